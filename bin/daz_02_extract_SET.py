@@ -2,7 +2,7 @@
 """
 v1.0 2022-01-03 Milan Lazecky, Leeds Uni
 
-This script will calculate solid Earth tides (currently using 'solid' implemented in GMT earthtides) and merge with esds.txt.
+This script will calculate solid Earth tides (using 'solid' - either its python port in daz_lib, or as implemented in GMT earthtides) and merge with esds.txt.
 If the SET file exists, it will just merge it.
 
 ===============
@@ -25,13 +25,25 @@ frame, epoch, dEtide, dNtide, dUtide
 =====
 Usage
 =====
-daz_02_extract_SET.py [--indaz esds.txt] [--infra frames.csv] [--tidescsv tides.csv] [--outdaz esds.csv]
+daz_02_extract_SET.py [--indaz esds.txt] [--infra frames.csv] [--tidescsv tides.csv] [--outdaz esds.csv] [--set_backend python] [--setcache SET.sqlite] [--perswath]
 
  --tidescsv - input or output (if does not exist) file containing SET.
+ --set_backend - python (default, in-process computation for all frames at once, see daz_lib.get_SET_ENU),
+                 gmt (gmt earthtide called once per frame, frames in parallel) or gmt_sh (original get_SET.sh, takes long)
+ --setcache - sqlite file to cache SET values (for python backend), so reruns/updates compute tides only for new epochs.
+              (the cache is used also by other SET functions in daz_lib if env. variable DAZ_SETCACHE is set)
+ --perswath - (python backend) evaluate SET at centres of swaths (swath_center_lon/lat in frames csv) and average them weighted by number of burst overlaps
+              (exits if the frames csv has no such columns, e.g. the default daz_01 frames csv; frames without values fall back to the frame centre)
 
 """
 #%% Change log
 '''
+v1.1 2026-10-19
+ - added python SET backend (default), GMT through get_SET.sh kept as --set_backend gmt
+ - added SET cache (--setcache)
+ - merging tides as a single join, epochs without tides are stored to *_missing_tides.csv
+ - batched gmt backend (one gmt earthtide call per frame), get_SET.sh kept as --set_backend gmt_sh
+ - per-swath SET (--perswath)
 v1.0 2022-01-03 Milan Lazecky, Uni of Leeds
  - Original implementation - based on codes from 2021-06-24
 '''
@@ -57,11 +69,14 @@ def main(argv=None):
     inframesfile = 'frames.csv'
     outdazfile = 'esds.csv'
     tidescsv = 'earthtides.csv'
+    set_backend = 'python'
+    setcache = None
+    perswath = False
     
     #%% Read options
     try:
         try:
-            opts, args = getopt.getopt(argv[1:], "h", ["help", "indaz=", "infra=", "outdaz=", "tidescsv="])
+            opts, args = getopt.getopt(argv[1:], "h", ["help", "indaz=", "infra=", "outdaz=", "tidescsv=", "set_backend=", "setcache=", "perswath"])
         except getopt.error as msg:
             raise Usage(msg)
         for o, a in opts:
@@ -76,6 +91,12 @@ def main(argv=None):
                 outdazfile = a
             elif o == "--tidescsv":
                 tidescsv = a
+            elif o == "--set_backend":
+                set_backend = a
+            elif o == "--setcache":
+                setcache = a
+            elif o == "--perswath":
+                perswath = True
         
         if os.path.exists(outdazfile):
             raise Usage('output esds csv file already exists. Cancelling')
@@ -83,6 +104,8 @@ def main(argv=None):
             raise Usage('input frames txt file does not exist. Cancelling')
         if not os.path.exists(indazfile):
             raise Usage('input esds txt file does not exist. Cancelling')
+        if set_backend not in ['python', 'gmt', 'gmt_sh']:
+            raise Usage('set_backend must be one of python, gmt, gmt_sh')
             
     except Usage as err:
         print("\nERROR:",)
@@ -93,9 +116,20 @@ def main(argv=None):
     # processing itself:
     if not os.path.exists(tidescsv):
         print('SET file {0} does not exist. Generating it.'.format(tidescsv))
-        print('(warning - this may take really long. it can take days..)')
-        cmd = 'get_SET.sh {0} {1} {2}'.format(indazfile, inframesfile, tidescsv)
-        os.system(cmd)
+        if set_backend == 'gmt_sh':
+            print('(warning - this may take really long. it can take days..)')
+            cmd = 'get_SET.sh {0} {1} {2}'.format(indazfile, inframesfile, tidescsv)
+            os.system(cmd)
+        else:
+            esds, framespd = load_csvs(esdscsv=indazfile, framescsv=inframesfile)
+            if set_backend == 'gmt':
+                earthtides = get_SET_all_frames_gmt(esds, framespd)
+            else:
+                if perswath and not 'swath_center_lon' in framespd:
+                    print('ERROR - per-swath SET requested but the frames csv has no per-swath centres (swath_center_lon/lat), exiting')
+                    return 2
+                earthtides = get_SET_all_frames(esds, framespd, cachefile = setcache, perswath = perswath)
+            earthtides.to_csv(tidescsv, index=False, float_format='%.12f')
     else:
         print('SET file already exists. Will use it for merging')
     
@@ -109,7 +143,11 @@ def main(argv=None):
     #framespd = pd.read_csv(inframesfile)
     esds, framespd = load_csvs(esdscsv=indazfile, framescsv=inframesfile)
     print('converting SET data to azimuth direction and merging with ESD values')
-    esds = merge_tides(esds, framespd, earthtides)
+    esds, missing = merge_tides(esds, framespd, earthtides, return_missing = True)
+    if not missing.empty:
+        missingcsv = outdazfile.replace('.csv', '') + '_missing_tides.csv'
+        print('storing list of epochs without SET to '+missingcsv)
+        missing.to_csv(missingcsv, index=False)
     print('exporting final merge to '+outdazfile)
     esds.to_csv(outdazfile)
     print('done')
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+v1.0 2026-10-19
+
+This script will calculate ocean tide loading (OTL) displacement in azimuth direction for all epochs (daz_otl_mm).
+The OTL harmonic constants (amplitude, phase of the 11 main constituents) are extracted for frame centres from the OTL grid only once
+and stored (projected to azimuth) in the frames csv - the per-epoch evaluation is then done for all epochs at once.
+
+===============
+Input & output files
+===============
+Inputs :
+ - frames.csv - contains data with heading:
+frame,master,center_lon,center_lat,heading,azimuth_resolution,avg_incidence_angle,centre_range_m,centre_time,dfDC
+ - esds.csv - output of daz_02 (contains daz_tide_mm)
+ - otl_grid.nc - OTL grid, with variables amp_E, pha_E, amp_N, pha_N (amplitude [m], phase lag [deg], E/N positive),
+                 dimensions (constituent, lat, lon) and constituents named as in BLQ files (M2, S2, N2, K2, K1, O1, P1, Q1, Mf, Mm, Ssa)
+                 (not needed if frames.csv already contains otl_azi_amp_*, otl_azi_pha_* columns)
+
+Outputs :
+ - esds_with_otl.csv - added daz_otl_mm column (and with --apply, daz_tide_mm including OTL, daz_set_mm with the original SET)
+ - frames_with_otl.csv - added otl_azi_amp_*, otl_azi_pha_* columns
+
+=====
+Usage
+=====
+daz_02b_extract_OTL.py [--indaz esds.csv] [--infra frames.csv] [--otlnc otl_grid.nc] [--outdaz esds_with_otl.csv] [--outfra frames_with_otl.csv] [--apply]
+
+ --apply - add the OTL to daz_tide_mm (the SET only is kept as daz_set_mm), so that it is removed together with SET in daz_mm_notide
+           (computed in the next steps, i.e. daz_03). Otherwise OTL is only stored as daz_otl_mm
+"""
+#%% Change log
+'''
+v1.0 2026-10-19
+ - Original implementation
+'''
+
+import getopt, os, sys
+from daz_lib import *
+
+class Usage(Exception):
+    """Usage context manager"""
+    def __init__(self, msg):
+        self.msg = msg
+
+
+#%% Main
+def main(argv=None):
+
+    #%% Check argv
+    if argv == None:
+        argv = sys.argv
+
+    #%% Set default
+    indazfile = 'esds.csv'
+    inframesfile = 'frames.csv'
+    otlnc = 'otl_grid.nc'
+    outdazfile = 'esds_with_otl.csv'
+    outframesfile = 'frames_with_otl.csv'
+    apply = False
+
+    #%% Read options
+    try:
+        try:
+            opts, args = getopt.getopt(argv[1:], "h", ["help", "apply", "indaz=", "infra=", "otlnc=", "outdaz=", "outfra="])
+        except getopt.error as msg:
+            raise Usage(msg)
+        for o, a in opts:
+            if o == '-h' or o == '--help':
+                print(__doc__)
+                return 0
+            elif o == "--apply":
+                apply = True
+            elif o == "--indaz":
+                indazfile = a
+            elif o == "--infra":
+                inframesfile = a
+            elif o == "--otlnc":
+                otlnc = a
+            elif o == "--outdaz":
+                outdazfile = a
+            elif o == "--outfra":
+                outframesfile = a
+
+        if os.path.exists(outdazfile):
+            raise Usage('output esds csv file already exists. Cancelling')
+        if os.path.exists(outframesfile):
+            raise Usage('output frames csv file already exists. Cancelling')
+        if not os.path.exists(inframesfile):
+            raise Usage('input frames csv file does not exist. Cancelling')
+        if not os.path.exists(indazfile):
+            raise Usage('input esds csv file does not exist. Cancelling')
+
+    except Usage as err:
+        print("\nERROR:",)
+        print("  "+str(err.msg))
+        print("\nFor help, use -h or --help.\n")
+        return 2
+
+    # processing itself:
+    esds, framespd = load_csvs(esdscsv = indazfile, framescsv = inframesfile)
+    if not 'otl_azi_amp_M2' in framespd:
+        if not os.path.exists(otlnc):
+            print('ERROR - OTL grid file {} does not exist, exiting'.format(otlnc))
+            return 2
+        print('extracting OTL constituents for frame centres')
+        framespd = df_get_otl_constituents(framespd, otlnc)
+    else:
+        print('OTL constituents already in frames csv, using them')
+    print('calculating OTL in azimuth for all epochs')
+    esds = df_calculate_otl(esds, framespd)
+    if apply:
+        print('adding OTL to daz_tide_mm')
+        if not 'daz_set_mm' in esds:
+            # keep SET alone (also to avoid adding OTL twice if rerun on own output)
+            if 'daz_tide_mm' in esds:
+                esds['daz_set_mm'] = esds['daz_tide_mm']
+            else:
+                print('WARNING, no daz_tide_mm column (SET not extracted?), using OTL only')
+                esds['daz_set_mm'] = 0.0
+        esds['daz_tide_mm'] = esds['daz_set_mm'] + esds['daz_otl_mm']
+        if ('daz_mm_notide' in esds) and ('daz_mm' in esds):
+            esds['daz_mm_notide'] = esds['daz_mm'] - esds['daz_tide_mm']
+    print('exporting to '+outdazfile+' and '+outframesfile)
+    esds.to_csv(outdazfile)
+    framespd.to_csv(outframesfile)
+    print('done')
+
+#%% main
+if __name__ == "__main__":
+    sys.exit(main())
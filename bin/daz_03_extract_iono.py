@@ -20,13 +20,33 @@ Outputs :
 =====
 Usage
 =====
-daz_03_extract_iono.py [--indaz esds.csv] [--use_gim] [--infra frames.csv] [--outfra frames_with_iono.csv] [--outdaz esds_with_iono.csv]
+daz_03_extract_iono.py [--indaz esds.csv] [--use_gim] [--daymajor] [--gimstore DIR] [--ensemble jpl,code,iri] [--iritable iri_table.nc] [--iricache iri.sqlite] [--nproc 1] [--perbovl] [--orbpar TEMPLATE] [--infra frames.csv] [--outfra frames_with_iono.csv] [--outdaz esds_with_iono.csv]
 
 Notes:
     --use_gim  Will apply JPL GIM (or CODE if JPL data not available) to get TEC values rather than the default IRI2016 estimates. Note IRI2016 can still be used to estimate iono peak altitude. Tested only in LiCSAR environment.
+    --daymajor Will evaluate TEC of all frames grouped per GIM day (each GIM day loaded only once) rather than frame by frame. Same results, faster for many frames.
+    --ensemble Will evaluate also these TEC sources in the same pass (jpl for JPL-HR GIM, code for CODE GIM, iri), stored as daz_iono_mm_<source> columns
+               together with their mean and std (daz_iono_mm_ensmean, daz_iono_mm_ensstd). The correction itself (daz_iono_mm) is still from the default/GIM source.
+    --iritable Will estimate iono peak altitude using the IRI surrogate table (see daz_03c_IRI_table.py) rather than running IRI.
+    --iricache sqlite file to cache IRI runs (sets env. variable DAZ_IRICACHE), so reruns and overlapping frames do not rerun IRI for the same time and point.
+    --nproc    Number of parallel IRI processes (sets env. variable DAZ_IRINPROC). Used for the IRI runs not found in the cache, e.g. with --daymajor.
+    --perbovl  Will estimate the iono correction per burst overlap (rather than per swath centre) and average it. Needs per-swath frame data (swath_* columns),
+               The overlap times are taken from the reference epoch TOPS_par burst windows (swath_bovl_dt column, from get_frameta perswath),
+               otherwise a nominal burst layout is used (spaced by swath_burst_interval about the swath centre).
+    --orbpar   Template of the reference epoch SLC par files (with {frame}, {track} and {master} fields), e.g. '$LiCSAR_procdir/{track}/{frame}/SLC/{master}/{master}.slc.par'.
+               If given, the satellite positions are interpolated from their orbit state vectors rather than estimated from the centre range.
+    --gimstore Directory with GIM files, or the GIM archive file (see daz_03b_archive_GIM.py). Default is the one used in LiCSAR environment.
 """
 #%% Change log
 '''
+v1.3 2026-10-19
+ - added day-major processing option (--daymajor)
+ - added option to use GIM directory or archive (--gimstore)
+ - added multi-source ensemble evaluation (--ensemble)
+ - added use of IRI surrogate table (--iritable)
+ - added IRI cache and parallel IRI runs (--iricache, --nproc)
+ - added per burst overlap estimation (--perbovl)
+ - added satellite positions from orbit state vectors (--orbpar)
 v1.2 2025-06-12 ML imported codes by M. Nergizci to replace CODE for JPL GIM (proven better as with higher temporal sampling)
 v1.1 2023-08-10 Milan Lazecky, UoL
  - added option to get iono correction from CODE (combined with IRI2016 to estimate iono F2 peak altitude)
@@ -60,11 +80,17 @@ def main(argv=None):
     outdazfile = 'esds_with_iono.csv'
     outframesfile = 'frames_with_iono.csv'
     ionosource = 'iri'
+    daymajor = False
+    storedir = '/gws/ssde/j25a/nceo_geohazards/vol1/code_iono'
+    ensemble = None
+    iritable = None
+    perbovl = False
+    orbpar = None
 
     #%% Read options
     try:
         try:
-            opts, args = getopt.getopt(argv[1:], "h", ["help", "use_gim", "indaz=", "infra=", "outdaz=", "outfra="])
+            opts, args = getopt.getopt(argv[1:], "h", ["help", "use_gim", "daymajor", "perbovl", "gimstore=", "ensemble=", "iritable=", "iricache=", "nproc=", "orbpar=", "indaz=", "infra=", "outdaz=", "outfra="])
         except getopt.error as msg:
             raise Usage(msg)
         for o, a in opts:
@@ -74,6 +100,22 @@ def main(argv=None):
             if o == '--use_gim':
                 ionosource = 'code'
                 print('using GIM (primarily JPL, or CODE) for iono correction - note latest data might not be processed (will be stored as NaN in the csv)')
+            elif o == "--daymajor":
+                daymajor = True
+            elif o == "--perbovl":
+                perbovl = True
+            elif o == "--orbpar":
+                orbpar = os.path.expandvars(a)
+            elif o == "--gimstore":
+                storedir = a
+            elif o == "--ensemble":
+                ensemble = a.split(',')
+            elif o == "--iritable":
+                iritable = a
+            elif o == "--iricache":
+                os.environ['DAZ_IRICACHE'] = a
+            elif o == "--nproc":
+                os.environ['DAZ_IRINPROC'] = str(int(a))
             elif o == "--indaz":
                 indazfile = a
             elif o == "--infra":
@@ -128,7 +170,7 @@ def main(argv=None):
     print('extra data cleaning step - perhaps should add to another step (first?)')
     esds, framespd = df_preprepare_esds(esds, framespd, firstdate = '', countlimit = 25)
     print('performing the iono calculation')
-    esds, framespd = extract_iono_full(esds, framespd, ionosource = ionosource, use_iri_hei=use_iri_hei)
+    esds, framespd = extract_iono_full(esds, framespd, ionosource = ionosource, use_iri_hei=(use_iri_hei or iritable != None), daymajor = daymajor, storedir = storedir, ensemble = ensemble, iritable = iritable, perbovl = perbovl, orbpar = orbpar)
     if 'daz_mm_notide' in esds:
         col = 'daz_mm_notide'
     else:
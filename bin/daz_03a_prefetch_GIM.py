@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+v1.0 2026-10-19
+
+This script will download (concurrently) the GIM files (JPL-HR GIM, or CODE GIM if not available) needed for the ionosphere correction
+of all epochs in esds.csv (+- 1 day, for epochs close to midnight) into the GIM store directory, prior to running daz_03_extract_iono.py.
+Days already existing in the store are skipped.
+
+===============
+Input & output files
+===============
+Inputs :
+ - esds.csv - contains data with heading:
+,frame,orbits_precision,epochdate,daz_mm,years_since_beginning[,daz_tide_mm,daz_mm_notide]
+
+Outputs :
+ - GIM files in the store directory
+ - gim_prefetch.csv - list of days and their GIM files (False if not available)
+
+=====
+Usage
+=====
+daz_03a_prefetch_GIM.py [--indaz esds.csv] [--storedir DIR] [--nproc 8] [--retries 3] [--nojpl] [--jplurl URL] [--codeurl URL] [--manifest sha256sums.txt] [--outcsv gim_prefetch.csv]
+
+ --storedir - GIM store directory (default is the one used in LiCSAR environment)
+ --nproc    - number of concurrent downloads
+ --nojpl    - download only CODE GIMs
+ --jplurl, --codeurl - base URLs of the JPL-HR GIM and CODE archives (the year subdirectory is added), e.g. for a local mirror
+ --manifest - file with sha256 checksums ('<sha256>  <filename>' per line) to verify the downloads. Otherwise, gzip CRC is checked
+"""
+#%% Change log
+'''
+v1.0 2026-10-19
+ - Original implementation
+'''
+
+import getopt, os, sys
+from daz_lib import *
+from daz_iono import *
+
+class Usage(Exception):
+    """Usage context manager"""
+    def __init__(self, msg):
+        self.msg = msg
+
+
+#%% Main
+def main(argv=None):
+
+    #%% Check argv
+    if argv == None:
+        argv = sys.argv
+
+    #%% Set default
+    indazfile = 'esds.csv'
+    storedir = '/gws/ssde/j25a/nceo_geohazards/vol1/code_iono'
+    outcsv = 'gim_prefetch.csv'
+    nproc = 8
+    retries = 3
+    noJPL = False
+    jplurl = None
+    codeurl = None
+    manifest = None
+
+    #%% Read options
+    try:
+        try:
+            opts, args = getopt.getopt(argv[1:], "h", ["help", "nojpl", "indaz=", "storedir=", "nproc=", "retries=", "jplurl=", "codeurl=", "manifest=", "outcsv="])
+        except getopt.error as msg:
+            raise Usage(msg)
+        for o, a in opts:
+            if o == '-h' or o == '--help':
+                print(__doc__)
+                return 0
+            elif o == "--nojpl":
+                noJPL = True
+            elif o == "--indaz":
+                indazfile = a
+            elif o == "--storedir":
+                storedir = a
+            elif o == "--nproc":
+                nproc = int(a)
+            elif o == "--retries":
+                retries = int(a)
+            elif o == "--jplurl":
+                jplurl = a.rstrip('/') + '/'
+            elif o == "--codeurl":
+                codeurl = a.rstrip('/') + '/'
+            elif o == "--manifest":
+                manifest = a
+            elif o == "--outcsv":
+                outcsv = a
+
+        if not os.path.exists(indazfile):
+            raise Usage('input esds csv file does not exist. Cancelling')
+        if manifest and not os.path.exists(manifest):
+            raise Usage('checksum manifest file does not exist. Cancelling')
+
+    except Usage as err:
+        print("\nERROR:",)
+        print("  "+str(err.msg))
+        print("\nFor help, use -h or --help.\n")
+        return 2
+
+    # processing itself:
+    esds = pd.read_csv(indazfile)
+    days = get_gim_days(esds)
+    checksums = read_checksum_manifest(manifest) if manifest else None
+    print('prefetching GIM for {} days using {} parallel downloads'.format(len(days), nproc))
+    gims = prefetch_gim(days, storedir, nthreads = nproc, noJPL = noJPL, retries = retries,
+                        checksums = checksums, jplurl = jplurl, codeurl = codeurl)
+    nmissing = (gims['file'] == False).sum()
+    if nmissing > 0:
+        print('WARNING, GIM not available for {} days'.format(nmissing))
+    gims.to_csv(outcsv, index = False)
+    print('done')
+
+#%% main
+if __name__ == "__main__":
+    sys.exit(main())
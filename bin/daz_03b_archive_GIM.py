@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+v1.0 2026-10-19
+
+This script will convert GIM files (JPL-HR GIM, or CODE GIM if not available) of the given days from the GIM store directory
+into the GIM archive - a single chunked NetCDF4 file with all days on a common time axis (15 min), TEC stored as int16 (0.01 TECU)
+and a source flag per time step. The archive can then be used instead of the store directory in daz_03_extract_iono.py (--gimstore),
+reading only the chunks needed. Existing archive is updated (days already in the archive are overwritten).
+Note the archive time axis starts at the first day converted - days before the start of an existing archive cannot be added
+(they are skipped with a warning), so to backfill older days, create a new archive starting from the earliest day needed.
+
+===============
+Input & output files
+===============
+Inputs :
+ - esds.csv - contains data with heading:
+,frame,orbits_precision,epochdate,daz_mm,years_since_beginning[,daz_tide_mm,daz_mm_notide]
+   (or use --start, --end)
+
+Outputs :
+ - gim_archive.nc - the GIM archive
+ - gim_archive.csv - list of days and their GIM source (none if not available)
+
+=====
+Usage
+=====
+daz_03b_archive_GIM.py [--indaz esds.csv] [--start 2016-01-01 --end 2025-12-31] [--storedir DIR] [--archive gim_archive.nc] [--nojpl] [--outcsv gim_archive.csv]
+
+ --start, --end - convert all days in this range instead of days needed for esds.csv epochs
+ --storedir - GIM store directory (default is the one used in LiCSAR environment). Missing GIM files would get downloaded
+ --nojpl    - use only CODE GIMs
+"""
+#%% Change log
+'''
+v1.0 2026-10-19
+ - Original implementation
+'''
+
+import getopt, os, sys
+from daz_lib import *
+from daz_iono import *
+
+class Usage(Exception):
+    """Usage context manager"""
+    def __init__(self, msg):
+        self.msg = msg
+
+
+#%% Main
+def main(argv=None):
+
+    #%% Check argv
+    if argv == None:
+        argv = sys.argv
+
+    #%% Set default
+    indazfile = 'esds.csv'
+    storedir = '/gws/ssde/j25a/nceo_geohazards/vol1/code_iono'
+    archive = 'gim_archive.nc'
+    outcsv = 'gim_archive.csv'
+    start = None
+    end = None
+    noJPL = False
+
+    #%% Read options
+    try:
+        try:
+            opts, args = getopt.getopt(argv[1:], "h", ["help", "nojpl", "indaz=", "start=", "end=", "storedir=", "archive=", "outcsv="])
+        except getopt.error as msg:
+            raise Usage(msg)
+        for o, a in opts:
+            if o == '-h' or o == '--help':
+                print(__doc__)
+                return 0
+            elif o == "--nojpl":
+                noJPL = True
+            elif o == "--indaz":
+                indazfile = a
+            elif o == "--start":
+                start = a
+            elif o == "--end":
+                end = a
+            elif o == "--storedir":
+                storedir = a
+            elif o == "--archive":
+                archive = a
+            elif o == "--outcsv":
+                outcsv = a
+
+        if (start == None) != (end == None):
+            raise Usage('please provide both --start and --end')
+        if start == None and not os.path.exists(indazfile):
+            raise Usage('input esds csv file does not exist. Cancelling')
+
+    except Usage as err:
+        print("\nERROR:",)
+        print("  "+str(err.msg))
+        print("\nFor help, use -h or --help.\n")
+        return 2
+
+    # processing itself:
+    if start == None:
+        days = get_gim_days(pd.read_csv(indazfile))
+    else:
+        days = pd.date_range(start, end, freq = 'D')
+    print('converting GIM of {} days to {}'.format(len(days), archive))
+    gims = update_gim_archive(archive, days, storedir, noJPL = noJPL)
+    nmissing = (gims['source'] == 'none').sum()
+    if nmissing > 0:
+        print('WARNING, GIM not available for {} days'.format(nmissing))
+    gims.to_csv(outcsv, index = False)
+    print('done')
+
+#%% main
+if __name__ == "__main__":
+    sys.exit(main())
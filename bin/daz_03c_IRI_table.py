@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+v1.0 2026-10-19
+
+This script will create the IRI surrogate table - hmF2 and alpha (TEC fraction below the satellite) tabulated from IRI model
+on lat/lon/local time/day of year/solar flux grid - and/or report its errors against direct IRI runs.
+The table can then be used in daz_03_extract_iono.py (--iritable) to avoid running IRI per epoch.
+Note the table creation is a one-off but takes long (two IRI runs per grid node) - use --nproc to run IRI in parallel.
+
+===============
+Input & output files
+===============
+Inputs :
+ - (optional) F10.7 table (fluxtable.txt from spaceweather.gc.ca - downloaded if not given)
+
+Outputs :
+ - iri_table.nc - the IRI surrogate table (with --create)
+ - iri_table_report.csv - per point comparison of table and IRI values (with --report)
+
+=====
+Usage
+=====
+daz_03c_IRI_table.py [--table iri_table.nc] [--create] [--report iri_table_report.csv] [--npoints 200] [--fluxtable fluxtable.txt] [--iricache iri.sqlite] [--nproc 1]
+
+ --create    - create the table (otherwise the existing table is used for the report)
+ --report    - compare the table with direct IRI runs in random points and store to this csv
+ --npoints   - number of random points for the report
+ --fluxtable - F10.7 table file (or url)
+ --iricache  - sqlite file to cache IRI runs (sets env. variable DAZ_IRICACHE), so interrupted/repeated runs do not rerun IRI
+ --nproc     - number of parallel IRI processes (sets env. variable DAZ_IRINPROC)
+"""
+#%% Change log
+'''
+v1.0 2026-10-19
+ - Original implementation
+'''
+
+import getopt, os, sys
+from daz_lib import *
+from daz_iono import *
+
+class Usage(Exception):
+    """Usage context manager"""
+    def __init__(self, msg):
+        self.msg = msg
+
+
+#%% Main
+def main(argv=None):
+
+    #%% Check argv
+    if argv == None:
+        argv = sys.argv
+
+    #%% Set default
+    tablefile = 'iri_table.nc'
+    create = False
+    reportfile = None
+    npoints = 200
+    fluxtable = None
+    iricache = None
+    nproc = None
+
+    #%% Read options
+    try:
+        try:
+            opts, args = getopt.getopt(argv[1:], "h", ["help", "create", "table=", "report=", "npoints=", "fluxtable=", "iricache=", "nproc="])
+        except getopt.error as msg:
+            raise Usage(msg)
+        for o, a in opts:
+            if o == '-h' or o == '--help':
+                print(__doc__)
+                return 0
+            elif o == "--create":
+                create = True
+            elif o == "--table":
+                tablefile = a
+            elif o == "--report":
+                reportfile = a
+            elif o == "--npoints":
+                npoints = int(a)
+            elif o == "--fluxtable":
+                fluxtable = a
+            elif o == "--iricache":
+                iricache = a
+            elif o == "--nproc":
+                nproc = int(a)
+
+        if create and os.path.exists(tablefile):
+            raise Usage('output table file already exists. Cancelling')
+        if not create and not os.path.exists(tablefile):
+            raise Usage('the table file does not exist (use --create). Cancelling')
+        if not create and not reportfile:
+            raise Usage('nothing to do, please use --create and/or --report')
+
+    except Usage as err:
+        print("\nERROR:",)
+        print("  "+str(err.msg))
+        print("\nFor help, use -h or --help.\n")
+        return 2
+
+    # processing itself:
+    if iricache:
+        os.environ['DAZ_IRICACHE'] = iricache
+    if nproc:
+        os.environ['DAZ_IRINPROC'] = str(nproc)
+    ftable = get_f107_table(fluxtable) if fluxtable else None
+    if create:
+        print('creating IRI surrogate table (takes long)')
+        iritable = create_iri_table(tablefile, ftable = ftable)
+    else:
+        iritable = load_iri_table(tablefile)
+    if reportfile:
+        print('comparing the table with IRI in {} random points'.format(npoints))
+        report = iri_surrogate_report(iritable, npoints = npoints, ftable = ftable)
+        report.to_csv(reportfile, index = False)
+    print('done')
+
+#%% main
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,14 +18,20 @@ Outputs :
 =====
 Usage
 =====
-daz_05_calculate_slopes.py [--s1ab] [--indaz esds_with_iono.csv] [--infra frames_with_itrf.csv] [--outfra frames_final.csv] [--outdaz esds_final.csv]
+daz_05_calculate_slopes.py [--s1ab] [--indaz esds_with_iono.csv] [--infra frames_with_itrf.csv] [--outfra frames_final.csv] [--outdaz esds_final.csv] [--outqc qc.csv] [--common_mode]
 
 Parameters:
     --s1ab ...... also estimate (and store to outfra) the s1ab offset prior to velocity estimation. Now done only for the noiono+notide (final) daz
     --nosubset .. by default, we limit the dataset to start since March 2016 as it appeared too noisy before. This can be adjusted/cancelled using this switch.
+    --outqc ..... run the data-quality report (per-frame counts, gaps, duplicates, A/B balance, detrended noise), store it to this csv and skip frames that fail the check
+                  (with --s1ab, the S1AB offset is estimated only for frames with enough S1B data before and after the POD change)
+    --common_mode  remove the common-mode signal of frames of the same track and date (stored as *_nocm columns) and estimate also their velocities
 """
 #%% Change log
 '''
+v1.2 2026-10-19
+ - added data-quality report stage (--outqc)
+ - added cross-frame common-mode filtering per track and date (--common_mode)
 v1.1 2024-04-06 ML
  - added S1AB offset estimation
 v1.0 2022-01-03 Milan Lazecky, Uni of Leeds
@@ -59,11 +65,13 @@ def main(argv=None):
     roll_assist = True
     s1ab = False
     subset = True
+    outqcfile = None
+    common_mode = False
     
     #%% Read options
     try:
         try:
-            opts, args = getopt.getopt(argv[1:], "h", ["help", "s1ab", "nosubset", "indaz=", "infra=", "outdaz=", "outfra="])
+            opts, args = getopt.getopt(argv[1:], "h", ["help", "s1ab", "nosubset", "indaz=", "infra=", "outdaz=", "outfra=", "outqc=", "common_mode"])
         except getopt.error as msg:
             raise Usage(msg)
         for o, a in opts:
@@ -82,6 +90,10 @@ def main(argv=None):
                 outdazfile = a
             elif o == "--outfra":
                 outframesfile = a
+            elif o == "--outqc":
+                outqcfile = a
+            elif o == "--common_mode":
+                common_mode = True
         
         if os.path.exists(outdazfile):
             raise Usage('output esds csv file already exists. Cancelling')
@@ -105,18 +117,33 @@ def main(argv=None):
 
     # setting 'subset' - means, only data > 2016-03-01 as before it is too noisy
     #subset = True
+    qc = None
+    if outqcfile:
+        # before subsetting, to have the full record counts (count_subset is evaluated inside)
+        print('Running data-quality report')
+        qccol = 'daz_mm' if 'daz_mm' in esds else 'daz_total_wrt_orbits'
+        qc = df_quality_report(esds, framespd, col = qccol)
+        qc.to_csv(outqcfile)
+        esds, framespd = qc_select_frames(esds, framespd, qc)
     if subset:
         print('Subsetting dataset to include only data after 2016-03-01')
         esds = esds[esds['epochdate'] > pd.Timestamp('2016-03-01')]
     if s1ab:
         print('Estimating S1AB offset per frame')
         # estimate the offset first, then apply correction, and then use Huber as usual
-        framespd = estimate_s1ab_allframes(esds, framespd, col = 'daz_mm_notide_noiono', rmsiter = 50)
+        framespd = estimate_s1ab_allframes(esds, framespd, col = 'daz_mm_notide_noiono', rmsiter = 50, qc = qc)
         print('Applying S1AB corrections (only to daz_mm_notide_noiono and stored as daz_mm_final)')
         esds['daz_mm_final'] = esds['daz_mm_notide_noiono'].copy()
         esds, framespd = correct_s1ab(esds, framespd, cols=['daz_mm_final'])
+    cols = ['daz_mm', 'daz_mm_notide', 'daz_mm_notide_noiono_grad', 'daz_mm_notide_noiono_iri', 'daz_mm_notide_noiono','daz_mm_final']
+    if common_mode:
+        print('Removing common mode per track and date')
+        for col in ['daz_mm_notide_noiono','daz_mm_final']:
+            if col in esds:
+                esds = df_remove_common_mode(esds, col = col)
+                cols.append(col+'_nocm')
     # 2021-10-12: the original way:
-    for col in ['daz_mm', 'daz_mm_notide', 'daz_mm_notide_noiono_grad', 'daz_mm_notide_noiono_iri', 'daz_mm_notide_noiono','daz_mm_final']:
+    for col in cols:
         if col in esds:
             print('estimating velocities of '+col)
             esds, framespd = df_calculate_slopes(esds, framespd, alpha = 1, eps = 1.35, bycol = col, subset = subset, roll_assist = roll_assist)
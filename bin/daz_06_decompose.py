@@ -17,15 +17,19 @@ Outputs :
 =====
 Usage
 =====
-daz_06_decompose.py [--infra frames_final.csv] [--outdec decomposed.csv] [--velnc vel_gps_kreemer.nc] [--outres 2.25]
+daz_06_decompose.py [--infra frames_final.csv] [--outdec decomposed.csv] [--velnc vel_gps_kreemer.nc] [--outres 2.25] [--inconsistent_factor 0]
 
 Note: param velnc is optional, but if provided as nc file with VEL_E, VEL_N variables, it will be used as GPS velocities.
 If not provided or vel_gps_kreemer.nc does not exist, it will extract ITRF2014 PMM instead.
 outres stands for output resolution - how large grid cell size (default: 2.25 deg)
+inconsistent_factor: frames with velocity inconsistent with their same-pass neighbours get their RMSE multiplied by this factor and the decomposition
+                     is solved by weighted least squares (default: 0 = switched off, e.g. 10 to downweight)
 
 """
 #%% Change log
 '''
+v1.1 2026-10-19
+ - downweighting frames inconsistent with their neighbours
 v1.0 2022-01-03 Milan Lazecky, Uni of Leeds
  - Original implementation - based on codes from 2021-06-24
 '''
@@ -54,10 +58,11 @@ def main(argv=None):
     outdecfile = 'decomposed.csv'
     velnc='vel_gps_kreemer.nc'
     outres = 2.25 # degrees
+    inconsistent_factor = 0
     #%% Read options
     try:
         try:
-            opts, args = getopt.getopt(argv[1:], "h", ["help", "infra=", "outdec=", "outres=","velnc="])
+            opts, args = getopt.getopt(argv[1:], "h", ["help", "infra=", "outdec=", "outres=","velnc=", "inconsistent_factor="])
         except getopt.error as msg:
             raise Usage(msg)
         for o, a in opts:
@@ -72,6 +77,8 @@ def main(argv=None):
                 outdecfile = a
             elif o == "--velnc":
                 velnc = a
+            elif o == "--inconsistent_factor":
+                inconsistent_factor = float(a)
         if os.path.exists(outdecfile):
             raise Usage('output decomposition file already exists. Cancelling')
         if not os.path.exists(inframesfile):
@@ -86,7 +93,7 @@ def main(argv=None):
     # processing itself:
     framespd = pd.read_csv(inframesfile)
     print('decomposing frames')
-    gridagg = decompose_framespd(framespd, cell_size = outres)
+    gridagg = decompose_framespd(framespd, cell_size = outres, inconsistent_factor = inconsistent_factor)
     #print('getting ITRF 2014 PMM for new cells')
     if os.path.exists(velnc):
         print('Extracting values from the available GNSS-based grid')
@@ -24,19 +24,27 @@ except:
 import pyproj
 import numpy as np
 import re
-import glob
+from functools import lru_cache
+from scipy.interpolate import RegularGridInterpolator, CubicHermiteSpline
+# for GIM download
+import gzip, hashlib, shutil, io
+import urllib.request, urllib.error
+from concurrent.futures import ThreadPoolExecutor
 try:
-    import wget
-    #import zlib
-    from LiCSAR_misc import grep1line
+    import unlzw3
 except:
-    print('error loading libraries to use of CODE (either wget or LiCSAR_misc). Use of CODE will fail')
+    unlzw3 = None
 
 
 # get daz iono
 ################### IONOSPHERE 
 
-def extract_iono_full(esds, framespd, ionosource = 'iri', use_iri_hei=True):
+# TEC sources for the ensemble (see extract_iono_full) - GIMs are used strictly, i.e. without the JPL-HR -> CODE fallback
+IONO_ENSEMBLE_SOURCES = {'jpl': 'jplhr', 'code': 'codg', 'iri': 'iri'}
+
+
+def extract_iono_full(esds, framespd, ionosource = 'iri', use_iri_hei=True, daymajor = False, storedir = '/gws/ssde/j25a/nceo_geohazards/vol1/code_iono',
+                      ensemble = None, iritable = None, perbovl = False, orbpar = None):
     """ Full extraction of ionospheric effect from ionosource.
     Note this will create column with the phase advanced effect recalculated to apparent azimuth offset [mm] that has opposite sign.
     Therefore this conforms the GRL article and you can subtract this correction from the original values, as usual.
@@ -44,6 +52,14 @@ def extract_iono_full(esds, framespd, ionosource = 'iri', use_iri_hei=True):
     Args:
         ionosource (str):   either 'iri' or 'code'
         use_iri_hei (bool): estimating F2 peak altitude using IRI (recommended), otherwise the 'valid' height of GIM is used (450 km)
+        daymajor (bool):    if True, the TEC requests of all frames are first collected and then evaluated per GIM day
+                            (each GIM day is loaded only once), otherwise frame by frame. The results are identical
+        storedir (str):     GIM directory or GIM archive (see update_gim_archive)
+        ensemble (list):    TEC sources (see IONO_ENSEMBLE_SOURCES) to evaluate in the same (day-major) pass, sharing the IPPs of ionosource.
+                            Stored as daz_iono_mm_<source> columns, with their mean and std as daz_iono_mm_ensmean and daz_iono_mm_ensstd
+        iritable (str):     IRI surrogate table (see create_iri_table) to get hmF2 (with use_iri_hei) rather than running IRI
+        perbovl (bool):     if True, the per-swath correction is estimated per burst overlap (see get_iono_requests)
+        orbpar (str):       template of the reference epoch SLC par files, to get the satellite positions from orbit (see calculate_daz_iono)
     Returns:
         esds, framespd
     """
@@ -58,24 +74,61 @@ def extract_iono_full(esds, framespd, ionosource = 'iri', use_iri_hei=True):
     framespd['Hiono_range'] = 0.0
     framespd['tecs_A'] = 0.0
     framespd['tecs_B'] = 0.0
+    if ensemble:
+        for src in ensemble:
+            if src not in IONO_ENSEMBLE_SOURCES:
+                print('WARNING, unknown TEC source '+src+' is skipped from the ensemble')
+        ensemble = [src for src in ensemble if src in IONO_ENSEMBLE_SOURCES]
+    if ensemble:
+        if not daymajor:
+            print('the ensemble is evaluated in the day-major mode')
+            daymajor = True
+        enscols = ['daz_iono_mm_'+src for src in ensemble]
+        for col in enscols:
+            # NaN where the source is not available (not to bias the ensemble statistics)
+            esds[col] = np.nan
+    if daymajor:
+        ionoreqs = {}
+        for frame in framespd['frame']:
+            print(frame)
+            try:
+                ionoreq = get_iono_requests(frame, esds, framespd, method = 'gradient', ionosource=ionosource, use_iri_hei=use_iri_hei, iritable = iritable, perbovl = perbovl, orbpar = orbpar)
+            except:
+                print('some error occurred preparing IPPs here')
+                continue
+            if ionoreq is not False:
+                ionoreqs[frame] = ionoreq
+        if ionoreqs:
+            print('evaluating TEC of all frames per GIM day')
+            points = []
+            for frame, ionoreq in ionoreqs.items():
+                points.append(ionoreq['points'].assign(frame=frame, ensemble=''))
+                if ensemble:
+                    for src in ensemble:
+                        srcpoints = set_iono_source(ionoreq['points'], IONO_ENSEMBLE_SOURCES[src], ionoreq['perswath'])
+                        points.append(srcpoints.assign(frame=frame, ensemble=src))
+            points = evaluate_iono_requests(pd.concat(points, ignore_index=True), storedir = storedir)
+            for (frame, src), framepoints in points.groupby(['frame', 'ensemble']):
+                if src:
+                    ionoreqs[frame].setdefault('ensemble', {})[src] = framepoints.drop(columns=['frame', 'ensemble'])
+                else:
+                    ionoreqs[frame]['points'] = framepoints.drop(columns=['frame', 'ensemble'])
     for frame in framespd['frame']:
         print(frame)
         resolution = framespd[framespd['frame'] == frame]['azimuth_resolution'].values[0] # in metres
         try:
             #daz_iono_with_F2 = calculate_daz_iono(frame, esds, framespd)
             #daz_iono_grad, hionos, tecs_A_master, tecs_B_master = calculate_daz_iono(frame, esds, framespd, method = 'gomba', out_hionos = True, out_tec_master = True)
+            if daymajor:
+                out = combine_daz_iono(ionoreqs[frame], out_hionos = use_iri_hei, out_tec_all = True)
+            else:
+                out = calculate_daz_iono(frame, esds, framespd, method = 'gradient', out_hionos = use_iri_hei, out_tec_all = True, ionosource=ionosource, use_iri_hei=use_iri_hei, storedir = storedir, iritable = iritable, perbovl = perbovl, orbpar = orbpar)
             if use_iri_hei:
-                daz_iono_grad, hionos, tecs_A_master, tecs_B_master, tecs_A, tecs_B = calculate_daz_iono(frame, esds, framespd, method = 'gradient', out_hionos = True, out_tec_all = True, ionosource=ionosource, use_iri_hei=use_iri_hei)
+                daz_iono_grad, hionos, tecs_A_master, tecs_B_master, tecs_A, tecs_B = out
                 hiono = np.mean(hionos)
                 hiono_std = np.std(hionos)
             else:
-                daz_iono_grad, tecs_A_master, tecs_B_master, tecs_A, tecs_B = calculate_daz_iono(frame, esds,
-                                                                                                         framespd,
-                                                                                                         method='gradient',
-                                                                                                         out_hionos=False,
-                                                                                                         out_tec_all=True,
-                                                                                                         ionosource=ionosource,
-                                                                                                         use_iri_hei=use_iri_hei)
+                daz_iono_grad, tecs_A_master, tecs_B_master, tecs_A, tecs_B = out
                 hiono = 450
                 hiono_std = 0
         except:
@@ -89,6 +142,13 @@ def extract_iono_full(esds, framespd, ionosource = 'iri', use_iri_hei=True):
         # skipping the correction here, since daz_mm_notide might not exist/not needed:
         #selesds['daz_mm_notide_noiono_grad'] = selesds['daz_mm_notide'] + selesds['daz_iono_grad_mm'] #*resolution*1000
         esds.update(selesds)
+        if ensemble:
+            # (assigned directly, as update would skip NaN)
+            for src, srcpoints in ionoreqs[frame].get('ensemble', {}).items():
+                try:
+                    esds.loc[selesds.index, 'daz_iono_mm_'+src] = combine_daz_iono(dict(ionoreqs[frame], points=srcpoints))*resolution*1000
+                except (KeyError, IndexError, ValueError) as e:
+                    print('some error occurred extracting TEC(s) of '+src+' here: '+str(e))
         framespd.at[framespd[framespd['frame'] == frame].index[0], 'Hiono'] = hiono
         if use_iri_hei:
             framespd.at[framespd[framespd['frame']==frame].index[0], 'Hiono_std'] = hiono_std
@@ -96,6 +156,9 @@ def extract_iono_full(esds, framespd, ionosource = 'iri', use_iri_hei=True):
         framespd.at[framespd[framespd['frame']==frame].index[0], 'tecs_A'] = tecs_A_master
         framespd.at[framespd[framespd['frame']==frame].index[0], 'tecs_B'] = tecs_B_master
         #esds.at[esds[esds['frame']==frame].index, 'daz_mm_notide_noiono_F2'] = esds[esds['frame']==frame]['daz_mm_notide'] - esds['daz_iono_with_F2']*resolution*1000
+    if ensemble:
+        esds['daz_iono_mm_ensmean'] = esds[enscols].mean(axis=1)
+        esds['daz_iono_mm_ensstd'] = esds[enscols].std(axis=1)
     return esds, framespd
 
 
@@ -133,21 +196,23 @@ def get_tecs(glat, glon, altitude, acq_times, returnhei = False, source='jpl', a
     if source == 'jpliri':
         ftable = get_f107_table()
         print('this was an experiment but seems not worth further works')
-    for acqtime in acq_times:
+    if source == 'iri' or (source == 'code' and getalpha):
+        # all IRI runs at once (memoised, see get_iri_cached)
+        iri_tecs, iri_heis = get_iri_cached(acq_times, glat, glon, altkmrange)
+        if getalpha:
+            iri_tecs_gps, _ = get_iri_cached(acq_times, glat, glon, [0, 20000, 20000])
+            iri_alphas = iri_tecs / iri_tecs_gps
+    for i, acqtime in enumerate(acq_times):
         if source == 'iri':
-            iri_acq = iri.IRI(acqtime, altkmrange, glat, glon )
-            TECs.append(iri_acq.TEC.values[0])
-            heis.append(iri_acq.hmF2.values[0])
+            TECs.append(iri_tecs[i])
+            heis.append(iri_heis[i])
             if getalpha:
-                iri_acq_gps = iri.IRI(acqtime, [0, 20000, 20000], glat, glon)
-                alpha = float(iri_acq.TEC / iri_acq_gps.TEC)
+                alpha = float(iri_alphas[i])
                 # print('using alpha of ' + str(alpha))
             alphas.append(alpha)
         elif source == 'code':
             if getalpha:
-                iri_acq_gps = iri.IRI(acqtime, [0, 20000, 20000], glat, glon )
-                iri_acq = iri.IRI(acqtime, altkmrange, glat, glon )
-                alpha = float(iri_acq.TEC/iri_acq_gps.TEC)
+                alpha = float(iri_alphas[i])
                 # print('using alpha of '+str(alpha))
             alphas.append(alpha)
             try:
@@ -182,82 +247,907 @@ def get_tecs(glat, glon, altitude, acq_times, returnhei = False, source='jpl', a
             return TECs
 
 
+# persistent memo of IRI runs (see get_iri_cached) - IRI is run at the rounded keys
+IRI_CACHE_TIMEROUND = '1s'  # e.g. '1min' to reuse near-identical runs
+IRI_CACHE_LATLONROUND = 4  # decimals, e.g. 2 to reuse near-identical runs
+IRI_CACHE_BATCH = 20  # IRI runs per process pool task
 
-def download_code_data(acqtime, storedir = '/gws/ssde/j25a/nceo_geohazards/vol1/code_iono'):
-    """Downloads Ionospheric TEC data from JPL or CODE."""
-    ffound = False
-    if not ffound:
-        filename = 'jpld'+ acqtime.strftime('%j') + '0.' + acqtime.strftime('%y')+'i.nc.gz' # TODO: check YMD
-        url = 'https://sideshow.jpl.nasa.gov/pub/iono_daily/gim_for_research/jpld/' + str(acqtime.year) + '/' + filename
-        fullpath = os.path.join(storedir, filename)
-        ionix = fullpath[:-3]
-        if not os.path.exists(ionix):
-            if not os.path.exists(fullpath):
-                # download this
-                try:
-                    wget.download(url, out=storedir)
-                    ffound = True 
-                except:
-                    #print('jpl-hr not exist')
-                    ffound = False
-            if os.path.exists(fullpath):
-                ffound = True
+
+def _run_iri_batch(args):
+    ''' Runs IRI for a batch of (time, lat, lon, altmin, altmax, altstep) - to be used in process pool'''
+    times, lats, lons, altranges = args
+    tecs, heis = [], []
+    for acqtime, lat, lon, altkmrange in zip(times, lats, lons, altranges):
+        iri_acq = iri.IRI(acqtime, list(altkmrange), lat, lon)
+        tecs.append(float(iri_acq.TEC.values[0]))
+        heis.append(float(iri_acq.hmF2.values[0]))
+    return tecs, heis
+
+
+def get_iri_cached(acqtimes, lats, lons, altkmrange, cachefile = None, nproc = None, timeround = None, latlonround = None):
+    ''' Gets IRI TEC and hmF2 (as iri.IRI(acqtime, altkmrange, lat, lon)) for arrays of times and points (or their combination with scalars),
+    using persistent SQLite cache. The cache is keyed by IRI model, UTC time, lat/lon (rounded) and the altitude range -
+    only the missing values are computed (at these rounded keys, each only once), in a process pool if nproc > 1, and stored.
+
+    Args:
+        acqtimes (pd.Timestamp or list/array of them)
+        lats, lons (float or np.array)
+        altkmrange (list): [min, max, step] altitude [km]
+        cachefile (str):   path to the sqlite cache. If None, env. variable DAZ_IRICACHE is used (if set, otherwise no caching)
+        nproc (int):       number of processes for the missing runs. If None, env. variable DAZ_IRINPROC is used (if set, otherwise 1)
+        timeround (str):   rounding of the time (pandas frequency), default IRI_CACHE_TIMEROUND
+        latlonround (int): decimals of lat/lon, default IRI_CACHE_LATLONROUND
+    Returns:
+        np.array, np.array: TEC [TECU], hmF2 [km]
+    '''
+    if cachefile is None:
+        cachefile = os.environ.get('DAZ_IRICACHE')
+    if nproc is None:
+        nproc = int(os.environ.get('DAZ_IRINPROC', 1))
+    if timeround is None:
+        timeround = IRI_CACHE_TIMEROUND
+    if latlonround is None:
+        latlonround = IRI_CACHE_LATLONROUND
+    times = pd.DatetimeIndex(pd.to_datetime(np.atleast_1d(acqtimes))).round(timeround)
+    lats, lons, utcs = np.broadcast_arrays(np.asarray(lats, dtype=float), np.asarray(lons, dtype=float),
+                                           (times - pd.Timestamp('1970-01-01')) // pd.Timedelta(seconds=1))
+    keys = pd.DataFrame({'model': iri.__name__,
+                         'utc': utcs.ravel(),
+                         'lat': np.round(lats.ravel(), latlonround),
+                         'lon': np.round(lons.ravel(), latlonround),
+                         'altmin': float(altkmrange[0]), 'altmax': float(altkmrange[1]), 'altstep': float(altkmrange[2])})
+    vals = cache_lookup(cachefile, 'iri', keys, ['TEC', 'hmF2'])
+    miss = vals['TEC'].isnull().values
+    if miss.any():
+        mkeys = keys[miss].drop_duplicates()
+        mtimes = pd.Timestamp('1970-01-01') + pd.to_timedelta(mkeys['utc'].values, unit='s')
+        altranges = mkeys[['altmin', 'altmax', 'altstep']].values
+        batches = [(mtimes[i:i+IRI_CACHE_BATCH], mkeys['lat'].values[i:i+IRI_CACHE_BATCH], mkeys['lon'].values[i:i+IRI_CACHE_BATCH],
+                    altranges[i:i+IRI_CACHE_BATCH]) for i in range(0, len(mkeys), IRI_CACHE_BATCH)]
+        if nproc > 1 and len(batches) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers = nproc) as executor:
+                results = list(executor.map(_run_iri_batch, batches))
         else:
-            ffound = True
-    ###if JPL HR-GIM is not available, then try to download CODE data. After, 2024-08-01 we need CODE data. 
-    if not ffound:  
-        instrings = ['CODG', 'CGIM']
-        #lastrings = ['I', 'N']
-        for instr in instrings:
-            #for lastr in lastrings:
-            filename = instr + acqtime.strftime('%j') + '0.' + acqtime.strftime('%y') + 'I.Z'
-            url = 'http://ftp.aiub.unibe.ch/CODE/' + acqtime.strftime('%Y') + '/' + filename
-            fullpath = os.path.join(storedir, filename)
-            ionix = fullpath[:-2]
-            if not os.path.exists(ionix):
-                if not os.path.exists(fullpath):
-                    # download this
-                    try:
-                        wget.download(url, out=storedir)
-                        ffound = True 
-                    except:
-                        #print('code-oldname not exists')
-                        ffound = False
-                if os.path.exists(fullpath):
-                    ffound = True
-            else:
-                ffound = True
-            if ffound:
-                break  #Exit loop if successful download
+            results = [_run_iri_batch(batch) for batch in batches]
+        mvals = pd.DataFrame({'TEC': np.concatenate([r[0] for r in results]), 'hmF2': np.concatenate([r[1] for r in results])})
+        if cachefile:
+            cache_store(cachefile, 'iri', mkeys, mvals)
+        mvals.index = pd.MultiIndex.from_frame(mkeys)
+        vals.loc[miss] = mvals.reindex(pd.MultiIndex.from_frame(keys[miss])).values
+    return vals['TEC'].values, vals['hmF2'].values
+
+
+################### IRI SURROGATE TABLE
+# hmF2 and alpha (ratio of TEC up to IRI_TABLE_ALTITUDE to the TEC up to 20000 km, see get_tecs) tabulated from IRI
+# on lat/lon/local time/day of year/solar flux grid, to avoid running IRI per epoch (see create_iri_table)
+IRI_TABLE_ALTITUDE = 800  # km, as used for hmF2/alpha estimates in get_iono_requests
+IRI_TABLE_GRID = {'lat': np.arange(-80, 81, 10.0),
+                  'lon': np.arange(-180, 181, 30.0),
+                  'lt': np.arange(0, 25, 2.0),  # local (solar) time [h]
+                  'doy': np.linspace(0, 366, 13),
+                  'f107': np.array([70, 100, 140, 180, 220.0])}  # F10.7 [sfu], smoothed by IRI_TABLE_F107_WINDOW
+IRI_TABLE_F107_WINDOW = 365  # days (IRI uses 12-month running mean solar indices for the F2 peak)
+IRI_TABLE_F107_TOLERANCE = 20  # sfu, nodes with the used smoothed F10.7 further from the nominal one are reported
+
+
+def get_f107_smoothed(ftable = None, colname = 'fluxadjflux'):
+    ''' Gets daily F10.7 smoothed by centred running mean of IRI_TABLE_F107_WINDOW days.
+
+    Returns:
+        pd.Series indexed by day
+    '''
+    if type(ftable) == type(None):
+        ftable = get_f107_table()
+    f107 = ftable[colname].resample('D').mean().interpolate()
+    return f107.rolling(IRI_TABLE_F107_WINDOW, center = True, min_periods = 1).mean()
+
+
+def create_iri_table(outfile = 'iri_table.nc', ftable = None, grid = IRI_TABLE_GRID, altitude = IRI_TABLE_ALTITUDE):
+    ''' Creates the IRI surrogate table of hmF2 and alpha (see get_iri_surrogate). One-off and long (two IRI runs per grid node, see get_iri_cached for parallel runs).
+    IRI takes the solar flux of the given date - therefore for each day of year and flux of the grid, the year with the closest
+    smoothed F10.7 is used (the F10.7 of the used dates is stored as f107_used, and get_iri_surrogate interpolates along it).
+    Note the high flux nodes might not be realised in the F10.7 record (e.g. the smoothed F10.7 since 2004 stays below ~170 sfu).
+
+    Args:
+        outfile (str): output NetCDF file
+        ftable (pd.DataFrame): F10.7 table as from get_f107_table (would download if None)
+        grid (dict): grid of lat, lon (-180 to 180), lt (0 to 24), doy (0 to 366) and f107 values. The lon, lt and doy grids are periodic,
+                     i.e. their last value is copied from the first one
+        altitude (float): top altitude [km] for alpha
+
+    Returns:
+        xr.Dataset
+    '''
+    f107s = get_f107_smoothed(ftable)
+    lats, lons, lts, doys, fluxes = [grid[dim] for dim in ['lat', 'lon', 'lt', 'doy', 'f107']]
+    shape = (len(lats), len(lons), len(lts), len(doys), len(fluxes))
+    hmf2 = np.full(shape, np.nan)
+    alpha = np.full(shape, np.nan)
+    f107_used = np.full((len(doys), len(fluxes)), np.nan)
+    years = np.unique(f107s.index.year)
+    for idoy, doy in enumerate(doys[:-1]):
+        for iflux, flux in enumerate(fluxes):
+            # day with the closest smoothed flux
+            days = pd.to_datetime([str(year)+'-01-01' for year in years]) + pd.Timedelta(days = doy)
+            days = days[(days >= f107s.index[0]) & (days <= f107s.index[-1])]
+            fdays = f107s.reindex(days.normalize(), method = 'nearest').values
+            iday = np.argmin(np.abs(fdays - flux))
+            day = days[iday]
+            f107_used[idoy, iflux] = fdays[iday]
+            if np.abs(f107_used[idoy, iflux] - flux) > IRI_TABLE_F107_TOLERANCE:
+                print('WARNING, F10.7 of {0:.0f} not realised for doy {1:.0f}, the closest is {2:.0f}'.format(flux, doy, f107_used[idoy, iflux]))
+            print('running IRI for doy {0:.0f}, F10.7 {1:.0f} (using {2} with smoothed F10.7 of {3:.0f})'.format(doy, flux, str(day.date()), f107_used[idoy, iflux]))
+            # all nodes of the day at once (memoised, see get_iri_cached)
+            glat, glon, glt = np.meshgrid(lats, lons[:-1], lts[:-1], indexing = 'ij')
+            acqtimes = day + pd.to_timedelta((glt - glon/15).ravel(), unit = 'h')
+            tecs, heis = get_iri_cached(acqtimes, glat.ravel(), glon.ravel(), [0, altitude, altitude])
+            tecs_gps, _ = get_iri_cached(acqtimes, glat.ravel(), glon.ravel(), [0, 20000, 20000])
+            hmf2[:, :-1, :-1, idoy, iflux] = heis.reshape(glat.shape)
+            alpha[:, :-1, :-1, idoy, iflux] = (tecs/tecs_gps).reshape(glat.shape)
+    # periodic grids
+    for arr in [hmf2, alpha]:
+        arr[:, -1] = arr[:, 0]
+        arr[:, :, -1] = arr[:, :, 0]
+        arr[:, :, :, -1] = arr[:, :, :, 0]
+    f107_used[-1] = f107_used[0]
+    dims = ['lat', 'lon', 'lt', 'doy', 'f107']
+    table = xr.Dataset({'hmF2': (dims, hmf2), 'alpha': (dims, alpha), 'f107_used': (['doy', 'f107'], f107_used),
+                        'f107_smoothed': (['fluxdate'], f107s.values)},
+                       coords = {'lat': lats, 'lon': lons, 'lt': lts, 'doy': doys, 'f107': fluxes, 'fluxdate': f107s.index.values})
+    table.attrs['altitude_km'] = altitude
+    table.to_netcdf(outfile)
+    return table
+
+
+def get_iri_surrogate(iritable, lats, lons, acqtimes, ftable = None):
+    ''' Gets hmF2 and alpha from the IRI surrogate table (see create_iri_table) for arrays of points and times (or their combination with scalars).
+    The table is interpolated in lat, lon, local time and day of year, and then along the F10.7 actually used for the nodes (f107_used),
+    i.e. F10.7 out of the range realised for the day of year is clipped to it.
+
+    Args:
+        iritable (str or xr.Dataset): the table (or its file)
+        lats, lons (float or np.array)
+        acqtimes (pd.Timestamp or list/array of them)
+        ftable (pd.DataFrame): F10.7 table as from get_f107_table, to get flux for times later than those stored in the table
+
+    Returns:
+        np.array, np.array: hmF2 [km] and alpha
+    '''
+    if type(iritable) == str:
+        iritable = load_iri_table(iritable)
+    acqtimes = pd.DatetimeIndex(pd.to_datetime(np.atleast_1d(acqtimes)))
+    if type(ftable) == type(None):
+        f107s = iritable['f107_smoothed'].to_series()
+    else:
+        f107s = get_f107_smoothed(ftable)
+    if acqtimes.max() > f107s.index[-1] + pd.Timedelta('30 days'):
+        print('WARNING, no F10.7 for '+str(acqtimes.max().date())+', using the last one ('+str(f107s.index[-1].date())+')')
+    f107 = np.interp(acqtimes.values.astype('datetime64[ns]').astype(np.int64),
+                     f107s.index.values.astype('datetime64[ns]').astype(np.int64), f107s.values)
+    lats, lons = np.broadcast_arrays(np.asarray(lats, dtype = np.float64), np.asarray(lons, dtype = np.float64))
+    lats, lons, f107 = np.broadcast_arrays(lats, lons, f107)
+    hours = np.asarray(acqtimes.hour + acqtimes.minute/60 + acqtimes.second/3600)
+    lts = np.mod(hours + lons/15, 24)
+    doys = np.asarray(acqtimes.dayofyear - 1 + hours/24)
+    doys = np.broadcast_to(doys, lats.shape).ravel()
+    pts = np.column_stack([np.clip(lats, iritable['lat'].values.min(), iritable['lat'].values.max()).ravel(),
+                           (np.mod(lons + 180, 360) - 180).ravel(),
+                           np.broadcast_to(lts, lats.shape).ravel(),
+                           doys])
+    # F10.7 of the flux nodes at the points day of year, sorted (high nodes may share the same used flux)
+    fluxes = iritable['f107_used'].values if 'f107_used' in iritable else np.tile(iritable['f107'].values, (len(iritable['doy']), 1))
+    fluxes = np.column_stack([np.interp(doys, iritable['doy'].values, fluxes[:, j]) for j in range(fluxes.shape[1])])
+    order = np.argsort(fluxes, axis = 1)
+    fluxes = np.take_along_axis(fluxes, order, axis = 1)
+    f107 = np.clip(f107.ravel(), fluxes[:, 0], fluxes[:, -1])
+    k = np.clip((fluxes <= f107[:, None]).sum(axis = 1) - 1, 0, fluxes.shape[1] - 2)
+    f0 = np.take_along_axis(fluxes, k[:, None], axis = 1)[:, 0]
+    f1 = np.take_along_axis(fluxes, k[:, None] + 1, axis = 1)[:, 0]
+    w = np.divide(f107 - f0, f1 - f0, out = np.zeros_like(f107), where = f1 > f0)
+    out = []
+    for var in ['hmF2', 'alpha']:
+        # all flux nodes at once (the last dimension)
+        interp = RegularGridInterpolator([iritable[dim].values for dim in ['lat', 'lon', 'lt', 'doy']], iritable[var].values)
+        vals = np.take_along_axis(interp(pts), order, axis = 1)
+        val0 = np.take_along_axis(vals, k[:, None], axis = 1)[:, 0]
+        val1 = np.take_along_axis(vals, k[:, None] + 1, axis = 1)[:, 0]
+        out.append(((1 - w)*val0 + w*val1).reshape(lats.shape))
+    return out[0], out[1]
+
+
+@lru_cache(maxsize = 2)
+def load_iri_table(filename):
+    ''' Loads the IRI surrogate table (to memory)'''
+    with xr.open_dataset(filename) as table:
+        return table.load()
+
+
+def iri_surrogate_report(iritable, npoints = 200, ftable = None, seed = 0):
+    ''' Compares the IRI surrogate table with direct IRI runs in random points and times (within the table time span).
+
+    Returns:
+        pd.DataFrame: per point values of hmF2 [km] and alpha from IRI and from the table, and their differences
+    '''
+    if type(iritable) == str:
+        iritable = load_iri_table(iritable)
+    rng = np.random.default_rng(seed)
+    fluxdates = iritable['fluxdate'].values
+    report = pd.DataFrame({'lat': rng.uniform(iritable['lat'].values.min(), iritable['lat'].values.max(), npoints),
+                           'lon': rng.uniform(-180, 180, npoints),
+                           'time': pd.to_datetime(rng.uniform(fluxdates[0].astype('datetime64[s]').astype(np.int64),
+                                                              fluxdates[-1].astype('datetime64[s]').astype(np.int64), npoints).astype(np.int64), unit = 's')})
+    altitude = iritable.attrs.get('altitude_km', IRI_TABLE_ALTITUDE)
+    # all points at once (memoised, see get_iri_cached)
+    tecs, report['hmF2_iri'] = get_iri_cached(report['time'], report['lat'].values, report['lon'].values, [0, altitude, altitude])
+    tecs_gps, _ = get_iri_cached(report['time'], report['lat'].values, report['lon'].values, [0, 20000, 20000])
+    report['alpha_iri'] = tecs/tecs_gps
+    report['hmF2_table'], report['alpha_table'] = get_iri_surrogate(iritable, report['lat'].values, report['lon'].values, report['time'], ftable = ftable)
+    report['hmF2_diff'] = report['hmF2_table'] - report['hmF2_iri']
+    report['alpha_diff'] = report['alpha_table'] - report['alpha_iri']
+    for var, unit in [('hmF2', ' km'), ('alpha', '')]:
+        diff = report[var+'_diff']
+        print('{0}: RMSE {1:.3f}{3}, max abs error {2:.3f}{3}'.format(var, np.sqrt(np.mean(diff**2)), np.abs(diff).max(), unit))
+    return report
+
+
+GIM_JPL_URL = 'https://sideshow.jpl.nasa.gov/pub/iono_daily/gim_for_research/jpld/'
+GIM_CODE_URL = 'http://ftp.aiub.unibe.ch/CODE/'
+
+
+def get_gim_candidates(acqtime, noJPL = False, jplurl = None, codeurl = None):
+    ''' Gets GIM files (compressed, as stored on the servers) that may contain the given day, in order of preference.
+
+    Args:
+        acqtime (dt.datetime)
+        noJPL (bool): skip JPL-HR GIM
+        jplurl, codeurl (str): base URLs of JPL-HR and CODE GIM archives (default to GIM_JPL_URL, GIM_CODE_URL)
+
+    Returns:
+        list of (filename, url)
+    '''
+    jplurl = jplurl or GIM_JPL_URL
+    codeurl = codeurl or GIM_CODE_URL
+    candidates = []
+    if not noJPL:
+        filename = 'jpld'+ acqtime.strftime('%j') + '0.' + acqtime.strftime('%y')+'i.nc.gz' # TODO: check YMD
+        candidates.append((filename, jplurl + str(acqtime.year) + '/' + filename))
+    ###if JPL HR-GIM is not available, then try to download CODE data. After, 2024-08-01 we need CODE data.
+    for instr in ['CODG', 'CGIM']:
+        filename = instr + acqtime.strftime('%j') + '0.' + acqtime.strftime('%y') + 'I.Z'
+        candidates.append((filename, codeurl + acqtime.strftime('%Y') + '/' + filename))
     # since 12/2022 they changed naming convention to e.g. COD0OPSFIN_20230510000_01D_01H_GIM.INX.gz
     # see https://cddis.nasa.gov/Data_and_Derived_Products/GNSS/atmospheric_products.html#iono
-    if not ffound:
-        filename = 'COD0OPSFIN_'+ acqtime.strftime('%Y') + acqtime.strftime('%j')+'0000_01D_01H_GIM.INX.gz' # TODO: check YMD
-        #filename = instr + acqtime.strftime('%j') + '0.' + acqtime.strftime('%y') + 'I.Z'
-        url = 'http://ftp.aiub.unibe.ch/CODE/' + acqtime.strftime('%Y') + '/' + filename
+    filename = 'COD0OPSFIN_'+ acqtime.strftime('%Y') + acqtime.strftime('%j')+'0000_01D_01H_GIM.INX.gz'
+    candidates.append((filename, codeurl + acqtime.strftime('%Y') + '/' + filename))
+    return candidates
+
+
+def read_checksum_manifest(manifest):
+    ''' Reads sha256sum-like manifest ('<sha256>  <filename>' per line) to dict {filename: sha256}'''
+    checksums = {}
+    with open(manifest) as f:
+        for line in f:
+            line = line.split()
+            if len(line) == 2:
+                checksums[os.path.basename(line[1].lstrip('*'))] = line[0].lower()
+    return checksums
+
+
+def check_gim_file(filename, sha256 = None):
+    ''' Checks integrity of downloaded GIM file - sha256 if given, otherwise the gzip CRC (.gz) or LZW header (.Z)'''
+    try:
+        if sha256:
+            h = hashlib.sha256()
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024*1024), b''):
+                    h.update(chunk)
+            return h.hexdigest() == sha256.lower()
+        if filename.endswith('.gz'):
+            # reading through would raise error on wrong CRC or truncated file
+            with gzip.open(filename, 'rb') as f:
+                while f.read(1024*1024):
+                    pass
+        elif filename.endswith('.Z'):
+            with open(filename, 'rb') as f:
+                return f.read(2) == b'\x1f\x9d'
+        return True
+    except:
+        return False
+
+
+def download_file(url, outfile, retries = 3, timeout = 60, sha256 = None):
+    ''' Downloads url to outfile (through temporary file), with retries and integrity check.
+
+    Returns:
+        bool: True if downloaded (False also if the file does not exist on the server)
+    '''
+    tmpfile = os.path.join(os.path.dirname(outfile), '.' + os.path.basename(outfile))  # hidden, keeping the extension
+    for attempt in range(retries):
+        try:
+            with urllib.request.urlopen(url, timeout = timeout) as r, open(tmpfile, 'wb') as f:
+                shutil.copyfileobj(r, f)
+        except urllib.error.HTTPError as e:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            if e.code in [403, 404]:
+                # not existing - no need to retry
+                return False
+            continue
+        except:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            continue
+        if check_gim_file(tmpfile, sha256):
+            os.replace(tmpfile, outfile)
+            return True
+        print('WARNING, corrupted download of '+url+' (attempt '+str(attempt+1)+')')
+        os.remove(tmpfile)
+    return False
+
+
+def download_gim_day(acqtime, storedir = '/gws/ssde/j25a/nceo_geohazards/vol1/code_iono', noJPL = False, retries = 3,
+                     checksums = None, jplurl = None, codeurl = None):
+    ''' Downloads GIM for the given day (unless already in storedir), trying JPL-HR GIM first and then CODE naming conventions.
+
+    Args:
+        checksums (dict or None): {filename: sha256} to verify the downloads (see read_checksum_manifest)
+
+    Returns:
+        str or False: path to the (compressed) GIM file, or to its decompressed version if exists
+    '''
+    checksums = checksums or {}
+    for filename, url in get_gim_candidates(acqtime, noJPL, jplurl, codeurl):
         fullpath = os.path.join(storedir, filename)
-        ionix = fullpath[:-3]
-        if not os.path.exists(ionix):
-            if not os.path.exists(fullpath):
-                # download this
-                try:
-                    wgotfile = wget.download(url, out=storedir)
-                except:
-                    print('error during wget download')
-                    ffound = False
-            if os.path.exists(fullpath):
-                ffound = True
+        ionix = os.path.splitext(fullpath)[0]
+        if os.path.exists(ionix):
+            return ionix
+        if os.path.exists(fullpath):
+            return fullpath
+        if download_file(url, fullpath, retries = retries, sha256 = checksums.get(filename)):
+            return fullpath
+    return False
+
+
+def get_gim_days(esds, margin = 1):
+    ''' Gets days of GIM needed for the esds epochs (+- margin days, for the epochs near midnight)'''
+    days = pd.to_datetime(esds['epochdate']).dt.normalize().drop_duplicates()
+    days = pd.concat([days + pd.Timedelta(days = d) for d in range(-margin, margin + 1)])
+    return pd.DatetimeIndex(days.drop_duplicates().sort_values())
+
+
+def prefetch_gim(days, storedir = '/gws/ssde/j25a/nceo_geohazards/vol1/code_iono', nthreads = 8, noJPL = False, retries = 3,
+                 checksums = None, jplurl = None, codeurl = None):
+    ''' Downloads GIMs for all given days concurrently (days already in storedir are skipped).
+
+    Args:
+        days (list of dt.datetime): e.g. output of get_gim_days
+        nthreads (int): number of concurrent downloads
+
+    Returns:
+        pd.DataFrame: day, file (False if not available)
+    '''
+    if not os.path.exists(storedir):
+        os.makedirs(storedir)
+    def _fetch(day):
+        return download_gim_day(day, storedir, noJPL, retries, checksums, jplurl, codeurl)
+    with ThreadPoolExecutor(max_workers = nthreads) as executor:
+        files = list(executor.map(_fetch, days))
+    out = pd.DataFrame({'day': days, 'file': files})
+    get_gim_index(storedir, refresh = True)
+    return out
+
+
+def unlzw(data):
+    ''' Decompresses data of unix compress (.Z, LZW) - uses unlzw3 if installed, otherwise a python port of unlzw() by Mark Adler (pigz)
+
+    Args:
+        data (bytes): content of the .Z file
+
+    Returns:
+        bytes
+    '''
+    if unlzw3:
+        return unlzw3.unlzw(data)
+    if len(data) < 3 or data[0] != 0x1f or data[1] != 0x9d:
+        raise ValueError('not a .Z (LZW) compressed data')
+    flags = data[2]
+    if flags & 0x60:
+        raise ValueError('unknown .Z flags')
+    maxbits = flags & 0x1f
+    if maxbits < 9 or maxbits > 16:
+        raise ValueError('invalid .Z maximum code size')
+    if maxbits == 9:
+        maxbits = 10  # 9 does not really mean 9
+    blockmode = flags & 0x80
+    n = len(data)
+    if n == 3:
+        return b''
+    if n == 4 or data[4] & 1:
+        raise ValueError('invalid .Z data')
+    # first 9-bit code is the first byte, table entry is created with the next code
+    bits = 9
+    mask = 0x1ff
+    end = 256 if blockmode else 255
+    final = prev = data[3]
+    rem = data[4] >> 1
+    left = 7
+    chunk = bits - 2  # codes are written in groups of 'bits' bytes
+    pos = 5
+    prefix = [0]*65536
+    suffix = bytearray(65536)
+    out = bytearray([final])
+    stack = bytearray()
+    while True:
+        if end >= mask and bits < maxbits:
+            # code size increases - skip rest of the group
+            pos = min(pos + chunk, n)
+            left = rem = chunk = 0
+            bits += 1
+            mask = (mask << 1) | 1
+        if pos >= n:
+            break
+        if chunk == 0:
+            chunk = bits
+        last = data[pos]
+        pos += 1
+        code = rem + (last << left)
+        left += 8
+        chunk -= 1
+        if bits > left:
+            if pos >= n:
+                raise ValueError('premature end of .Z data')
+            last = data[pos]
+            pos += 1
+            code += last << left
+            left += 8
+            chunk -= 1
+        code &= mask
+        left -= bits
+        rem = last >> (8 - left)
+        if code == 256 and blockmode:
+            # clear code - skip rest of the group and restart
+            pos = min(pos + chunk, n)
+            left = rem = chunk = 0
+            bits = 9
+            mask = 0x1ff
+            end = 255
+            continue
+        temp = code
+        if code > end:
+            # special case of the code just being defined
+            if code != end + 1 or prev > end:
+                raise ValueError('invalid .Z code')
+            stack.append(final)
+            code = prev
+        while code >= 256:
+            stack.append(suffix[code])
+            code = prefix[code]
+        stack.append(code)
+        final = code
+        if end < mask:
+            end += 1
+            prefix[end] = prev
+            suffix[end] = final
+        prev = temp
+        stack.reverse()
+        out += stack
+        stack.clear()
+    return bytes(out)
+
+
+def read_gim_bytes(filename):
+    ''' Reads content of GIM file, decompressing .Z (LZW) or .gz in memory'''
+    if filename.endswith('.gz'):
+        with gzip.open(filename, 'rb') as f:
+            return f.read()
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if filename.endswith('.Z'):
+        data = unlzw(data)
+    return data
+
+
+def open_gim_netcdf(filename):
+    ''' Opens (possibly gzipped) JPL-HR GIM NetCDF as xr.Dataset, without a decompressed copy on disk'''
+    if not filename.endswith('.gz') and not filename.endswith('.Z'):
+        return xr.open_dataset(filename)
+    data = read_gim_bytes(filename)
+    try:
+        return xr.open_dataset(io.BytesIO(data))
+    except:
+        # e.g. h5netcdf not installed - netCDF4 can read from memory
+        import netCDF4
+        nc = netCDF4.Dataset(os.path.basename(filename), memory = data)
+        return xr.open_dataset(xr.backends.NetCDF4DataStore(nc))
+
+
+def download_code_data(acqtime, storedir = '/gws/ssde/j25a/nceo_geohazards/vol1/code_iono', decompress = False):
+    """Downloads Ionospheric TEC data from JPL or CODE.
+
+    Args:
+        decompress (bool): store also the decompressed file (and remove the compressed one). Not needed for GIM loading in daz
+
+    Returns:
+        str or False: path to the GIM file
+    """
+    fullpath = download_gim_day(acqtime, storedir)
+    if not fullpath:
+        print('no GIM layer found for '+str(acqtime.date()))
+        return False
+    if decompress and (fullpath.endswith('.gz') or fullpath.endswith('.Z')):
+        ionix = os.path.splitext(fullpath)[0]
+        try:
+            data = read_gim_bytes(fullpath)
+        except:
+            print('ERROR decompressing '+fullpath)
+            return False
+        with open(ionix, 'wb') as f:
+            f.write(data)
+        os.remove(fullpath)
+        fullpath = ionix
+    return fullpath
+
+
+################### GIM DATACUBE CACHE
+# the same GIM day is used by all frames acquired that day (and per swath, again for each swath) - we therefore keep
+# ready-to-interpolate TEC cubes in memory (LRU), store the parsed day also in binary form (.npz next to the GIM file)
+# and use a directory index instead of globbing the storage directory for every epoch
+GIM_CACHE_SIZE = 4  # number of stitched day cubes kept in memory (JPL-HR day cube is ~50 MB)
+_gim_index = {}
+
+
+def _gim_file_key(filename):
+    ''' Identifies GIM file by its name (compressed, decompressed or parsed to .npz).
+
+    Returns:
+        tuple: (source, 'YYYYJJJ') where source is 'jpl' or 'code', or None if not a GIM file
+    '''
+    fname = filename[:-4] if filename.endswith('.npz') else filename
+    for ext in ['.gz', '.Z']:
+        if fname.endswith(ext):
+            fname = fname[:-len(ext)]
+    if fname.startswith('jpld') and fname.endswith('.nc') and len(fname) == 15:
+        # jpldJJJ0.YYi.nc
+        yy, jjj = fname[9:11], fname[4:7]
+    elif fname.startswith('COD0OPSFIN_') and fname.endswith('.INX'):
+        # COD0OPSFIN_YYYYJJJ0000_01D_01H_GIM.INX
+        return 'code', fname[11:18]
+    elif len(fname) == 12 and fname[7] == '0' and fname[8] == '.' and fname[11] in ['I', 'N']:
+        # CODGJJJ0.YYI
+        yy, jjj = fname[9:11], fname[4:7]
+    else:
+        return None
+    if not (yy + jjj).isdigit():
+        return None
+    # GIMs start with 1995
+    century = '19' if int(yy) > 90 else '20'
+    return ('jpl' if fname.startswith('jpld') else 'code'), century + yy + jjj
+
+
+def get_gim_index(storedir, refresh = False):
+    ''' Gets (cached) index of GIM files in storedir.
+
+    Args:
+        storedir (str)
+        refresh (bool): rescan the directory (e.g. after download)
+
+    Returns:
+        dict: {(source, 'YYYYJJJ'): path}, where source is 'jpl' or 'code'. Parsed (.npz) version is preferred if up to date,
+              then decompressed and then compressed file
+    '''
+    if refresh or storedir not in _gim_index:
+        index = {}
+        ranks = {}
+        if os.path.isdir(storedir):
+            for entry in os.scandir(storedir):
+                key = _gim_file_key(entry.name)
+                if not key:
+                    continue
+                mtime = entry.stat().st_mtime
+                if entry.name.endswith('.npz'):
+                    rank = 2
+                elif entry.name.endswith('.gz') or entry.name.endswith('.Z'):
+                    rank = 0
+                else:
+                    rank = 1
+                if key in index:
+                    prank, pmtime = ranks[key]
+                    if 2 in [rank, prank]:
+                        # prefer the npz unless its source is newer
+                        npzmtime, srcmtime = (mtime, pmtime) if rank == 2 else (pmtime, mtime)
+                        if (npzmtime >= srcmtime) == (prank == 2):
+                            continue
+                    elif rank <= prank:
+                        # from several files (e.g. CODG/CGIM) keep the first
+                        continue
+                index[key] = entry.path
+                ranks[key] = (rank, mtime)
+        _gim_index[storedir] = index
+    return _gim_index[storedir]
+
+
+def get_gim_file(acqtime, storedir = '/gws/ssde/j25a/nceo_geohazards/vol1/code_iono', noJPL = False, noCODE = False):
+    ''' Finds (or downloads) GIM file for the day of acqtime, preferring JPL-HR GIM over CODE GIM (unless noJPL or noCODE).
+
+    Returns:
+        str or False: path to the GIM file (may be its parsed .npz form)
+    '''
+    day = acqtime.strftime('%Y%j')
+    downloaded = False
+    if not noJPL:
+        if ('jpl', day) not in get_gim_index(storedir):
+            # JPL-HR GIM does not exist, try to download it (would fallback to CODE)
+            download_code_data(acqtime, storedir)
+            get_gim_index(storedir, refresh = True)
+            downloaded = True
+        if ('jpl', day) in get_gim_index(storedir):
+            return get_gim_index(storedir)[('jpl', day)]
+    if noCODE:
+        return False
+    if ('code', day) not in get_gim_index(storedir) and not downloaded:
+        download_code_data(acqtime, storedir)
+        get_gim_index(storedir, refresh = True)
+    return get_gim_index(storedir).get(('code', day), False)
+
+
+@lru_cache(maxsize = 3)
+def load_gim_day(gimfile):
+    ''' Loads TEC maps of one GIM file, using (and creating) its parsed .npz form.
+
+    Args:
+        gimfile (str): JPL-HR GIM NetCDF, CODE IONEX or their .npz
+
+    Returns:
+        tuple: times (np.datetime64 array), lat, lon, tec [TECU] with shape (time, lat, lon), or False if failed
+    '''
+    if gimfile.endswith('.npz'):
+        with np.load(gimfile) as npz:
+            return npz['time'], npz['lat'], npz['lon'], npz['tec']
+    if os.path.basename(gimfile).startswith('jpl'):
+        # Open the NetCDF file (decompressed in memory if needed)
+        with open_gim_netcdf(gimfile) as ds:
+            # Convert time epochs to readable datetime format, 15min resolution referenced to j2000 (1/1/2000 12:00 UT).
+            times = pd.to_datetime(ds['time'].values, origin='2000-01-01 12:00:00', unit='s').values
+            lat = ds['lat'].values
+            lon = ds['lon'].values
+            tec = ds['tecmap'].values
+    else:
+        # loading the TEC maps, thanks to https://notebook.community/daniestevez/jupyter_notebooks/IONEX (but improved towards xarray by ML B-)
+        try:
+            times, lat, lon, tec = read_ionex(gimfile)
+        except:
+            print('ERROR loading ionix file: '+gimfile)
+            return False
+        tecxr = xr.DataArray(data=tec, dims=['time','lat','lon'],
+                            coords=dict(time=times, lon=lon, lat=lat) )
+        # interpolate through the nan (no data) values
+        if np.isnan(tec).any():
+            tecxr=tecxr.interpolate_na(dim="lon", method="linear", fill_value="extrapolate")
+        tec = tecxr.values
+    try:
+        np.savez(gimfile+'.npz', time=times, lat=lat, lon=lon, tec=tec)
+    except:
+        print('WARNING, cannot store parsed GIM to '+gimfile+'.npz')
+    return times, lat, lon, tec
+
+
+@lru_cache(maxsize = GIM_CACHE_SIZE)
+def _get_gim_tecxr_day(date, storedir, noJPL, printout, noCODE = False, stitch_before = False, stitch_after = False):
+    ''' Loads the day datacube (cached), stitched with the bracketing maps of the previous/next day if requested.
+    Raises FileNotFoundError if no data, so that failures are not cached (e.g. a transient download error).
+    '''
+    if os.path.isfile(storedir):
+        # GIM archive (bracketing maps of adjacent days are added when reading)
+        flags = [flag for flag, source in GIM_SOURCES.items() if (source == 'jpl' and not noJPL) or (source == 'code' and not noCODE)]
+        gim = read_gim_archive(storedir, date, flags)
+        if not gim:
+            raise FileNotFoundError('no GIM data available for '+str(date.date()))
+        times, lat, lon, tec, source = gim
+        if printout:
+            print('using GIM archive ('+'/'.join([GIM_SOURCES[s] for s in np.unique(source)])+' data)')
+        tecxr = xr.DataArray(data=tec, dims=['time','lat','lon'],
+                             coords=dict(time=times, lat=lat, lon=lon))
+        return tecxr*1e+16 # from TECU
+    times, lat, lon, tec = _load_gim_day(date, storedir, noJPL, noCODE, printout)
+    # stitch the bracketing maps of adjacent days
+    for neighbour, stitch in [(date - pd.Timedelta('1 day'), stitch_before),
+                              (date + pd.Timedelta('1 day'), stitch_after)]:
+        if not stitch:
+            continue
+        gimfile2 = get_gim_file(neighbour, storedir, noJPL, noCODE)
+        gim2 = load_gim_day(gimfile2) if gimfile2 else False
+        if not gim2 or not (np.array_equal(gim2[1], lat) and np.array_equal(gim2[2], lon)):
+            print('WARNING, could not stitch GIM of '+str(neighbour.date())+' to '+str(date.date()))
+            continue
+        if neighbour < date:
+            sel = np.where(gim2[0] < times[0])[0][-1:]
+            times, tec = np.concatenate([gim2[0][sel], times]), np.concatenate([gim2[3][sel], tec])
         else:
-            ffound = True
-    if not ffound:
-        print('no CODE layer found for '+filename)
+            sel = np.where(gim2[0] > times[-1])[0][:1]
+            times, tec = np.concatenate([times, gim2[0][sel]]), np.concatenate([tec, gim2[3][sel]])
+    tecxr = xr.DataArray(data=tec, dims=['time','lat','lon'],
+                         coords=dict(time=times, lat=lat, lon=lon))
+    return tecxr*1e+16 # from TECU
+
+
+def _load_gim_day(date, storedir, noJPL, noCODE, printout = False):
+    ''' Loads TEC maps of the day from the GIM directory (see load_gim_day), raises FileNotFoundError if no data '''
+    gimfile = get_gim_file(date, storedir, noJPL, noCODE)
+    if not gimfile:
+        raise FileNotFoundError('no GIM data available for '+str(date.date()))
+    if printout:
+        if os.path.basename(gimfile).startswith('jpl'):
+            print('using JPL-HR GIM data')
+        else:
+            print('using CODE GIM data')
+    gim = load_gim_day(gimfile)
+    if not gim:
+        raise FileNotFoundError('could not load GIM file '+gimfile)
+    return gim
+
+
+def get_gim_tecxr(acqtime, storedir = '/gws/ssde/j25a/nceo_geohazards/vol1/code_iono', noJPL = False, printout = True, noCODE = False,
+                  attimes = None):
+    ''' Gets (cached) TEC datacube [el/m2] for the day of acqtime. The bracketing maps of adjacent days are stitched to it only
+    if some of attimes (times to be interpolated, by default acqtime itself) fall outside of the day maps (e.g. JPL-HR GIM ends at 23:45).
+    The storedir can be also the GIM archive file (see update_gim_archive). Use noJPL or noCODE to get only CODE or JPL-HR GIM.
+    Note the returned xr.DataArray is shared between calls - do not modify it in place.
+
+    Returns:
+        xr.DataArray or False if no data
+    '''
+    date = pd.Timestamp(acqtime).normalize()
+    stitch_before, stitch_after = False, False
+    try:
+        if not os.path.isfile(storedir):
+            times = _load_gim_day(date, storedir, noJPL, noCODE)[0]
+            attimes = pd.to_datetime(np.atleast_1d(acqtime if attimes is None else attimes)).values
+            stitch_before = bool((attimes < times[0]).any())
+            stitch_after = bool((attimes > times[-1]).any())
+        return _get_gim_tecxr_day(date, storedir, noJPL, printout, noCODE, stitch_before, stitch_after)
+    except FileNotFoundError as e:
+        if printout:
+            print(e)
         return False
-    if not os.path.exists(ionix):
-        rc = os.system('cd ' + storedir + '; 7za x ' + filename + ' >/dev/null 2>/dev/null; rm ' + fullpath)
-    if not os.path.exists(ionix):
-        print('ERROR: maybe you do not have 7za installed')
+
+
+################### GIM ARCHIVE
+# all GIM days in one chunked NetCDF4 file (see update_gim_archive). If given as storedir to get_gim_tecxr,
+# only the chunks of the requested day are read from it
+GIM_ARCHIVE_STEP = pd.Timedelta('15 min')  # common time axis (JPL-HR GIM sampling)
+GIM_ARCHIVE_CHUNK = 8  # time steps per chunk (~1 MB of int16 maps)
+GIM_ARCHIVE_SCALE, GIM_ARCHIVE_OFFSET = 0.01, 300  # int16 TEC packing [TECU], i.e. range of -27 to 627 TECU
+GIM_ARCHIVE_LAT = np.arange(-90, 90.5, 1.0)
+GIM_ARCHIVE_LON = np.arange(-180, 180.5, 1.0)
+GIM_SOURCES = {0: 'none', 1: 'jpl', 2: 'code'}
+
+
+def update_gim_archive(archive, days, storedir = '/gws/ssde/j25a/nceo_geohazards/vol1/code_iono', noJPL = False):
+    ''' Converts GIM of given days (JPL-HR GIM, or CODE GIM if not available) to the GIM archive.
+
+    The archive is a single NetCDF4 file with TEC maps of all days on a common time axis (GIM_ARCHIVE_STEP) and 1 deg grid
+    (CODE maps are interpolated to it), stored as int16 scaled by 0.01 TECU in chunks of GIM_ARCHIVE_CHUNK time steps.
+    Variable 'source' flags each time step (see GIM_SOURCES, 0 means no data).
+
+    Args:
+        archive (str): path to the archive (.nc), created if not existing. Days already in the archive are overwritten
+        days (list of dt.datetime): e.g. output of get_gim_days (days before start of an existing archive are skipped)
+        storedir (str): directory with the GIM files (missing ones would get downloaded)
+        noJPL (bool): use only CODE GIM
+
+    Returns:
+        pd.DataFrame: with columns day and source
+    '''
+    import netCDF4
+    days = pd.DatetimeIndex(days).normalize().drop_duplicates().sort_values()
+    nday = int(pd.Timedelta('1 day') / GIM_ARCHIVE_STEP)
+    step = int(GIM_ARCHIVE_STEP / pd.Timedelta('1 min'))
+    if not os.path.exists(archive):
+        nc = netCDF4.Dataset(archive, 'w', format = 'NETCDF4')
+        nc.createDimension('time', None)
+        nc.createDimension('lat', len(GIM_ARCHIVE_LAT))
+        nc.createDimension('lon', len(GIM_ARCHIVE_LON))
+        var = nc.createVariable('time', 'i4', ('time',))
+        var.units = 'minutes since '+str(days[0].date())+' 00:00:00'
+        var.calendar = 'standard'
+        nc.createVariable('lat', 'f8', ('lat',))[:] = GIM_ARCHIVE_LAT
+        nc.createVariable('lon', 'f8', ('lon',))[:] = GIM_ARCHIVE_LON
+        var = nc.createVariable('tec', 'i2', ('time', 'lat', 'lon'), zlib = True, complevel = 4, shuffle = True,
+                                chunksizes = (GIM_ARCHIVE_CHUNK, len(GIM_ARCHIVE_LAT), len(GIM_ARCHIVE_LON)), fill_value = -32768)
+        var.scale_factor = GIM_ARCHIVE_SCALE
+        var.add_offset = GIM_ARCHIVE_OFFSET
+        var.units = 'TECU'
+        var = nc.createVariable('source', 'i1', ('time',), fill_value = False)
+        var.flag_values = np.array(list(GIM_SOURCES.keys()), dtype = np.int8)
+        var.flag_meanings = ' '.join(GIM_SOURCES.values())
+    else:
+        nc = netCDF4.Dataset(archive, 'a')
+    t0 = pd.Timestamp(nc['time'].units.split('since ')[1])
+    sources = []
+    try:
+        for day in days:
+            source = 0
+            if day < t0:
+                print('WARNING, '+str(day.date())+' is before start of the GIM archive, skipping')
+                sources.append(GIM_SOURCES[source])
+                continue
+            i0 = int((day - t0) / GIM_ARCHIVE_STEP)
+            # extend the time axis (and clear the day)
+            n = len(nc['time'])
+            if i0 + nday > n:
+                nc['time'][n:i0+nday] = np.arange(n, i0+nday, dtype = np.int32) * step
+            nc['source'][min(n, i0):i0+nday] = 0
+            gimfile = get_gim_file(day, storedir, noJPL)
+            gim = load_gim_day(gimfile) if gimfile else False
+            if gim:
+                times, lat, lon, tec = gim
+                itimes = np.asarray((pd.to_datetime(times) - t0) / GIM_ARCHIVE_STEP)
+                # maps of the day, plus the midnight one at the end if the next day is not in the archive (yet)
+                sel = (itimes >= i0) & (itimes < i0 + nday) & (itimes % 1 == 0)
+                if len(nc['time']) == i0 + nday or nc['source'][i0 + nday] == 0:
+                    sel = sel | (itimes == i0 + nday)
+                if (itimes % 1 != 0).any():
+                    print('WARNING, some GIM maps of '+str(day.date())+' are off the archive time step, skipping them')
+                tecxr = xr.DataArray(data = tec[sel], dims = ['time', 'lat', 'lon'], coords = dict(lat = lat, lon = lon))
+                if not (np.array_equal(lat, GIM_ARCHIVE_LAT) and np.array_equal(lon, GIM_ARCHIVE_LON)):
+                    # (keeping the edge values for the poles, e.g. CODE GIM ends at 87.5 deg)
+                    tecxr = tecxr.interp(lat = np.clip(GIM_ARCHIVE_LAT, lat.min(), lat.max()),
+                                         lon = np.clip(GIM_ARCHIVE_LON, lon.min(), lon.max()))
+                source = 1 if os.path.basename(gimfile).startswith('jpl') else 2
+                tecmin, tecmax = -32767*GIM_ARCHIVE_SCALE + GIM_ARCHIVE_OFFSET, 32767*GIM_ARCHIVE_SCALE + GIM_ARCHIVE_OFFSET
+                if (tecxr < tecmin).any() or (tecxr > tecmax).any():
+                    print('WARNING, GIM of '+str(day.date())+' is out of the archive TEC range, clipping')
+                    tecxr = tecxr.clip(tecmin, tecmax)
+                for i, tecmap in zip(np.array(itimes[sel], dtype = int), tecxr.values):
+                    if i == len(nc['time']):
+                        nc['time'][i] = i * step
+                    nc['tec'][i] = np.ma.masked_invalid(tecmap)
+                    nc['source'][i] = source
+            else:
+                print('no GIM data available for '+str(day.date()))
+            sources.append(GIM_SOURCES[source])
+    finally:
+        nc.close()
+        # the archive might be used (cached) already
+        open_gim_archive.cache_clear()
+        _get_gim_tecxr_day.cache_clear()
+    return pd.DataFrame({'day': days, 'source': sources})
+
+
+@lru_cache(maxsize = 2)
+def open_gim_archive(archive):
+    ''' Opens the GIM archive lazily - TEC maps are read (by chunks) only when selected.
+
+    Returns:
+        tuple: xr.Dataset, times, source flags (per time step)
+    '''
+    ds = xr.open_dataset(archive)
+    return ds, ds['time'].values, ds['source'].values
+
+
+def read_gim_archive(archive, date, flags = None):
+    ''' Reads TEC maps of the day from the GIM archive, adding the bracketing maps of adjacent days if the day is not fully covered.
+    Only time steps of given source flags (see GIM_SOURCES) are used if flags is given.
+
+    Returns:
+        tuple: times, lat, lon, tec [TECU], source flags - or False if no data for the day
+    '''
+    ds, times, source = open_gim_archive(archive)
+    day = np.datetime64(pd.Timestamp(date))
+    dayend = day + np.timedelta64(1, 'D')
+    valid = np.where((source > 0 if flags is None else np.isin(source, flags)) & (times >= day - np.timedelta64(1, 'D')) & (times <= dayend + np.timedelta64(1, 'D')))[0]
+    inday = np.where((times[valid] >= day) & (times[valid] <= dayend))[0]
+    if len(inday) == 0:
         return False
-    return ionix
+    i0, i1 = inday[0], inday[-1]
+    if times[valid[i0]] > day and i0 > 0:
+        i0 = i0 - 1
+    if times[valid[i1]] < dayend and i1 < len(valid) - 1:
+        i1 = i1 + 1
+    idx = valid[i0:i1+1]
+    tec = ds['tec'].isel(time = slice(idx[0], idx[-1] + 1)).values[idx - idx[0]]
+    return times[idx], ds['lat'].values, ds['lon'].values, tec, source[idx]
 
 
 def get_vtec_from_code(acqtime, lat = 0, lon = 0, storedir = '/gws/ssde/j25a/nceo_geohazards/vol1/code_iono', return_fullxr = False, noJPL=False, printout=True):
@@ -265,6 +1155,7 @@ def get_vtec_from_code(acqtime, lat = 0, lon = 0, storedir = '/gws/ssde/j25a/nce
     
     17/03/2025-(MN):function also helps to extract NASA JPL High Resolution vTEC values (15min, 1x1degree) at first. 
     https://sideshow.jpl.nasa.gov/pub/iono_daily/gim_for_research/jpli/
+    2026/10: the day datacubes are cached, see get_gim_tecxr
     
     Args:
         acqtime (dt.datetime)
@@ -273,88 +1164,9 @@ def get_vtec_from_code(acqtime, lat = 0, lon = 0, storedir = '/gws/ssde/j25a/nce
         storedir (str)
         return_fullxr (bool): if True, will return full TEC datacube
     """
-    #D = acqtime.strftime('%Y%m%d')
-    #ipp = np.array([lat,lon])
-    # check if exists:
-
-    if not noJPL:
-        fna = glob.glob(storedir + '/jpld' + acqtime.strftime('%j') + '0.' + acqtime.strftime('%y') + '*.nc')  # prioritize JPL-HR GIM
-        if fna:  
-            ionix = os.path.join(storedir, fna[0])  # Found JPL-HR GIM file, use it
-        else:
-            # JPL-HR GIM does not exist, try to download it.
-            ionix = download_code_data(acqtime, storedir)
-            fna = glob.glob(storedir + '/jpld' + acqtime.strftime('%j') + '0.' + acqtime.strftime('%y') + '*.nc')  # prioritize JPL-HR GIM again
-            if fna:  
-                ionix = os.path.join(storedir, fna[0])  # Found a different GIM file, use it
-            else:
-                ionix = None
-    else:
-        ionix = None
-
-    if not ionix:
-        # If JPL-HR GIM is missing or noJPL is True, fallback to CODE GIM
-        fna = glob.glob(storedir + '/????' + acqtime.strftime('%j') + '0.' + acqtime.strftime('%y') + '?')  # CODE GIM
-        if fna:
-            ionix = os.path.join(storedir, fna[0])
-        else:
-            # If no CODE GIM is found, try to download it
-            ionix = download_code_data(acqtime, storedir)
-        if not ionix:
-            if printout:
-                print('no GIM data available for '+str(acqtime))
-            return False
-        elif printout:
-            print('using CODE GIM data')
-    elif printout:
-        print('using JPL-HR GIM data')
-    #
-    #else:
-    #    rc=os.system('rm '+fullpath) # clean the .Z
-    # prep 
-    #hhmmss=acqtime.strftime('%H%M%S')
-    # loading the TEC maps, thanks to https://notebook.community/daniestevez/jupyter_notebooks/IONEX (but improved towards xarray by ML B-)
-    if os.path.basename(ionix).startswith('jpl'):
-        # Open the NetCDF file
-        ds = xr.open_dataset(ionix)
-        # Convert time epochs to readable datetime format, 15min resolution referenced to j2000 (1/1/2000 12:00 UT).
-        time_values = ds['time'].values
-        #converting yyyy-mm-ddThh:mm:ss format. #TODO: We can change that regarding ML's wishes. I found this is clear for now.
-        converted_times = pd.to_datetime(time_values, origin='2000-01-01 12:00:00', unit='s')
-        #dataset2dataarray
-        tecxr_jhr = xr.DataArray(data=ds['tecmap'].values, dims=['time','lat','lon'],
-                            coords=dict(time=converted_times, lat= ds["lat"].values, lon= ds["lon"].values) )
-        tecxr=tecxr_jhr*1e+16 # from TECU   
-    else:
-        try:
-            tecmaps = get_tecmaps(ionix)
-        except:
-            print('ERROR loading ionix file: '+ionix)
-            return False
-        try:
-            interval = int(grep1line('INTERVAL',ionix).split()[0])
-        except:
-            print('ERROR, the ionix file '+ionix+' does not contain necessary keywords. Cancelling')
-            return False
-        timestep = interval/3600
-        timecoords = np.arange(0.0,24.0+timestep,timestep)  # we expect start/end time being midnight, should be standard for all CODE files?
-        timecoords = acqtime.normalize() + pd.to_timedelta(timecoords, unit='h')  # set to real datetime..
-        lat_all = np.arange(87.5,-87.5-2.5,-2.5)
-        lon_all = np.arange(-180.0,180.0+5,5.0)
-        tecxr = xr.DataArray(data=tecmaps, dims=['time','lat','lon'],
-                            coords=dict(time=timecoords, lon=lon_all, lat=lat_all) )
-        # interpolate through the nan values
-        tonan=9999
-        tecxr.where(tecxr!=tonan)
-        tecxr=tecxr.interpolate_na(dim="lon", method="linear", fill_value="extrapolate")
-        tecxr = tecxr*1e+16 # from TECU
-    if acqtime<tecxr.time.min():
-        # need to join day before:
-        tecxr2=get_vtec_from_code(acqtime-pd.Timedelta('1 day'), lat=lat, lon=lon, return_fullxr = True)
-        tecxr = xr.concat([tecxr2, tecxr], dim='time')
-    if acqtime>tecxr.time.max():
-        tecxr2=get_vtec_from_code(acqtime+pd.Timedelta('1 day'), lat=lat, lon=lon, return_fullxr = True)
-        tecxr = xr.concat([tecxr, tecxr2], dim='time')
+    tecxr = get_gim_tecxr(acqtime, storedir, noJPL, printout)
+    if tecxr is False:
+        return False
     if return_fullxr:
         return tecxr
     else:
@@ -434,20 +1246,152 @@ def get_vtec_from_tecxr(tecxr, acqtime, lat, lon, rotate=True, method='cubic'):
     return tec
 
 
-def parse_map(tecmap, exponent = -1):
-    tecmap = re.split('.*END OF TEC MAP', tecmap)[0]
-    return np.stack([np.fromstring(l, sep=' ') for l in re.split('.*LAT/LON1/LON2/DLON/H\\n',tecmap)[1:]])*10**exponent
+def _grid_weights(grid, x):
+    ''' Indices and weights for linear interpolation of x in (monotonic) grid. Points outside the grid get NaN weights.'''
+    grid = np.asarray(grid, dtype=np.float64)
+    if grid[0] > grid[-1]:
+        # descending grid (e.g. CODE latitudes)
+        i, w = _grid_weights(grid[::-1], x)
+        return len(grid) - 2 - i, 1 - w
+    i = np.clip(np.searchsorted(grid, x, side='right') - 1, 0, len(grid) - 2)
+    w = (x - grid[i]) / (grid[i + 1] - grid[i])
+    w = np.where((x < grid[0]) | (x > grid[-1]), np.nan, w)
+    return i, w
+
+
+def _interp_maps(tec, lat, lon, itime, lats, lons):
+    ''' Bilinear interpolation of tec[itime] maps at given points'''
+    i, wi = _grid_weights(lat, lats)
+    j, wj = _grid_weights(lon, lons)
+    return ((1 - wi) * (1 - wj) * tec[itime, i, j] + (1 - wi) * wj * tec[itime, i, j + 1]
+            + wi * (1 - wj) * tec[itime, i + 1, j] + wi * wj * tec[itime, i + 1, j + 1])
+
+
+def get_vtec_from_tecxr_batch(tecxr, acqtimes, lats, lons, rotate=True, method='linear'):
+    ''' Batch version of get_vtec_from_tecxr - gets VTEC for arrays of times, lats and lons (or their combination with scalars).
+
+    The bracketing maps of all points are found at once, the rotated (sun-fixed) longitudes are computed
+    for both of them and all points are evaluated with one bilinear kernel (weighted linearly in time).
+    For other methods (e.g. 'cubic'), all points are interpolated by one pointwise xarray call.
+
+    Returns:
+        np.array of VTEC values (NaN for points outside the datacube)
+    '''
+    htimes = tecxr.time.values.astype('datetime64[ns]')
+    acqtimes = np.asarray(pd.to_datetime(np.atleast_1d(acqtimes)).values, dtype='datetime64[ns]')
+    acqtimes, lats, lons = np.broadcast_arrays(acqtimes, np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64))
+    # seconds since the first map
+    hsec = (htimes - htimes[0]) / np.timedelta64(1, 's')
+    tsec = (acqtimes - htimes[0]) / np.timedelta64(1, 's')
+    if rotate:
+        # bracketing maps
+        ipre = np.searchsorted(hsec, tsec, side='right') - 1
+        ipost = np.searchsorted(hsec, tsec, side='left')
+        outside = (ipre < 0) | (ipost >= len(hsec))
+        ipre = np.clip(ipre, 0, len(hsec) - 1)
+        ipost = np.clip(ipost, 0, len(hsec) - 1)
+        lon0 = lons + (tsec - hsec[ipre]) / 86400 * 360.
+        lon1 = lons + (tsec - hsec[ipost]) / 86400 * 360.
+        if method == 'linear':
+            tec = tecxr.values
+            lat = tecxr.lat.values
+            lon = tecxr.lon.values
+            tec_val0 = _interp_maps(tec, lat, lon, ipre, lats, lon0)
+            tec_val1 = _interp_maps(tec, lat, lon, ipost, lats, lon1)
+        else:
+            # both bracketing maps of all points in one (pointwise) xarray call
+            points = xr.DataArray(tecxr.time.values[np.concatenate([ipre, ipost])], dims='points')
+            tec_vals = tecxr.interp(time=points, lat=xr.DataArray(np.concatenate([lats, lats]), dims='points'),
+                                    lon=xr.DataArray(np.concatenate([lon0, lon1]), dims='points'), method=method).values
+            tec_val0, tec_val1 = tec_vals[:len(tsec)], tec_vals[len(tsec):]
+        # linear in time (exactly at a map time, the map value is used)
+        dtime = hsec[ipost] - hsec[ipre]
+        wpost = np.divide(tsec - hsec[ipre], dtime, out=np.zeros(len(tsec)), where=dtime > 0)
+        tec = (1 - wpost) * tec_val0 + wpost * tec_val1
+        tec[outside] = np.nan
+    else:
+        tec = tecxr.interp(time=xr.DataArray(acqtimes.astype(tecxr.time.dtype), dims='points'), lat=xr.DataArray(lats, dims='points'),
+                           lon=xr.DataArray(lons, dims='points'), method=method).values
+    return tec
+
+
+def _ionex_ints(lines, width = 5):
+    '''Converts right-aligned fixed-width integer records (e.g. IONEX I5) to np.array at once'''
+    chars = np.frombuffer(''.join(lines).encode(), dtype=np.uint8)
+    if len(chars) % width:
+        return np.array([])
+    chars = chars.reshape(-1, width)
+    digits = chars - np.uint8(48)
+    digits[digits > 9] = 0  # spaces and signs
+    values = np.zeros(len(chars), dtype=np.int32)
+    for k in range(width):
+        values = values * 10 + digits[:, k]
+    values[(chars == 45).any(axis=1)] *= -1
+    return values
+
+
+def read_ionex(filename):
+    ''' Reads TEC maps from IONEX file (e.g. CODE GIM) in one pass.
+
+    The header is read once (exponent, grid definition), data blocks of all TEC maps (RMS/height maps are skipped)
+    are converted at once from their fixed-width records. No-data values (9999) are set to NaN.
+
+    Args:
+        filename (str): path to IONEX file (can be .Z or .gz compressed - decompressed in memory)
+
+    Returns:
+        tuple: times (np.datetime64 array), lat, lon, tec [TECU] as np.array with shape (time, lat, lon)
+    '''
+    ionex = read_gim_bytes(filename).decode('latin-1')
+    header, _, body = ionex.partition('END OF HEADER')
+    # header (defaults to the standard CODE grid)
+    exponent = -1
+    lat1, lat2, dlat = 87.5, -87.5, -2.5
+    lon1, lon2, dlon = -180.0, 180.0, 5.0
+    for line in header.splitlines():
+        label = line[60:].strip()
+        if label == 'EXPONENT':
+            exponent = int(line[:6])
+        elif label == 'LAT1 / LAT2 / DLAT':
+            lat1, lat2, dlat = [float(x) for x in line[:60].split()]
+        elif label == 'LON1 / LON2 / DLON':
+            lon1, lon2, dlon = [float(x) for x in line[:60].split()]
+    lat = np.linspace(lat1, lat2, int(round((lat2 - lat1) / dlat)) + 1)
+    lon = np.linspace(lon1, lon2, int(round((lon2 - lon1) / dlon)) + 1)
+    nrecords = -(-len(lon) // 16)  # data records per latitude row (max 16 values per record)
+    # data lines of TEC maps (RMS maps follow after the last END OF TEC MAP)
+    datalines = []
+    times = []
+    exponents = []
+    for block in body.split('START OF TEC MAP')[1:]:
+        # skip the rest of the START line and the beginning of the END line
+        lines = block.split('END OF TEC MAP')[0].splitlines()[1:-1]
+        times.append(dt.datetime(*[int(x) for x in lines[0][:36].split()]))
+        exponents.append(exponent)
+        rows = lines[1:]
+        if len(rows) == len(lat) * (nrecords + 1):
+            # standard block - just drop the LAT/LON1/LON2/DLON/H record of each row
+            del rows[::nrecords + 1]
+        else:
+            # e.g. map-specific exponent
+            for line in rows:
+                if line[60:].strip() == 'EXPONENT':
+                    exponents[-1] = int(line[:6])
+            rows = [line for line in rows if line[60:].strip() != 'EXPONENT' and not line[60:].startswith('LAT/LON1/LON2/DLON/H')]
+        datalines += rows
+    tec = _ionex_ints(datalines)
+    if tec.size != len(times)*len(lat)*len(lon):
+        # non-standard record widths - fallback to whitespace-separated values
+        tec = np.array(' '.join(datalines).split(), dtype=np.int64)
+    tec = tec.reshape(len(times), len(lat), len(lon)).astype(np.float64)
+    tec[tec == 9999] = np.nan
+    tec = tec * (10.0 ** np.array(exponents))[:, np.newaxis, np.newaxis]
+    return pd.to_datetime(times).values.astype('datetime64[ns]'), lat, lon, tec
 
 
 def get_tecmaps(filename):
-    try:
-        exponent = int(grep1line('EXPONENT',filename).split()[0]) # this is exponent of the data
-    except:
-        print('WARNING, exponent not found in '+filename+'. Perhaps the file is corrupted?')
-        exponent = -1
-    with open(filename) as f:
-        ionex = f.read()
-        return [parse_map(t, exponent) for t in ionex.split('START OF TEC MAP')[1:]]
+    ''' Returns list of TEC maps [TECU] from the IONEX file (see read_ionex)'''
+    return list(read_ionex(filename)[3])
 
 
 def get_tec(tecmap, lat, lon):
@@ -774,27 +1718,146 @@ def aer2ecef(azimuthDeg, elevationDeg, slantRange, obs_lat, obs_long, obs_alt):
     return x, y, z
 
 
+@lru_cache
+def get_ecef_transformer(to_ecef = True):
+    ''' Returns (cached) pyproj transformer between WGS-84 lat/lon/hei and ECEF (or back if to_ecef = False)'''
+    latlong = {"proj":'latlong', "ellps":'WGS84', "datum":'WGS84'}
+    geocent = {"proj":'geocent', "ellps":'WGS84', "datum":'WGS84'}
+    if to_ecef:
+        return pyproj.Transformer.from_crs(latlong, geocent)
+    return pyproj.Transformer.from_crs(geocent, latlong)
+
+
+WGS84_GEOD = pyproj.Geod(ellps='WGS84')
+
+
 def latlonhei2ecef(lat, lon, alt):
     '''
     altitude should be in metres!!!!!
     '''
-    transformer = pyproj.Transformer.from_crs(
-        {"proj":'latlong', "ellps":'WGS84', "datum":'WGS84'},
-        {"proj":'geocent', "ellps":'WGS84', "datum":'WGS84'},
-        )
-    x, y, z = transformer.transform(lon, lat, alt, radians=False)
+    x, y, z = get_ecef_transformer(True).transform(lon, lat, alt, radians=False)
     return x, y, z
 
 
 def ecef2latlonhei(x, y, z):
-    transformer = pyproj.Transformer.from_crs(
-        {"proj":'geocent', "ellps":'WGS84', "datum":'WGS84'},
-        {"proj":'latlong', "ellps":'WGS84', "datum":'WGS84'},
-        )
-    lon, lat, alt = transformer.transform(x,y,z,radians=False)
+    lon, lat, alt = get_ecef_transformer(False).transform(x,y,z,radians=False)
     return lat, lon, alt
 
 
+@lru_cache
+def load_orbit_par(parfile):
+    ''' Loads orbit state vectors from GAMMA (SLC) par file and returns their interpolator (cached per file).
+
+    Returns:
+        scipy.interpolate.CubicHermiteSpline, pd.Timestamp: ECEF position [m] interpolator (of seconds since the first state vector),
+                                                             time of the first state vector
+    '''
+    params = {}
+    with open(parfile) as f:
+        for line in f:
+            if ':' in line:
+                key, val = line.split(':', 1)
+                params[key.strip()] = val.split()
+    date = params['date']
+    t0 = pd.Timestamp(int(date[0]), int(date[1]), int(date[2])) + pd.Timedelta(float(params['time_of_first_state_vector'][0]), 's')
+    nsv = int(params['number_of_state_vectors'][0])
+    tsv = np.arange(nsv) * float(params['state_vector_interval'][0])
+    pos = np.array([params['state_vector_position_'+str(i+1)][:3] for i in range(nsv)], dtype=float)
+    vel = np.array([params['state_vector_velocity_'+str(i+1)][:3] for i in range(nsv)], dtype=float)
+    return CubicHermiteSpline(tsv, pos, vel, axis = 0), t0
+
+
+def get_orbit_positions(parfile, times):
+    ''' Gets satellite ECEF positions [m] at given times, interpolated (cubic Hermite, using velocities) from the par file orbit state vectors.
+
+    Returns:
+        np.array of shape (len(times), 3), NaN for times outside the state vectors
+    '''
+    orbit, t0 = load_orbit_par(parfile)
+    tsec = (pd.to_datetime(np.atleast_1d(times)) - t0) / pd.Timedelta(seconds = 1)
+    tsec = np.asarray(tsec, dtype=float)
+    pos = orbit(tsec)
+    outside = (tsec < orbit.x[0]) | (tsec > orbit.x[-1])
+    if outside.any():
+        print('WARNING, times outside of the orbit state vectors of '+parfile)
+        pos[outside] = np.nan
+    return pos
+
+
+def latlon2nvec(lat, lon):
+    ''' Converts (arrays of) geodetic lat, lon [deg] to n-vectors (stacked in the last axis)'''
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)], axis = -1)
+
+
+def nvec2latlon(nvec):
+    ''' Converts (arrays of, not necessarily unit) n-vectors to geodetic lat, lon [deg]'''
+    lat = np.degrees(np.arctan2(nvec[..., 2], np.hypot(nvec[..., 0], nvec[..., 1])))
+    lon = np.degrees(np.arctan2(nvec[..., 1], nvec[..., 0]))
+    return lat, lon
+
+
+def intersect_paths(path_a, path_b):
+    ''' Intersection of great circles given by paths (pairs of n-vectors) A and B, the one closer to the first point of A
+    (as nvector.GeoPath.intersect). Vectorised, i.e. the n-vectors can be arrays (stacked in the last axis).
+
+    Returns:
+        np.array: lat, lon [deg] of the intersection(s)
+    '''
+    nvec = np.cross(np.cross(path_a[0], path_a[1]), np.cross(path_b[0], path_b[1]))
+    nvec = np.sign(np.sum(nvec * path_a[0], axis = -1, keepdims = True)) * nvec
+    return nvec2latlon(nvec)
+
+
+def get_ipps(hionos, scene_lat, scene_lon, azimuthDeg, elevationDeg, slantRange, heading, satg_lat, satg_lon, sat_alt, bovl_acq_dist,
+             satgA = None, satgB = None):
+    ''' Gets ionosphere pierce points A, B (i.e. of the burst overlap forward and backward looks) for all iono heights at once.
+    The geometry is given per swath or burst overlap (arrays) or for the whole frame (scalars), the satellite altitude is for the frame centre.
+
+    Args:
+        hionos (np.array): iono heights [m], e.g. per epoch
+        scene_lat, scene_lon, azimuthDeg, elevationDeg, slantRange, heading (float or np.array): (swath) centre geometry
+        satg_lat, satg_lon (float or np.array): satellite nadir point (for the whole frame, or as the geometry arrays)
+        sat_alt (float): satellite altitude [m]
+        bovl_acq_dist (float): distance travelled by the satellite during the burst overlap acquisition [m]
+        satgA, satgB (tuple): lat, lon of the satellite nadir at the A, B acquisitions (e.g. from orbit, see get_orbit_positions).
+                              If None, they are estimated from satg, heading and bovl_acq_dist
+
+    Returns:
+        np.array, np.array, np.array, np.array: latA, lonA, latB, lonB, each of shape (len(hionos), number of swaths)
+    '''
+    hionos = np.asarray(hionos, dtype=float)[:, np.newaxis]
+    scene_lat, scene_lon, azimuthDeg, elevationDeg, slantRange, heading = [np.atleast_1d(np.asarray(v, dtype=float))[np.newaxis, :]
+                                                    for v in [scene_lat, scene_lon, azimuthDeg, elevationDeg, slantRange, heading]]
+    shape = np.broadcast_shapes(hionos.shape, scene_lat.shape)
+    # iono point in the (swath) centre line of sight
+    range_IPP = slantRange * hionos / sat_alt
+    x, y, z = aer2ecef(np.broadcast_to(azimuthDeg, shape), np.broadcast_to(elevationDeg, shape), range_IPP,
+                       np.broadcast_to(scene_lat, shape), np.broadcast_to(scene_lon, shape), np.zeros(shape))
+    ippg_lat, ippg_lon, _ = ecef2latlonhei(x, y, z)
+    # then get A', B'
+    if satgA is None:
+        satgA_lon, satgA_lat, _ = WGS84_GEOD.fwd(np.broadcast_to(satg_lon, heading.shape), np.broadcast_to(satg_lat, heading.shape),
+                                                 heading - 180, np.full(heading.shape, bovl_acq_dist/2))
+    else:
+        satgA_lat, satgA_lon = satgA
+    if satgB is None:
+        satgB_lon, satgB_lat, _ = WGS84_GEOD.fwd(np.broadcast_to(satg_lon, heading.shape), np.broadcast_to(satg_lat, heading.shape),
+                                                 heading, np.full(heading.shape, bovl_acq_dist/2))
+    else:
+        satgB_lat, satgB_lon = satgB
+    # then do intersection ... (distance is set just larger here, no meaning for bovl_acq_dist)
+    headings = np.broadcast_to(heading, shape)
+    ippAt_lon, ippAt_lat, _ = WGS84_GEOD.fwd(ippg_lon, ippg_lat, headings - 180, np.full(shape, bovl_acq_dist))
+    ippBt_lon, ippBt_lat, _ = WGS84_GEOD.fwd(ippg_lon, ippg_lat, headings, np.full(shape, bovl_acq_dist))
+    path_ipp = (latlon2nvec(ippAt_lat, ippAt_lon), latlon2nvec(ippBt_lat, ippBt_lon))
+    nscene = latlon2nvec(scene_lat, scene_lon)
+    # these two points are the ones where we should get TEC
+    latA, lonA = intersect_paths(path_ipp, (nscene, latlon2nvec(satgA_lat, satgA_lon)))
+    latB, lonB = intersect_paths(path_ipp, (nscene, latlon2nvec(satgB_lat, satgB_lon)))
+    return latA, lonA, latB, lonB
+
+
 def get_altitude(lat, lon):
     '''
     uses USGS site to get elevation data. thanks to:
@@ -837,7 +1900,8 @@ def get_abs_iono_corr(frame,esds,framespd):
 '''
 
 def calculate_daz_iono(frame, esds, framespd, method = 'gradient', out_hionos = False, out_alphas = False,
-                 out_tec_master = False, out_tec_all = False, ionosource='code', use_iri_hei=False, alpha = 0.85):
+                 out_tec_master = False, out_tec_all = False, ionosource='code', use_iri_hei=False, alpha = 0.85,
+                 storedir = '/gws/ssde/j25a/nceo_geohazards/vol1/code_iono', iritable = None, perbovl = False, orbpar = None):
     ''' Function to calculate iono correction for a given frame.
 
     Args:
@@ -851,9 +1915,38 @@ def calculate_daz_iono(frame, esds, framespd, method = 'gradient', out_hionos =
         ionosource (str)            iri or code (for IRI or GIM-based ionosphere. the latter improves RMSE!)
         use_iri_hei (bool)          if True, it estimates F2 peak altitude using IRI and uses for the correction (with any ionosource). NOTE, CODE data are for 450 km ALT..
         alpha (float or 'auto')     only for code (/jpl) source. If 'auto', it would estimate it using IRI model
+        storedir (str)              only for code (/jpl) source. GIM directory or GIM archive (see update_gim_archive)
+        iritable (str or xr.Dataset) only with use_iri_hei. If given, hmF2 and alpha are taken from this IRI surrogate table (see create_iri_table)
+        perbovl (bool)              only with per-swath frame data. If True, the IPPs are estimated per burst overlap (number of bursts from frame ID,
+                                    overlap times from the reference epoch TOPS_par burst windows (swath_bovl_dt, see get_frameta) if available,
+                                    otherwise a nominal layout spaced by swath_burst_interval about the swath centre) rather than at swath centres,
+                                    and their corrections averaged
+        orbpar (str)                template of the reference epoch SLC par file, with {frame}, {track} and {master} fields,
+                                    e.g. '/path/{track}/{frame}/SLC/{master}/{master}.slc.par'. If given (and existing), the satellite positions
+                                    are interpolated from its orbit state vectors at the (burst overlap) acquisition times rather than estimated from the centre range
 
     Notes: 'liang' method should include also some extra F2 height correction..
     2023/08: Liang method was first implemented here and a lot happened since that time.. Please consider it obsolete.
+    2026/10: split to get_iono_requests, evaluate_iono_requests and combine_daz_iono (see extract_iono_full for their day-major use)
+    '''
+    ionoreq = get_iono_requests(frame, esds, framespd, method = method, ionosource = ionosource, use_iri_hei = use_iri_hei, alpha = alpha,
+                                iritable = iritable, perbovl = perbovl, orbpar = orbpar)
+    if ionoreq is False:
+        return False
+    ionoreq['points'] = evaluate_iono_requests(ionoreq['points'], storedir = storedir)
+    return combine_daz_iono(ionoreq, out_hionos = out_hionos, out_alphas = out_alphas,
+                            out_tec_master = out_tec_master, out_tec_all = out_tec_all)
+
+
+def get_iono_requests(frame, esds, framespd, method = 'gradient', ionosource='code', use_iri_hei=False, alpha = 0.85, iritable = None, perbovl = False,
+                      orbpar = None):
+    ''' Prepares the TEC requests of a given frame, i.e. the ionosphere pierce points A, B (per swath or burst overlap if available)
+    for all epochs of the frame and its reference epoch (the last one). Parameters as in calculate_daz_iono.
+
+    Returns:
+        dict with the frame parameters needed by combine_daz_iono and 'points', i.e. pd.DataFrame of the requests with columns
+            iepoch, swath, ipair (swath or burst overlap), ab, epochdate, time, lat, lon, altitude, alpha, cosiono, source, gimmethod, gimday
+        (or False if failed)
     '''
     # some constants
     earth_radius = 6378160 # m
@@ -885,13 +1978,14 @@ def calculate_daz_iono(frame, esds, framespd, method = 'gradient', out_hionos =
     theta = np.radians(inc_angle_avg)
     #sathei = int(range_avg * np.cos(theta)/1000) #in km --- will do this better
     master_time = pd.to_datetime(str(master)+'T'+center_time)
-    acq_times = pd.to_datetime(selected_frame_esds.epochdate.astype(str)+'T'+center_time)
+    # exact epoch times (derived from the reference epoch time if not given in esds)
+    selected_frame_esds = add_epochtime(selected_frame_esds, frameta)
+    acq_times = pd.to_datetime(selected_frame_esds['epochtime'])
+    acq_times = acq_times.fillna(pd.to_datetime(selected_frame_esds.epochdate.astype(str)+'T'+center_time)).rename('epochdate')
     # include master time!
     acq_times[acq_times.index[-1]+1] = master_time
     #
     # 1. get f2 hei inbetween target center point C and nadir of the satellite satg
-    wgs84 = nv.FrameE(name='WGS84')
-    Pscene_center = wgs84.GeoPoint(latitude=scene_center_lat, longitude=scene_center_lon, degrees=True)
     # bovl_acq_dist = 7100*(2.75*2+110*0.002056) #approx. satellite velocity on the ground 7100 [m/s] * time to acquire burst overlap
     bovl_dtime = 2.75/3*2 + 0.07
     bovl_acq_dist = 7100 * bovl_dtime  # approx. satellite velocity on the ground 7100 [m/s] * time to acquire burst overlap
@@ -906,19 +2000,23 @@ def calculate_daz_iono(frame, esds, framespd, method = 'gradient', out_hionos =
     #    scene_alt = 0
     #to get position of the satellite - UNCLEAR about slantRange - is this w.r.t. DEM? (should ask GAMMA) - if not (only in WGS-84), i should use scene_alt=0!
     # 2023/08: checked using orbits - the slantranfe is wrt ellipsoid! setting scene alt 0
-    x, y, z = aer2ecef(azimuthDeg, elevationDeg, slantRange, scene_center_lat, scene_center_lon, 0) #scene_alt)
-    satg_lat, satg_lon, sat_alt = ecef2latlonhei(x, y, z)
-    print('debug: sat coordinates are expected as')
-    print('lat,lon,alt=')
-    print([satg_lat, satg_lon, sat_alt])
-    print('x,y,z=')
-    print([x,y,z])
-    print('--------')
-    Psatg = wgs84.GeoPoint(latitude=satg_lat, longitude=satg_lon, degrees=True)
+    orbitpar = None
+    if orbpar:
+        orbitpar = orbpar.format(frame = frame, track = int(frame[:3]), master = master)
+        if not os.path.exists(orbitpar):
+            print('WARNING, orbit par file '+orbitpar+' does not exist, estimating the satellite position from the centre range')
+            orbitpar = None
+    if orbitpar:
+        # 2026/10: satellite position from the reference epoch orbit (at the reference epoch time)
+        x, y, z = get_orbit_positions(orbitpar, [master_time]).T
+        satg_lat, satg_lon, sat_alt = [v[0] for v in ecef2latlonhei(x, y, z)]
+        print('satellite position from orbit (lat,lon,alt): '+str([float(satg_lat), float(satg_lon), float(sat_alt)]))
+    else:
+        x, y, z = aer2ecef(azimuthDeg, elevationDeg, slantRange, scene_center_lat, scene_center_lon, 0) #scene_alt)
+        satg_lat, satg_lon, sat_alt = ecef2latlonhei(x, y, z)
+        print('satellite position estimated from the centre range (lat,lon,alt): '+str([float(satg_lat), float(satg_lon), float(sat_alt)]))
     # get middle point between scene and sat - and get F2 altitude (max TEC) for it
-    path = nv.GeoPath(Pscene_center.to_nvector(), Psatg.to_nvector())
-    # get point in the middle
-    Pmid_scene_sat = path.interpolate(0.5).to_geo_point()
+    mid_lat, mid_lon = nvec2latlon(latlon2nvec(scene_center_lat, scene_center_lon) + latlon2nvec(satg_lat, satg_lon))
     # work in dedicated table
     df = pd.DataFrame(acq_times)
     # 2024: not clear if IRI F2 peak altitude is correct. Allowing the standard 450 km assumption by CODE (I think TECs will get scaled, so the gradient should be still ok. Not tested)
@@ -929,8 +2027,13 @@ def calculate_daz_iono(frame, esds, framespd, method = 'gradient', out_hionos =
             stralpha='and alpha '
         else:
             stralpha=''
-        print('extracting hmF2 '+stralpha+'estimates from IRI model')
-        _, hionos, alphas = get_tecs(Pmid_scene_sat.latitude_deg, Pmid_scene_sat.longitude_deg, 800, acq_times, source='iri', returnhei = True, returnalpha=True, alpha=alpha)
+        if iritable is not None:
+            print('extracting hmF2 '+stralpha+'estimates from IRI surrogate table')
+            hionos, alphas = get_iri_surrogate(iritable, mid_lat, mid_lon, acq_times)
+            hionos, alphas = list(hionos), list(alphas)
+        else:
+            print('extracting hmF2 '+stralpha+'estimates from IRI model')
+            _, hionos, alphas = get_tecs(mid_lat, mid_lon, 800, acq_times, source='iri', returnhei = True, returnalpha=True, alpha=alpha)
         hiono_master = hionos[-1]
         selected_frame_esds['hiono'] = hionos[:-1]  ###*1000 # convert to metres, avoid last measure, as this is 'master'
         df['hiono'] = hionos
@@ -958,8 +2061,8 @@ def calculate_daz_iono(frame, esds, framespd, method = 'gradient', out_hionos =
         #
     ############## now calculate TEC using the SLM knowledge, i.e. different A,B per epoch (!)
     # (note that the last hiono is for the master/reference epoch
-    tecs_A = []
-    tecs_B = []
+    # here we only prepare the IPPs A, B - their TEC is evaluated in evaluate_iono_requests
+    points = []
     # do per epoch, using frame metadata (valid for reference epoch dt...)
     if 'swath_dfDC' in frameta:
         print('estimating iono gradients per swath')
@@ -974,92 +2077,172 @@ def calculate_daz_iono(frame, esds, framespd, method = 'gradient', out_hionos =
         # ka = np.array(frameta['swath_ka'].values[0]) # not used....
         perswath=True
         method='gradient'
+        nobovls = get_frame_nobovls(frame)
+        swaths = np.arange(len(heading))
+        bovl_dt = np.zeros(len(heading))
+        # swath centre times w.r.t. the frame centre time (seconds of day, from the swath par files center_time, see get_frameta)
+        swath_dt = get_frame_swath_values(frameta.iloc[0], 'swath_center_time_s')
+        if swath_dt is not None:
+            swath_dt = np.mod(swath_dt - (master_time - master_time.normalize()).total_seconds() + 43200, 86400) - 43200
+        if (swath_dt is None) or (len(swath_dt) != len(heading)) or not (np.abs(swath_dt) < 60).all():
+            if swath_dt is not None:
+                print('WARNING, swath centre times (swath_center_time_s) not usable, using the frame centre time')
+            swath_dt = np.zeros(len(heading))
+        if perbovl and len(nobovls) != len(heading):
+            print('WARNING, burst counts of the frame ID do not fit the swaths, estimating per swath')
+        elif perbovl:
+            # burst overlap times w.r.t. the swath centre - from the reference epoch burst windows
+            bovl_dt = get_frame_swath_values(frameta.iloc[0], 'swath_bovl_dt')
+            nbovls = get_frame_swath_values(frameta.iloc[0], 'swath_nbovls')
+            if (bovl_dt is None) or (nbovls is None) or (len(nbovls) != len(nobovls)) or (nbovls != nobovls).any():
+                # or nominal layout (the swath centre being in the middle of the bursts)
+                burst_interval = get_frame_swath_values(frameta.iloc[0], 'swath_burst_interval')
+                if (burst_interval is None) or (len(burst_interval) != len(nobovls)):
+                    burst_interval = np.full(len(nobovls), 2.758277)
+                print('no burst overlap times (swath_bovl_dt) fitting the frame ID, using nominal burst layout')
+                bovl_dt = np.concatenate([(np.arange(n) + 0.5 - n/2)*burst_interval[j] for j, n in enumerate(nobovls)])
+            swaths = np.repeat(swaths, nobovls)
+            print('estimating iono gradients per burst overlap ({} overlaps)'.format(len(swaths)))
+            # the swath centres and the satellite nadir shifted along track to the burst overlaps (approx. ground velocity as for bovl_acq_dist,
+            # or the distance of the satellite nadir points from orbit)
+            heading, azimuthDeg, elevationDeg, slantRange, theta, dfDC, swath_dt = [v[swaths] for v in [heading, azimuthDeg, elevationDeg, slantRange, theta, dfDC, swath_dt]]
+            bovl_dist = 7100*bovl_dt
+            if orbitpar:
+                swath_satg_lat, swath_satg_lon, _ = ecef2latlonhei(*get_orbit_positions(orbitpar, master_time + pd.to_timedelta(swath_dt, unit = 's')).T)
+                bovl_satg_lat, bovl_satg_lon, _ = ecef2latlonhei(*get_orbit_positions(orbitpar, master_time + pd.to_timedelta(swath_dt + bovl_dt, unit = 's')).T)
+                bovl_dist = np.sign(bovl_dt) * WGS84_GEOD.inv(swath_satg_lon, swath_satg_lat, bovl_satg_lon, bovl_satg_lat)[2]
+            scene_center_lon, scene_center_lat, _ = WGS84_GEOD.fwd(scene_center_lon[swaths], scene_center_lat[swaths], heading, bovl_dist)
+            satg_lon, satg_lat, _ = WGS84_GEOD.fwd(np.full(len(swaths), satg_lon), np.full(len(swaths), satg_lat), heading, bovl_dist)
+            nobovls = np.ones(len(swaths))
     else:
         perswath=False
-    for i,a in df.iterrows():
-        hiono = float(a['hiono']*1000) # m
-        # overwriting input alpha param, as now fixed by pre-init above
-        alpha = float(a['alpha'])
-        epochdate = a['epochdate']
-        #alpha_to_use = alpha
-        print('running for epochtime: '+str(epochdate))
-        print('assuming peak iono alt of : '+str(int(hiono/1000))+' km')
-        if perswath:
-            if ionosource == 'code':
-                print('getting GIM VTEC')
-                tecxr=get_vtec_from_code(epochdate, lat=0, lon=0, return_fullxr = True)
-            range_IPP = slantRange * hiono / sat_alt
-            sin_thetaiono = earth_radius/(earth_radius+hiono) * np.sin(theta)
-            tecs_A_swaths = np.array([], dtype=np.float64)
-            tecs_B_swaths = np.array([], dtype=np.float64)
-            for j in range(len(range_IPP)):
-                #print('debug: swath '+str(j))
-                x, y, z = aer2ecef(azimuthDeg[j], elevationDeg[j], range_IPP[j], scene_center_lat[j], scene_center_lon[j], 0) #scene_alt)
-                ippg_lat, ippg_lon, ipp_alt = ecef2latlonhei(x, y, z)
-                Pippg = wgs84.GeoPoint(latitude=ippg_lat, longitude=ippg_lon, degrees=True)
-                # then get A', B'
-                # note, bovl_acq_dist would slightly vary per swath...
-                PsatgA, _azimuth = Psatg.displace(distance=bovl_acq_dist/2, azimuth=heading[j]-180, method='ellipsoid', degrees=True)
-                PsatgB, _azimuth = Psatg.displace(distance=bovl_acq_dist/2, azimuth= heading[j], method='ellipsoid', degrees=True)
-                # then do intersection ... (distance is set just larger here, no meaning for bovl_acq_dist)
-                PippAt, _azimuth = Pippg.displace(distance=bovl_acq_dist, azimuth=heading[j]-180, method='ellipsoid', degrees=True)
-                PippBt, _azimuth = Pippg.displace(distance=bovl_acq_dist, azimuth= heading[j], method='ellipsoid', degrees=True)
-                path_ipp = nv.GeoPath(PippAt, PippBt)
-                Pburst_center = wgs84.GeoPoint(latitude=scene_center_lat[j], longitude=scene_center_lon[j], degrees=True)
-                path_scene_satgA = nv.GeoPath(Pburst_center, PsatgA)
-                path_scene_satgB = nv.GeoPath(Pburst_center, PsatgB)
-                # these two points are the ones where we should get TEC
-                PippA = path_ipp.intersect(path_scene_satgA).to_geo_point()
-                PippB = path_ipp.intersect(path_scene_satgB).to_geo_point()
-                pdist, pa1, pa2 = PippA.distance_and_azimuth(PippB, degrees=True)
-                print('debug: swath '+str(j+1)+': distance between the IPP points is ' + str(int(pdist)) + ' m and their azimuth ' + str(
-                    int(pa1)) + ' deg')
-                if ionosource != 'code':
-                    TECV_A = get_tecs(PippA.latitude_deg, PippA.longitude_deg, round(sat_alt/1000), [epochdate-pd.Timedelta(bovl_dtime/2, 's')], False, source=ionosource, alpha = alpha)[0]
-                    TECV_B = get_tecs(PippB.latitude_deg, PippB.longitude_deg, round(sat_alt/1000), [epochdate+pd.Timedelta(bovl_dtime/2, 's')], False, source=ionosource, alpha = alpha)[0]
-                else:
-                    TECV_A = get_vtec_from_tecxr(tecxr, epochdate-pd.Timedelta(bovl_dtime/2, 's'), PippA.latitude_deg, PippA.longitude_deg, method='linear')
-                    TECV_B = get_vtec_from_tecxr(tecxr, epochdate+pd.Timedelta(bovl_dtime/2, 's'), PippB.latitude_deg, PippB.longitude_deg, method='linear')
-                    TECV_A = TECV_A * alpha
-                    TECV_B = TECV_B * alpha
-                TECS_A = TECV_A/np.sqrt(1-sin_thetaiono[j]**2)
-                TECS_B = TECV_B/np.sqrt(1-sin_thetaiono[j]**2)
-                tecs_A_swaths = np.append(tecs_A_swaths, TECS_A)
-                tecs_B_swaths = np.append(tecs_B_swaths, TECS_B)
-            tecs_A.append(tecs_A_swaths) #.mean())
-            tecs_B.append(tecs_B_swaths) #.mean())
+        nobovls = None
+        bovl_dt = np.zeros(1)
+        swath_dt = np.zeros(1)
+    # times of the burst overlaps (or swath/frame centres) w.r.t. the frame centre time
+    sat_dt = swath_dt + bovl_dt
+    satgA, satgB = None, None
+    if orbitpar:
+        # satellite nadir points at these times and at the times of their A, B acquisitions
+        satg_lat, satg_lon, _ = ecef2latlonhei(*get_orbit_positions(orbitpar, master_time + pd.to_timedelta(sat_dt, unit = 's')).T)
+        satgA = ecef2latlonhei(*get_orbit_positions(orbitpar, master_time + pd.to_timedelta(sat_dt - bovl_dtime/2, unit = 's')).T)[:2]
+        satgB = ecef2latlonhei(*get_orbit_positions(orbitpar, master_time + pd.to_timedelta(sat_dt + bovl_dtime/2, unit = 's')).T)[:2]
+    # IPPs of all epochs (and swaths or burst overlaps) at once
+    hionos_m = df['hiono'].values.astype(float)*1000  # m
+    latA, lonA, latB, lonB = get_ipps(hionos_m, scene_center_lat, scene_center_lon, azimuthDeg, elevationDeg, slantRange, heading,
+                                      satg_lat, satg_lon, sat_alt, bovl_acq_dist, satgA = satgA, satgB = satgB)
+    # get inc angle at IPP - see iono. single layer model function
+    sin_thetaiono = earth_radius/(earth_radius+hionos_m[:, np.newaxis]) * np.sin(np.atleast_1d(theta))[np.newaxis, :]
+    cosiono = np.sqrt(1-sin_thetaiono**2)
+    # the per swath IPPs are acquired at the burst overlap times
+    nepochs, npairs = latA.shape
+    epochdates = pd.Series(np.repeat(df['epochdate'].values, npairs))
+    for ab, lat, lon, sign in [('A', latA, lonA, -1), ('B', latB, lonB, 1)]:
+        times = epochdates + pd.to_timedelta(np.tile(sat_dt + sign*bovl_dtime/2, nepochs), unit = 's') if perswath else epochdates
+        points.append(pd.DataFrame({'iepoch': np.repeat(np.arange(nepochs), npairs), 'swath': np.tile(swaths if perswath else [0], nepochs),
+                                    'ipair': np.tile(np.arange(npairs), nepochs), 'ab': ab,
+                                    'epochdate': epochdates, 'time': times, 'lat': lat.ravel(), 'lon': lon.ravel(),
+                                    'altitude': round(sat_alt/1000), 'alpha': np.repeat(df['alpha'].values.astype(float), npairs),
+                                    'cosiono': cosiono.ravel()}))
+    points = pd.concat(points).sort_values(['iepoch', 'ipair', 'ab'], kind = 'stable').reset_index(drop = True)
+    #
+    return {'frame': frame, 'method': method, 'perswath': perswath, 'dfDC': dfDC, 'nobovls': nobovls, 'sat_alt': sat_alt, 'frameta': frameta,
+            'selected_frame_esds': selected_frame_esds, 'hionos': hionos, 'hiono_master': hiono_master, 'alphas': alphas,
+            'points': set_iono_source(points, ionosource, perswath)}
+
+
+def set_iono_source(points, source, perswath):
+    ''' Sets TEC source of the requests from get_iono_requests (so they can be evaluated for other sources, sharing the IPPs).
+
+    Args:
+        points (pd.DataFrame): requests of one frame
+        source (str): as ionosource in calculate_daz_iono, or 'jplhr' / 'codg' for only JPL-HR / CODE GIM
+        perswath (bool): if the requests are per swath
+
+    Returns:
+        pd.DataFrame: points with columns source, gimmethod and gimday
+    '''
+    points = points.copy()
+    points['source'] = source
+    # GIM VTEC is interpolated linearly for the per-swath GIM (all swaths at once), otherwise as in get_tecs
+    # (the 'jpl' source is kept for consistency with earlier results). The GIM day is of the IPP time, as the day datacube
+    # ends at the next midnight (burst overlaps of an epoch close to midnight may be acquired on the next day)
+    if perswath and source in ['code', 'jplhr', 'codg']:
+        points['gimmethod'] = 'linear'
+    else:
+        points['gimmethod'] = 'cubic'
+    points['gimday'] = points['time'].dt.normalize()
+    return points
+
+
+def evaluate_iono_requests(points, storedir = '/gws/ssde/j25a/nceo_geohazards/vol1/code_iono'):
+    ''' Evaluates TEC for the requests prepared by get_iono_requests (of one or more frames).
+    The GIM requests are grouped by GIM day, so each day datacube is loaded only once and all its requests are evaluated together
+    (the 'linear' ones in one batch). Other sources are evaluated per point through get_tecs.
+    The GIM sources are 'code' or 'jpl' (JPL-HR GIM, or CODE if not available), 'jplhr' (only JPL-HR) and 'codg' (only CODE GIM).
+
+    Args:
+        points (pd.DataFrame): requests as from get_iono_requests (can be concatenated from several frames)
+        storedir (str): GIM directory or GIM archive (see update_gim_archive)
+
+    Returns:
+        pd.DataFrame: points with added columns tecv (VTEC, for GIM already scaled by alpha) and tecs (slant TEC)
+    '''
+    points = points.copy()
+    points['tecv'] = np.nan
+    isgim = points['source'].isin(['code', 'jpl', 'jplhr', 'codg'])
+    for (gimday, source, gimmethod), sel in points[isgim].groupby(['gimday', 'source', 'gimmethod']):
+        tecxr = get_gim_tecxr(gimday, storedir = storedir, noJPL = (source == 'codg'), noCODE = (source == 'jplhr'), attimes = sel['time'].values)
+        if tecxr is False:
+            print('No JPL/CODE data for date '+str(gimday.date())+'. Setting NaN.')
+            continue
+        if gimmethod == 'linear':
+            tecv = get_vtec_from_tecxr_batch(tecxr, sel['time'].values, sel['lat'].values, sel['lon'].values, method='linear')
         else:
-            # first, get IPP - ionosphere pierce point
-            # range to IPP can be calculated using:
-            # range_IPP = hiono/np.sin(theta)
-            # but maybe not... let's do it simpler:
-            range_IPP = slantRange * hiono / sat_alt
-            x, y, z = aer2ecef(azimuthDeg, elevationDeg, range_IPP, scene_center_lat, scene_center_lon, 0) #scene_alt)
-            ippg_lat, ippg_lon, ipp_alt = ecef2latlonhei(x, y, z)
-            Pippg = wgs84.GeoPoint(latitude=ippg_lat, longitude=ippg_lon, degrees=True)
-            # then get A', B'
-            PsatgA, _azimuth = Psatg.displace(distance=bovl_acq_dist/2, azimuth=heading-180, method='ellipsoid', degrees=True)
-            PsatgB, _azimuth = Psatg.displace(distance=bovl_acq_dist/2, azimuth= heading, method='ellipsoid', degrees=True)
-            # then do intersection ... (distance is set just larger here, no meaning for bovl_acq_dist)
-            PippAt, _azimuth = Pippg.displace(distance=bovl_acq_dist, azimuth=heading-180, method='ellipsoid', degrees=True)
-            PippBt, _azimuth = Pippg.displace(distance=bovl_acq_dist, azimuth= heading, method='ellipsoid', degrees=True)
-            path_ipp = nv.GeoPath(PippAt, PippBt)
-            path_scene_satgA = nv.GeoPath(Pscene_center, PsatgA)
-            path_scene_satgB = nv.GeoPath(Pscene_center, PsatgB)
-            # these two points are the ones where we should get TEC
-            PippA = path_ipp.intersect(path_scene_satgA).to_geo_point()
-            PippB = path_ipp.intersect(path_scene_satgB).to_geo_point()
-            pdist, pa1, pa2 = PippA.distance_and_azimuth(PippB, degrees=True)
-            print('debug: distance between the IPP points is '+str(int(pdist))+' m and their azimuth '+str(int(pa1))+' deg')
-            ######### get TECS for A, B
-            TECV_A = get_tecs(PippA.latitude_deg, PippA.longitude_deg, round(sat_alt/1000), [epochdate], False, source=ionosource, alpha = alpha)[0]
-            TECV_B = get_tecs(PippB.latitude_deg, PippB.longitude_deg, round(sat_alt/1000), [epochdate], False, source=ionosource, alpha = alpha)[0]
-            # get inc angle at IPP - see iono. single layer model function
-            sin_thetaiono = earth_radius/(earth_radius+hiono) * np.sin(theta)
-            TECS_A = TECV_A/np.sqrt(1-sin_thetaiono**2)
-            TECS_B = TECV_B/np.sqrt(1-sin_thetaiono**2)
-            tecs_A.append(TECS_A)
-            tecs_B.append(TECS_B)
+            # keeping the pointwise interpolation of get_tecs here
+            tecv = []
+            for acqtime, lat, lon in zip(sel['time'], sel['lat'], sel['lon']):
+                try:
+                    tecv.append(get_vtec_from_tecxr(tecxr, acqtime, lat, lon, method=gimmethod))
+                except:
+                    print('No JPL/CODE data for time '+str(acqtime)+'. Setting NaN.')
+                    tecv.append(np.nan)
+            tecv = np.array(tecv, dtype=np.float64)
+        points.loc[sel.index, 'tecv'] = tecv * sel['alpha'].values
+    isiri = points['source'] == 'iri'
+    for altitude, sel in points[isiri].groupby('altitude'):
+        # all IRI runs at once (memoised, see get_iri_cached)
+        lons = np.where(sel['lon'].values > 180, sel['lon'].values - 180, sel['lon'].values)  # as in get_tecs
+        points.loc[sel.index, 'tecv'] = get_iri_cached(sel['time'], sel['lat'].values, lons, [0, altitude, altitude])[0]
+    for i, p in points[~isgim & ~isiri].iterrows():
+        points.at[i, 'tecv'] = get_tecs(p['lat'], p['lon'], p['altitude'], [p['time']], False, source=p['source'], alpha = p['alpha'])[0]
+    points['tecs'] = points['tecv']/points['cosiono']
+    return points
+
+
+def combine_daz_iono(ionoreq, out_hionos = False, out_alphas = False, out_tec_master = False, out_tec_all = False):
+    ''' Calculates the iono correction of a frame from its evaluated TEC requests (see calculate_daz_iono for the outputs).
+
+    Args:
+        ionoreq (dict): as from get_iono_requests, with 'points' evaluated by evaluate_iono_requests
+    '''
+    frame = ionoreq['frame']
+    method = ionoreq['method']
+    perswath = ionoreq['perswath']
+    dfDC = ionoreq['dfDC']
+    sat_alt = ionoreq['sat_alt']
+    frameta = ionoreq['frameta']
+    selected_frame_esds = ionoreq['selected_frame_esds'].copy()
+    hionos = ionoreq['hionos']
+    hiono_master = ionoreq['hiono_master']
+    alphas = ionoreq['alphas']
+    points = ionoreq['points'].sort_values(['iepoch', 'ipair'])
+    tecs_A = points[points['ab'] == 'A']['tecs'].values
+    tecs_B = points[points['ab'] == 'B']['tecs'].values
+    if perswath:
+        # to (epoch, swath) arrays (or (epoch, burst overlap))
+        tecs_A = tecs_A.reshape(-1, points['ipair'].max()+1)
+        tecs_B = tecs_B.reshape(-1, points['ipair'].max()+1)
     #
     tec_A_master = tecs_A[-1]
     tec_B_master = tecs_B[-1]
@@ -1068,9 +2251,6 @@ def calculate_daz_iono(frame, esds, framespd, method = 'gradient', out_hionos =
     tecs_A = tecs_A[:-1]
     tecs_B = tecs_B[:-1]
     #
-    #selected_frame_esds['TECS_A'] = tecs_A
-    #selected_frame_esds['TECS_B'] = tecs_B
-    #
     ##############################
     #if method == 'gomba':
     PRF = 486.486
@@ -1083,36 +2263,14 @@ def calculate_daz_iono(frame, esds, framespd, method = 'gradient', out_hionos =
     #daz_iono = -2*PRF*k*f0/c/dfDC * tecovl
     #
     if perswath:
-        nobursts = frame.split('_')[2]
-        nobursts = [int(nobursts[:2]), int(nobursts[2:4]), int(nobursts[4:6])]
-        while 0 in nobursts:
-            nobursts.remove(0)
-        nobursts = np.array(nobursts)
-        nobovls = nobursts-1
-        tecs_A2tb = []
-        tecs_B2tb = []
-        for t in tecs_A:
-            tecs_A2tb.append(t.mean())
-        for t in tecs_B:
-            tecs_B2tb.append(t.mean())
-        selected_frame_esds['TECS_A'] = tecs_A2tb
-        selected_frame_esds['TECS_B'] = tecs_B2tb
-        selected_frame_esds['daz_iono'] = 0.0
-        daz_iono = []
-        #
-        for tecind in range(len(tecs_A)):
-            tecs_A_ep = tecs_A[tecind]
-            tecs_B_ep = tecs_B[tecind]
-            #print('debug, tecs_A_ep:')
-            #print(tecs_A_ep)
-            daz_iono_ep = []
-            for j in range(len(tec_A_master)):
-                tecovl = (tec_A_master[j] - tecs_A_ep[j])/fH[j] - (tec_B_master[j] - tecs_B_ep[j])/fL[j]
-                daz_iono_sw = 2*PRF*k/c/dfDC[j] * tecovl
-                daz_iono_ep.append(daz_iono_sw*nobovls[j])
-            # now get it as avg for no of bovls:
-            daz_iono.append(np.array(daz_iono_ep).sum()/nobovls.sum())
-        selected_frame_esds['daz_iono'] = np.array(daz_iono)
+        nobovls = ionoreq['nobovls']
+        selected_frame_esds['TECS_A'] = tecs_A.mean(axis=1)
+        selected_frame_esds['TECS_B'] = tecs_B.mean(axis=1)
+        # (epoch, swath) matrices, i.e. all epochs at once
+        tecovl = (tec_A_master - tecs_A)/fH - (tec_B_master - tecs_B)/fL
+        daz_iono_sw = 2*PRF*k/c/dfDC * tecovl
+        # now get it as avg for no of bovls:
+        selected_frame_esds['daz_iono'] = (daz_iono_sw*nobovls).sum(axis=1)/nobovls.sum()
         daz_iono = selected_frame_esds['daz_iono']
         # return mean values for later use
         #tec_A_master = np.mean(tec_A_master)
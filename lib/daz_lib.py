@@ -10,6 +10,7 @@ try:
     from scipy.constants import pi
     from scipy import signal
     from scipy.stats import linregress
+    from scipy.spatial import cKDTree
     from sklearn.linear_model import HuberRegressor
     #
     import urllib
@@ -24,6 +25,7 @@ except:
 
 import xarray as xr
 import glob, os
+import warnings
 
 
 # load the csvs
@@ -42,7 +44,7 @@ def load_csvs(esdscsv = 'esds.csv', framescsv = 'frames.csv', core_init = False)
         esds = esds.drop('epoch', axis=1)
     esds['epochdate'] = esds.apply(lambda x : pd.to_datetime(str(x.epochdate)).date(), axis=1)
     if 'epochtime' in esds.columns:
-        esds['epochtime'] = esds.apply(lambda x: pd.to_datetime(str(x.epochtime)), axis=1)
+        esds['epochtime'] = pd.to_datetime(esds['epochtime'])
     if core_init:
         mindate = esds['epochdate'].min()
         #maxdate = esds['epochdate'].max()
@@ -52,7 +54,104 @@ def load_csvs(esdscsv = 'esds.csv', framescsv = 'frames.csv', core_init = False)
     return esds, framespd
 
 
+def get_frame_master_dts(framespd):
+    ''' Returns pd.Series (indexed by frame) of acquisition datetimes of the reference epochs (master + centre_time). NaT if unknown.'''
+    fpd = framespd.drop_duplicates('frame').set_index('frame')
+    centre_time = fpd['centre_time'].astype(str).str.strip()
+    centre_time = centre_time.where(~centre_time.isin(['0', '0.0', '', 'nan', 'None']))
+    masterdate = pd.to_datetime(fpd['master'].astype(str).str.replace('-', '').str[:8], format='%Y%m%d', errors='coerce')
+    return masterdate + pd.to_timedelta(centre_time, errors='coerce')
+
+
+def add_epochtime(esds, framespd, repeat_days = 6, overwrite = False):
+    ''' Adds (or fills missing values of) esds['epochtime'] - acquisition datetime of the epoch.
+
+    S1 repeats its ground track every 12 days (175 orbits, 6 days for the S1A/B(C) constellation),
+    i.e. each epoch is acquired at the reference epoch time shifted by a multiple of repeat_days
+    (up to few seconds of orbit control). This also keeps the correct time for frames crossing midnight,
+    where epochdate + centre_time would be one day off. Done for all frames at once (no need of fc.estimate_bperps).
+    Epochs outside of the repeat grid (derived time more than an hour outside of epochdate) get epochdate + centre_time.
+
+    Args:
+        esds (pd.DataFrame)
+        framespd (pd.DataFrame):  needs columns master and centre_time
+        repeat_days (int)
+        overwrite (bool):         if False, existing (valid) epochtime values are kept
+    Returns:
+        pd.DataFrame: esds with the epochtime column
+    '''
+    masterdts = esds['frame'].map(get_frame_master_dts(framespd))
+    epochdates = pd.to_datetime(esds['epochdate'].astype(str))
+    days = (epochdates - masterdts.dt.normalize()).dt.days
+    nrepeats = (days/repeat_days).round()
+    epochtimes = masterdts + pd.to_timedelta(nrepeats*repeat_days, unit='D')
+    ongrid = ((epochtimes - epochdates) > pd.Timedelta(hours=-1)) & ((epochtimes - epochdates) < pd.Timedelta(hours=25))
+    epochtimes = epochtimes.where(ongrid, epochdates + (masterdts - masterdts.dt.normalize()))
+    if (not overwrite) and ('epochtime' in esds):
+        esds['epochtime'] = pd.to_datetime(esds['epochtime']).fillna(epochtimes)
+    else:
+        esds['epochtime'] = epochtimes
+    return esds
+
+
 # general functions
+def cache_lookup(dbfile, table, keys, valcols):
+    ''' Bulk lookup of values in SQLite cache table.
+
+    Args:
+        dbfile (str):         path to the sqlite file (if it does not exist, all values are returned as missing)
+        table (str):          table name
+        keys (pd.DataFrame):  query keys (column names = key columns of the table, values already rounded as when stored)
+        valcols (list):       value columns to get
+    Returns:
+        pd.DataFrame: values (NaN where missing), indexed as keys
+    '''
+    out = pd.DataFrame(np.nan, index=keys.index, columns=valcols)
+    if (not dbfile) or (not os.path.exists(dbfile)) or keys.empty:
+        return out
+    import sqlite3
+    keycols = list(keys.columns)
+    with sqlite3.connect(dbfile) as con:
+        if not con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone():
+            return out
+        q = keys.reset_index(drop=True)
+        q['qid'] = np.arange(len(q))
+        q.to_sql('tmp_query', con, if_exists='replace', index=False)
+        sql = 'SELECT q.qid, {0} FROM tmp_query q JOIN {1} t ON {2}'.format(
+            ', '.join(['t.'+c for c in valcols]), table, ' AND '.join(['q.{0} = t.{0}'.format(c) for c in keycols]))
+        found = pd.read_sql_query(sql, con)
+        con.execute('DROP TABLE tmp_query')
+    if not found.empty:
+        found = found.drop_duplicates('qid')
+        out.iloc[found['qid'].values] = found[valcols].values
+    return out
+
+
+def cache_store(dbfile, table, keys, values):
+    ''' Bulk store of values to SQLite cache table (created if not existing, existing keys are replaced).
+
+    Args:
+        dbfile (str):          path to the sqlite file
+        table (str):           table name
+        keys (pd.DataFrame):   key columns
+        values (pd.DataFrame): value columns (same length as keys)
+    '''
+    if keys.empty:
+        return
+    import sqlite3
+    keycols = list(keys.columns)
+    valcols = list(values.columns)
+    df = pd.concat([keys.reset_index(drop=True), values.reset_index(drop=True)], axis=1).drop_duplicates(keycols)
+    with sqlite3.connect(dbfile) as con:
+        # typed columns (same affinity as the query tables, otherwise the index would not be used)
+        sqltypes = [c+(' INTEGER' if df[c].dtype.kind in 'iub' else ' REAL' if df[c].dtype.kind == 'f' else ' TEXT') for c in df.columns]
+        con.execute('CREATE TABLE IF NOT EXISTS {0} ({1}, PRIMARY KEY ({2}))'.format(table,
+                    ', '.join(sqltypes), ', '.join(keycols)))
+        df.to_sql('tmp_store', con, if_exists='replace', index=False)
+        con.execute('INSERT OR REPLACE INTO {0} ({1}) SELECT {1} FROM tmp_store'.format(table, ', '.join(keycols + valcols)))
+        con.execute('DROP TABLE tmp_store')
+
+
 def rad2mm_s1(inrad):
     #speed_of_light = 299792458 #m/s
     radar_freq = 5.405e9  #for S1
@@ -155,27 +254,332 @@ def heading2EN_lookvector(heading): # e.g. heading = -169
 # step 2 - get solid Earth tides
 ################### SOLID EARTH TIDES
 
-def get_SET_for_frame(frame, esds, framespd):
-    """ Updated function to get ENU solid earth tides for given frame.
-    Warning, this solution probably does not include corrections to leap seconds1
+def _sun_moon_ecef(times):
+    ''' Low-precision geocentric ECEF positions [m] of the Sun and the Moon (Montenbruck & Gill, as in solid.f by D. Milbert).
+
+    Args:
+        times (pd.DatetimeIndex): UTC times
+    Returns:
+        np.array, np.array, np.array: sun and moon positions, each of shape (len(times), 3), and Greenwich mean sidereal angle [rad]
+    '''
+    rad = np.pi/180
+    mjd_utc = np.asarray((times - pd.Timestamp('1858-11-17')) / pd.Timedelta(days=1), dtype=float)
+    # ephemerides in TT (assuming TT-UTC = 69.184 s, i.e. leap seconds since 2017 - 1 s error is negligible here)
+    t = (mjd_utc + 69.184/86400 - 51544.5)/36525
+    obe = 23.43929111*rad
+    # Sun
+    emdeg = 357.5256 + 35999.049*t
+    em = emdeg*rad
+    rsun = (149.619 - 2.499*np.cos(em) - 0.021*np.cos(2*em))*1e9
+    slon = (282.94 + emdeg + (6892*np.sin(em) + 72*np.sin(2*em))/3600 + 1.3972*t)*rad  # incl. precession to equinox of date
+    sun = np.stack([rsun*np.cos(slon), rsun*np.sin(slon)*np.cos(obe), rsun*np.sin(slon)*np.sin(obe)], axis=-1)
+    # Moon
+    el0 = 218.31617 + 481267.88088*t - 1.3972*t
+    el = (134.96292 + 477198.86753*t)*rad
+    elp = (357.52543 + 35999.04944*t)*rad
+    f = (93.27283 + 483202.01873*t)*rad
+    d = (297.85027 + 445267.11135*t)*rad
+    dlon = (22640*np.sin(el) + 769*np.sin(2*el) - 4586*np.sin(el-2*d) + 2370*np.sin(2*d) - 668*np.sin(elp) - 412*np.sin(2*f)
+            - 212*np.sin(2*el-2*d) - 206*np.sin(el+elp-2*d) + 192*np.sin(el+2*d) - 165*np.sin(elp-2*d) + 148*np.sin(el-elp)
+            - 125*np.sin(d) - 110*np.sin(el+elp) - 55*np.sin(2*f-2*d))/3600
+    q = (412*np.sin(2*f) + 541*np.sin(elp))/3600*rad
+    mlat = (18520*np.sin(f + dlon*rad + q) - 526*np.sin(f-2*d) + 44*np.sin(el+f-2*d) - 31*np.sin(-el+f-2*d) - 25*np.sin(-2*el+f)
+            - 23*np.sin(elp+f-2*d) + 21*np.sin(-el+f) + 11*np.sin(-elp+f-2*d))/3600*rad
+    rmoon = (385000.56 - 20905*np.cos(el) - 3699*np.cos(2*d-el) - 2956*np.cos(2*d) - 570*np.cos(2*el) + 246*np.cos(2*el-2*d)
+             - 205*np.cos(elp-2*d) - 171*np.cos(el+2*d) - 152*np.cos(el+elp-2*d))*1000
+    mlon = (el0 + dlon + 1.3972*t)*rad  # precession to equinox of date
+    x, y, z = rmoon*np.cos(mlon)*np.cos(mlat), rmoon*np.sin(mlon)*np.cos(mlat), rmoon*np.sin(mlat)
+    moon = np.stack([x, y*np.cos(obe) - z*np.sin(obe), y*np.sin(obe) + z*np.cos(obe)], axis=-1)
+    # to ECEF through Greenwich mean sidereal time (UT1 ~ UTC)
+    ghar = np.mod(280.46061837504 + 360.9856473662862*(mjd_utc - 51544.5), 360)*rad
+    cg, sg = np.cos(ghar), np.sin(ghar)
+    out = []
+    for body in [sun, moon]:
+        out.append(np.stack([cg*body[...,0] + sg*body[...,1], -sg*body[...,0] + cg*body[...,1], body[...,2]], axis=-1))
+    return out[0], out[1], ghar
+
+
+def get_SET_ENU(lon, lat, times):
+    ''' Solid Earth tide displacements in E, N, U [m], computed in-process for many points/times at once (vectorised).
+
+    This is a numpy port of the step 1 of solid.f (D. Milbert, IERS Conventions 2010, eq. 7.5-7.6), i.e. the same model as in
+    gmt earthtide: degree 2 and 3 Love/Shida numbers (with the latitude dependence of h2, l2), Sun and Moon.
+    From the step 2 (frequency-dependent) corrections, only the dominant K1 term is included (up to 1.3 cm in U).
+    Other step 2 and out-of-phase terms are omitted - these are at the level of 1 mm (compared to solid.f).
+
+    Args:
+        lon, lat (float or np.array): geodetic coordinates [deg], broadcastable with times
+        times (datetime-like or array of them): UTC times
+    Returns:
+        np.array, np.array, np.array: E, N, U [m]
+    '''
+    rad = np.pi/180
+    times = pd.DatetimeIndex(pd.to_datetime(np.atleast_1d(times)))
+    lon = np.asarray(lon, dtype=float)*rad
+    lat = np.asarray(lat, dtype=float)*rad
+    lon, lat = np.broadcast_arrays(lon, lat, np.zeros(len(times)))[:2]
+    # station on GRS80 ellipsoid (h=0)
+    a, e2 = 6378137.0, 0.00669438002290
+    nrad = a/np.sqrt(1 - e2*np.sin(lat)**2)
+    xsta = np.stack([nrad*np.cos(lat)*np.cos(lon), nrad*np.cos(lat)*np.sin(lon), nrad*(1 - e2)*np.sin(lat)], axis=-1)
+    rsta = np.linalg.norm(xsta, axis=-1)
+    usta = xsta/rsta[...,None]
+    # Love and Shida numbers, with latitude (geocentric) dependence
+    cosphi2 = (usta[...,0]**2 + usta[...,1]**2)
+    h2 = 0.6078 - 0.0006*(1 - 1.5*cosphi2)
+    l2 = 0.0847 + 0.0002*(1 - 1.5*cosphi2)
+    h3, l3 = 0.292, 0.015
+    re = 6378136.6
+    sun, moon, ghar = _sun_moon_ecef(times)
+    dxyz = np.zeros(xsta.shape)
+    for body, massratio in [(sun, 332946.0482), (moon, 0.0123000371)]:
+        rbody = np.linalg.norm(body, axis=-1)
+        ubody = body/rbody[...,None]
+        sc = np.sum(ubody*usta, axis=-1)
+        fac2 = massratio*re*(re/rbody)**3
+        fac3 = fac2*(re/rbody)
+        # degree 2
+        p2 = 3*(h2/2 - l2)*sc**2 - h2/2
+        x2 = 3*l2*sc
+        # degree 3
+        p3 = 5/2*(h3 - 3*l3)*sc**3 + 3/2*(l3 - h3)*sc
+        x3 = 3/2*l3*(5*sc**2 - 1)
+        dxyz = dxyz + (fac2*x2 + fac3*x3)[...,None]*ubody + (fac2*p2 + fac3*p3)[...,None]*usta
+    # rotate to local E, N, U (geodetic)
+    E = -np.sin(lon)*dxyz[...,0] + np.cos(lon)*dxyz[...,1]
+    N = -np.sin(lat)*np.cos(lon)*dxyz[...,0] - np.sin(lat)*np.sin(lon)*dxyz[...,1] + np.cos(lat)*dxyz[...,2]
+    U = np.cos(lat)*np.cos(lon)*dxyz[...,0] + np.cos(lat)*np.sin(lon)*dxyz[...,1] + np.sin(lat)*dxyz[...,2]
+    # step 2 correction for K1 (IERS 2010 eq. 7.12, using h, l of K1 from Table 7.2)
+    thk1 = ghar + np.pi + lon
+    dRk1 = -1.5*np.sqrt(5/(24*np.pi))*0.36878*(0.5236 - 0.6078)
+    dTk1 = -3*np.sqrt(5/(24*np.pi))*0.36878*(0.0870 - 0.0847)
+    U = U + dRk1*np.sin(thk1)*np.sin(2*lat)
+    N = N + dTk1*np.sin(thk1)*np.cos(2*lat)
+    E = E + dTk1*np.cos(thk1)*np.sin(lat)
+    return E, N, U
+
+
+def get_SET_ENU_cached(lon, lat, times, backend = 'python', cachefile = None):
+    ''' As get_SET_ENU (or gmt earthtide if backend = 'gmt'), but using persistent SQLite cache of the tides.
+    The cache is keyed by backend, lon/lat rounded to 4 decimals and UTC time rounded to seconds - only the missing values are computed (at these rounded keys) and stored.
+
+    Args:
+        lon, lat (np.array), times (array of datetimes): as in get_SET_ENU, but of the same length
+        backend (str):   'python' or 'gmt'
+        cachefile (str): path to the sqlite cache. If None, env. variable DAZ_SETCACHE is used (if set, otherwise no caching)
+    Returns:
+        np.array, np.array, np.array: E, N, U [m]
+    '''
+    if cachefile is None:
+        cachefile = os.environ.get('DAZ_SETCACHE')
+    times = pd.DatetimeIndex(pd.to_datetime(np.atleast_1d(times))).round('s')
+    keys = pd.DataFrame({'backend': backend,
+                         'lon': np.round(np.broadcast_to(np.asarray(lon, dtype=float), times.shape), 4),
+                         'lat': np.round(np.broadcast_to(np.asarray(lat, dtype=float), times.shape), 4),
+                         'utc': (times - pd.Timestamp('1970-01-01')) // pd.Timedelta(seconds=1)})
+    tides = cache_lookup(cachefile, 'settides', keys, ['E', 'N', 'U'])
+    miss = tides['E'].isnull().values
+    if miss.any():
+        mkeys = keys[miss]
+        if backend == 'gmt':
+            # one gmt call per point
+            E, N, U = np.zeros(len(mkeys)), np.zeros(len(mkeys)), np.zeros(len(mkeys))
+            mtimes = times[miss]
+            for (lo, la), ii in mkeys.reset_index(drop=True).groupby(['lon', 'lat']).indices.items():
+                E[ii], N[ii], U[ii] = get_SET_gmt(lo, la, mtimes[ii].strftime('%Y-%m-%dT%H:%M:%S'))
+        else:
+            E, N, U = get_SET_ENU(mkeys['lon'].values, mkeys['lat'].values, times[miss])
+        tides.loc[miss, 'E'], tides.loc[miss, 'N'], tides.loc[miss, 'U'] = E, N, U
+        if cachefile:
+            cache_store(cachefile, 'settides', mkeys, tides[miss])
+    return tides['E'].values, tides['N'].values, tides['U'].values
+
+
+def get_frame_nobovls(frame):
+    ''' Returns number of burst overlaps per (existing) swath, from the frame ID (e.g. 001A_05199_131313 -> [12, 12, 12])'''
+    nobursts = frame.split('_')[2]
+    nobursts = [int(nobursts[:2]), int(nobursts[2:4]), int(nobursts[4:6])]
+    while 0 in nobursts:
+        nobursts.remove(0)
+    return np.array(nobursts) - 1
+
+
+def get_frame_swath_values(frameta, col):
+    ''' Gets per-swath values (list) from framespd row, also if they were loaded from csv (as a string). Returns None if not available.'''
+    if not col in frameta:
+        return None
+    vals = frameta[col]
+    if isinstance(vals, str):
+        vals = np.fromstring(vals.strip('[]() '), sep=',')
+    try:
+        vals = np.array(vals, dtype=float).flatten()
+    except:
+        return None
+    if (vals.size == 0) or (not np.all(np.isfinite(vals))):
+        return None
+    return vals
+
+
+def get_frame_SET_points(framespd, perswath = True):
+    ''' Points to evaluate SET for each frame, with weights - per-swath centres weighted by their number of burst overlaps
+    (as for the iono correction), or frame centre if per-swath data are not available (or perswath = False).
+
+    Returns:
+        pd.DataFrame: table with columns frame, lon, lat, weight
+    '''
+    pts = []
+    nfallback = 0
+    for i, frameta in framespd.drop_duplicates('frame').iterrows():
+        frame = frameta['frame']
+        lons = get_frame_swath_values(frameta, 'swath_center_lon') if perswath else None
+        lats = get_frame_swath_values(frameta, 'swath_center_lat') if perswath else None
+        if (lons is None) or (lats is None) or (len(lons) != len(lats)):
+            nfallback += int(perswath)
+            lons, lats, weights = [frameta['center_lon']], [frameta['center_lat']], [1.0]
+        else:
+            try:
+                weights = get_frame_nobovls(frame)
+                if (len(weights) != len(lons)) or (weights.sum() <= 0):
+                    weights = np.ones(len(lons))
+            except:
+                weights = np.ones(len(lons))
+        pts.append(pd.DataFrame({'frame': frame, 'lon': lons, 'lat': lats, 'weight': np.array(weights, dtype=float)}))
+    if nfallback:
+        print('WARNING, no per-swath centres (swath_center_lon/lat, see get_frameta(perswath=True)) for {0} of {1} frames, using their frame centre'.format(
+            nfallback, len(pts)))
+    return pd.concat(pts, ignore_index=True)
+
+
+def _get_SET_weighted(pts, frames, times, cachefile = None):
+    ''' E, N, U tides for (frame, time) pairs, as a weighted average over SET points of the frames (all in one call)'''
+    q = pd.DataFrame({'frame': np.asarray(frames), 'time': pd.to_datetime(np.asarray(times))})
+    q['qid'] = np.arange(len(q))
+    q = q.merge(pts, on='frame')
+    E, N, U = get_SET_ENU_cached(q['lon'].values, q['lat'].values, q['time'], cachefile = cachefile)
+    w = q['weight'].values
+    sums = pd.DataFrame({'E': E*w, 'N': N*w, 'U': U*w, 'w': w}).groupby(q['qid'].values).sum()
+    sums = sums.reindex(np.arange(len(frames)))
+    return (sums['E']/sums['w']).values, (sums['N']/sums['w']).values, (sums['U']/sums['w']).values
+
+
+def get_SET_all_frames(esds, framespd, cachefile = None, perswath = False):
+    ''' Gets ENU solid Earth tides for all epochs of all frames at once (using get_SET_ENU), w.r.t. the reference epoch of each frame.
+    Epoch times are derived by add_epochtime (if not already in esds).
+    The tides are cached in cachefile (see get_SET_ENU_cached), so reruns only compute tides of new epochs.
+    If perswath, the tides are evaluated at per-swath centres and averaged with weights of their number of burst overlaps (see get_frame_SET_points).
+
+    Returns:
+        pd.DataFrame: table as from get_SET.sh, i.e. with columns frame, epoch (YYYYMMDD), dEtide, dNtide, dUtide [m]
+    '''
+    cols = ['frame', 'epochdate'] + (['epochtime'] if 'epochtime' in esds else [])
+    e = esds[esds['frame'].isin(framespd['frame'])][cols].copy()
+    e = add_epochtime(e, framespd)
+    if e['epochtime'].isnull().any():
+        print('WARNING, no acquisition time for {} epochs (no centre_time of the frame?), skipping them'.format(e['epochtime'].isnull().sum()))
+        e = e[e['epochtime'].notnull()]
+    pts = get_frame_SET_points(framespd, perswath = perswath)
+    E, N, U = _get_SET_weighted(pts, e['frame'].values, e['epochtime'].values, cachefile = cachefile)
+    # reference epochs
+    masterdts = get_frame_master_dts(framespd)
+    masterdts = masterdts[masterdts.notnull()]
+    Em, Nm, Um = _get_SET_weighted(pts, masterdts.index.values, masterdts.values, cachefile = cachefile)
+    mtides = pd.DataFrame({'E': Em, 'N': Nm, 'U': Um}, index=masterdts.index)
+    tides = pd.DataFrame({'frame': e['frame'].values,
+                          'epoch': pd.to_datetime(e['epochdate'].astype(str)).dt.strftime('%Y%m%d').astype(int).values})
+    tides['dEtide'] = E - e['frame'].map(mtides['E']).values
+    tides['dNtide'] = N - e['frame'].map(mtides['N']).values
+    tides['dUtide'] = U - e['frame'].map(mtides['U']).values
+    return tides
+
+
+def get_SET_for_frame(frame, esds, framespd, cachefile = None, perswath = False):
+    """ Gets ENU solid earth tides for given frame, w.r.t. its reference epoch (in-process, see get_SET_ENU).
+    Returns the same table as get_SET_all_frames.
     """
-    import pysolid
-    #lat, lon = 
-    #dt0 = # first epoch datetime
-    #dt1 = # last epoch datetime (plus few seconds)
-    step_sec = 6*24*3600 # 6 days, to capture S1A/B
-    #dtout, E, N, U = pysolid.calc_solid_earth_tides_point(lat, lon, dt0, dt1, step_sec=60)
-    # and then need to extract the data towards epochs, and diff with the reference epoch before returning
-    return True
+    return get_SET_all_frames(esds[esds['frame'] == frame], framespd[framespd['frame'] == frame], cachefile = cachefile, perswath = perswath)
 
 
-def get_SET_coords(lon,lat,epochdt):
+def get_SET_coords(lon,lat,epochdt, cachefile = None):
+    ''' Gets E, N, U tide [m] from gmt earthtide. If cachefile (or env. variable DAZ_SETCACHE) is set, the SET cache is used.'''
+    if cachefile is None:
+        cachefile = os.environ.get('DAZ_SETCACHE')
+    if cachefile:
+        E, N, U = get_SET_ENU_cached(lon, lat, [str(epochdt).replace('T', ' ')], backend = 'gmt', cachefile = cachefile)
+        return float(E[0]), float(N[0]), float(U[0])
     cmd = "gmt earthtide -L{0}/{1} -T{2}".format(lon, lat, str(epochdt).replace(' ', 'T'))
     tides = subp.check_output(cmd.split())
     tides = tides.split()
     ntide, etide, utide = float(tides[1]), float(tides[2]), float(tides[3])
     return etide, ntide, utide
 
+def get_SET_gmt(lon, lat, epochdts):
+    ''' Gets E, N, U tides [m] from gmt earthtide for many times at once (single call of gmt, using a file with times).
+
+    Args:
+        lon, lat (float)
+        epochdts (list):  times as strings ('YYYY-MM-DDTHH:MM:SS[.f]') or datetimes
+    Returns:
+        np.array, np.array, np.array: E, N, U
+    '''
+    import tempfile
+    epochdts = [str(x).replace(' ', 'T') for x in epochdts]
+    uniqdts, inv = np.unique(epochdts, return_inverse=True)  # sorted, as gmt expects increasing times
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+        f.write('\n'.join(uniqdts)+'\n')
+        timefile = f.name
+    try:
+        cmd = "gmt earthtide -L{0}/{1} -T{2}".format(lon, lat, timefile)
+        tides = subp.check_output(cmd.split(), stderr=subp.DEVNULL)
+    finally:
+        os.remove(timefile)
+    tides = np.array(tides.split()).reshape(-1, 4)[:, 1:].astype(float)
+    if len(tides) != len(uniqdts):
+        print('WARNING, gmt earthtide returned {0} values for {1} times'.format(len(tides), len(uniqdts)))
+        return np.full(len(epochdts), np.nan), np.full(len(epochdts), np.nan), np.full(len(epochdts), np.nan)
+    ntide, etide, utide = tides[inv, 0], tides[inv, 1], tides[inv, 2]
+    return etide, ntide, utide
+
+
+def _get_SET_gmt_frame(args):
+    ''' Helper for get_SET_all_frames_gmt - tides of one frame, rounded and differenced as in get_SET.sh'''
+    frame, lon, lat, masterdt, epochs, epochdts = args
+    E, N, U = get_SET_gmt(lon, lat, [masterdt] + list(epochdts))
+    E, N, U = np.round(E, 12), np.round(N, 12), np.round(U, 12)
+    return pd.DataFrame({'frame': frame, 'epoch': epochs,
+                         'dEtide': np.round(E[1:] - E[0], 12),
+                         'dNtide': np.round(N[1:] - N[0], 12),
+                         'dUtide': np.round(U[1:] - U[0], 12)})
+
+
+def get_SET_all_frames_gmt(esds, framespd, nproc = 8):
+    ''' Batched alternative of get_SET.sh - calls gmt earthtide once per frame (for all its epochs), frames run in parallel.
+    Epoch times follow get_SET.sh, i.e. epochtime column of esds if existing, otherwise epochdate + centre_time of the frame.
+    Output values are identical to get_SET.sh (to be stored with float_format = '%.12f').
+
+    Returns:
+        pd.DataFrame: table with columns frame, epoch (YYYYMMDD), dEtide, dNtide, dUtide [m]
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    fpd = framespd.drop_duplicates('frame').set_index('frame')
+    jobs = []
+    for frame, fesds in esds[esds['frame'].isin(fpd.index)].groupby('frame'):
+        centre_time = str(fpd.loc[frame, 'centre_time'])
+        master = str(fpd.loc[frame, 'master'])
+        masterdt = master[:4]+'-'+master[4:6]+'-'+master[6:8]+'T'+centre_time
+        epochdates = pd.to_datetime(fesds['epochdate'].astype(str))
+        if 'epochtime' in fesds:
+            epochdts = pd.to_datetime(fesds['epochtime']).dt.strftime('%Y-%m-%dT%H:%M:%S.%f').values
+        else:
+            epochdts = (epochdates.dt.strftime('%Y-%m-%d') + 'T' + centre_time).values
+        epochs = epochdates.dt.strftime('%Y%m%d').astype(int).values
+        jobs.append((frame, fpd.loc[frame, 'center_lon'], fpd.loc[frame, 'center_lat'], masterdt, epochs, epochdts))
+    with ProcessPoolExecutor(max_workers = nproc) as executor:
+        tides = list(executor.map(_get_SET_gmt_frame, jobs))
+    if not tides:
+        return pd.DataFrame(columns=['frame', 'epoch', 'dEtide', 'dNtide', 'dUtide'])
+    return pd.concat(tides, ignore_index=True)
+
+
 def get_SET_for_frame_dazes(frameta, frame_esds, mm2px = 1/14000):
     ''' Function to calculate SET in azimuth [px]. Working ok, hopefully correct in scaling?'''
     lon = frameta['center_lon'][0]
@@ -183,8 +587,13 @@ def get_SET_for_frame_dazes(frameta, frame_esds, mm2px = 1/14000):
     heading = frameta['heading'][0]
     centre_time = frameta['centre_time'][0]
     daz_tides_mm = []
-    for edt in frame_esds.epochdate.values:
-        epochdtstr = str(edt) + 'T' + centre_time
+    # using exact epoch times if available (or derived from the reference epoch time)
+    epochtimes = add_epochtime(frame_esds.copy(), frameta)['epochtime']
+    for edt, etime in zip(frame_esds.epochdate.values, epochtimes):
+        if pd.isnull(etime):
+            epochdtstr = str(edt) + 'T' + centre_time
+        else:
+            epochdtstr = etime.strftime('%Y-%m-%dT%H:%M:%S.%f')
         E, N, U = get_SET_coords(lon,lat,epochdtstr)
         daz_tide_mm = EN2azi(N, E, heading) * 1000
         daz_tides_mm.append(daz_tide_mm)
@@ -215,32 +624,137 @@ def get_tide_in_azimuth(lat, lon, hei, azi, time1):
 # step 2 - merge and furnish esds and framespd sets:
 #######################################
 
-def merge_tides(esds, framespd, earthtides):
-    #calculate daz_tide from N,E
+def merge_tides(esds, framespd, earthtides, return_missing = False):
+    ''' Merges the SET (E, N) table with esds (on frame, epoch) and projects it to azimuth (daz_tide_mm) using heading of each frame.
+    Epochs with missing tides (or frame metadata) get daz_tide_mm = 0.
+
+    Args:
+        esds (pd.DataFrame)
+        framespd (pd.DataFrame)
+        earthtides (pd.DataFrame): table with columns frame, epoch (YYYYMMDD), dEtide, dNtide, dUtide
+        return_missing (bool):     if True, returns also table of esds epochs without tides
+    Returns:
+        pd.DataFrame (, pd.DataFrame): esds (, missing with columns frame, epoch, reason)
+    '''
     if 'epoch' not in esds:
-        esds['epoch'] = esds.epochdate.apply(lambda x: int(x.strftime('%Y%m%d')))
-    esds['daz_tide_mm'] = 0.0
-    lenframes = len(framespd['frame'])
-    # oh.. would be better using framespd.iterrows but ok..
-    for i, frame in framespd['frame'].iteritems():
-        print('  Running for {0:6}/{1:6}th frame...'.format(i+1, lenframes), flush=True, end='\r')
-        #print(frame)
-        try:
-            frameta = framespd[framespd['frame'] == frame]
-            tiderows_frame = earthtides[earthtides['frame'] == frame]
-            for i,row in esds[esds['frame'] == frame].iterrows():
-                tiderow = tiderows_frame[tiderows_frame['epoch'] == row['epoch']]
-                if tiderow.empty:
-                    print('error in frame '+frame+'- no epoch in tides')
-                    continue
-                E = tiderow['dEtide'].values[0]
-                N = tiderow['dNtide'].values[0]
-                heading = frameta['heading']
-                daz_tide_mm = EN2azi(N, E, heading)*1000
-                esds.at[i,'daz_tide_mm'] = daz_tide_mm
-        except:
-            print('some error for frame '+frame)
-    print('\ndone')
+        esds['epoch'] = pd.to_datetime(esds['epochdate'].astype(str)).dt.strftime('%Y%m%d').astype(int)
+    tides = earthtides.drop_duplicates(['frame', 'epoch']).set_index(['frame', 'epoch'])[['dEtide', 'dNtide']]
+    tides = tides.reindex(pd.MultiIndex.from_arrays([esds['frame'], esds['epoch'].astype(int)]))
+    headings = esds['frame'].map(framespd.drop_duplicates('frame').set_index('frame')['heading']).values
+    daz_tide_mm = EN2azi(tides['dNtide'].values, tides['dEtide'].values, headings)*1000
+    isok = np.isfinite(daz_tide_mm)
+    esds['daz_tide_mm'] = np.where(isok, daz_tide_mm, 0.0)
+    if (~isok).any():
+        missing = esds.loc[~isok, ['frame', 'epoch']].copy()
+        missing['reason'] = 'no_epoch_in_tides'
+        missing.loc[~missing['frame'].isin(earthtides['frame']), 'reason'] = 'no_frame_in_tides'
+        missing.loc[~missing['frame'].isin(framespd['frame']), 'reason'] = 'no_frame_in_framespd'
+        print('WARNING, no SET for {0} epochs (of {1} frames) - setting daz_tide_mm = 0 there'.format(len(missing), missing['frame'].nunique()))
+    else:
+        missing = pd.DataFrame(columns=['frame', 'epoch', 'reason'])
+    if return_missing:
+        return esds, missing.reset_index(drop=True)
+    return esds
+
+
+################### OCEAN TIDE LOADING
+
+# constituents as in BLQ files (and the IERS ARG routine), their angular speeds [rad/s] and factors for H0, S0, P0 and 2pi
+OTL_CONSTITUENTS = ['M2', 'S2', 'N2', 'K2', 'K1', 'O1', 'P1', 'Q1', 'Mf', 'Mm', 'Ssa']
+OTL_SPEEDS = np.array([1.40519e-4, 1.45444e-4, 1.37880e-4, 1.45842e-4, 0.72921e-4, 0.67598e-4,
+                       0.72523e-4, 0.64959e-4, 0.053234e-4, 0.026392e-4, 0.003982e-4])
+OTL_ANGFAC = np.array([[2, -2, 0, 0], [0, 0, 0, 0], [2, -3, 1, 0], [2, 0, 0, 0],
+                       [1, 0, 0, 0.25], [1, -2, 0, -0.25], [-1, 0, 0, -0.25], [1, -3, 1, -0.25],
+                       [0, 2, 0, 0], [0, 1, -1, 0], [2, 0, 0, 0]], dtype=float)
+
+
+def get_otl_astro_args(times):
+    ''' Astronomical arguments [rad] of the 11 OTL constituents for given (UTC) times, as in the IERS ARG routine (vectorised).
+
+    Returns:
+        np.array: angles of shape (len(times), 11)
+    '''
+    times = pd.DatetimeIndex(pd.to_datetime(np.atleast_1d(times)))
+    days = times.normalize()
+    fday = np.asarray((times - days) / pd.Timedelta(seconds=1), dtype=float)
+    icapd = np.asarray((days - pd.Timestamp('1974-12-31')) / pd.Timedelta(days=1), dtype=float)
+    capt = (27392.500528 + 1.000000035*icapd)/36525
+    dtr = np.pi/180
+    h0 = (279.69668 + (36000.768930485 + 3.03e-4*capt)*capt)*dtr
+    s0 = (((1.9e-6*capt - 0.001133)*capt + 481267.88314137)*capt + 270.434358)*dtr
+    p0 = (((-1.2e-5*capt - 0.010325)*capt + 4069.0340329577)*capt + 334.329653)*dtr
+    angles = (np.outer(fday, OTL_SPEEDS) + np.outer(h0, OTL_ANGFAC[:,0]) + np.outer(s0, OTL_ANGFAC[:,1])
+              + np.outer(p0, OTL_ANGFAC[:,2]) + OTL_ANGFAC[:,3]*2*np.pi)
+    return np.mod(angles, 2*np.pi)
+
+
+def df_get_otl_constituents(framespd, otlnc, maxdist = None):
+    ''' Extracts OTL harmonic constants at frame centres from a grid and stores them in framespd, already projected to the azimuth (heading) direction.
+
+    The otlnc (NetCDF) is expected to contain variables amp_E, pha_E, amp_N, pha_N (amplitude [m], phase lag [deg], positive E and N,
+    i.e. BLQ W/S components need to be flipped), with dimensions (constituent, lat, lon) and constituent names as in OTL_CONSTITUENTS.
+
+    The grid longitudes can be either -180 to 180 or 0 to 360. Frames that cannot be interpolated (e.g. along coast) get the value
+    of the nearest grid node if within maxdist [deg] (default: two grid cells), otherwise NaN.
+
+    Returns:
+        pd.DataFrame: framespd with columns otl_azi_amp_<C> [m], otl_azi_pha_<C> [deg]
+    '''
+    otl = xr.open_dataset(otlnc)
+    if 'lon' not in otl.dims:
+        otl = otl.rename({'longitude': 'lon', 'latitude': 'lat'})
+    constituents = [str(c) for c in otl['constituent'].values]
+    lons = framespd['center_lon'].values.astype(float)
+    if otl['lon'].values.max() > 180:
+        lons = np.mod(lons, 360)
+    else:
+        lons = np.mod(lons + 180, 360) - 180
+    if maxdist is None:
+        maxdist = 2*max(np.abs(np.diff(otl['lon'].values)).max(), np.abs(np.diff(otl['lat'].values)).max())
+    lons = xr.DataArray(lons, dims='frame')
+    lats = xr.DataArray(framespd['center_lat'].values.astype(float), dims='frame')
+    # interpolate as complex phasors (avoiding phase wrapping)
+    phasors = {}
+    for comp in ['E', 'N']:
+        ph = otl['amp_'+comp] * np.exp(-1j*np.radians(otl['pha_'+comp]))
+        re = np.real(ph).interp(lon=lons, lat=lats)
+        im = np.imag(ph).interp(lon=lons, lat=lats)
+        # fill by nearest (e.g. for frames along coast, outside of the land grid cells), if not too far
+        ren = np.real(ph).sel(lon=lons, lat=lats, method='nearest')
+        imn = np.imag(ph).sel(lon=lons, lat=lats, method='nearest')
+        isnear = (np.abs(ren['lat'] - lats) <= maxdist) & (np.abs(np.mod(ren['lon'] - lons + 180, 360) - 180) <= maxdist)
+        ren, imn = ren.where(isnear), imn.where(isnear)
+        phasors[comp] = (re.fillna(ren) + 1j*im.fillna(imn)).transpose('frame', 'constituent').values
+    azi = EN2azi(phasors['N'], phasors['E'], framespd['heading'].values.astype(float)[:, None])
+    for i, c in enumerate(constituents):
+        framespd['otl_azi_amp_'+c] = np.abs(azi[:, i])
+        framespd['otl_azi_pha_'+c] = np.mod(-np.degrees(np.angle(azi[:, i])), 360)
+    return framespd
+
+
+def df_calculate_otl(esds, framespd):
+    ''' Calculates daz_otl_mm - OTL displacement in azimuth, w.r.t. reference epoch, for all epochs at once
+    (needs otl_azi_amp_*, otl_azi_pha_* columns in framespd, see df_get_otl_constituents).'''
+    fpd = framespd.drop_duplicates('frame').set_index('frame')
+    idx = [i for i, c in enumerate(OTL_CONSTITUENTS) if 'otl_azi_amp_'+c in fpd]
+    if not idx:
+        print('ERROR, no OTL constituents in framespd, cancelling')
+        return esds
+    ampcols = ['otl_azi_amp_'+OTL_CONSTITUENTS[i] for i in idx]
+    phacols = ['otl_azi_pha_'+OTL_CONSTITUENTS[i] for i in idx]
+    epochtimes = add_epochtime(esds[[c for c in ['frame', 'epochdate', 'epochtime'] if c in esds]].copy(), framespd)['epochtime']
+    amps = fpd[ampcols].reindex(esds['frame']).values
+    phas = np.radians(fpd[phacols].reindex(esds['frame']).values)
+    otl = np.sum(amps * np.cos(get_otl_astro_args(epochtimes)[:, idx] - phas), axis=1)
+    # reference epochs
+    masterdts = get_frame_master_dts(framespd).dropna()
+    mamps = fpd.loc[masterdts.index, ampcols].values
+    mphas = np.radians(fpd.loc[masterdts.index, phacols].values)
+    motl = pd.Series(np.sum(mamps * np.cos(get_otl_astro_args(masterdts.values)[:, idx] - mphas), axis=1), index=masterdts.index)
+    daz_otl_mm = 1000*(otl - esds['frame'].map(motl).values)
+    if np.isnan(daz_otl_mm).any():
+        print('WARNING, OTL not available for {} epochs, setting daz_otl_mm = 0 there'.format(np.isnan(daz_otl_mm).sum()))
+    esds['daz_otl_mm'] = np.nan_to_num(daz_otl_mm)
     return esds
 
 
@@ -309,12 +823,120 @@ def df_preprepare_esds(esdsin, framespdin, firstdate = '', countlimit = 25):
     #we also do not need the RSLC3 information
     if 'esd_master' in esds.columns:
         esds = esds.drop('esd_master', axis=1)
-    # some more to add - daz_tide:
+    # some more to add - daz_tide (incl. OTL if added by daz_02b --apply):
     if 'daz_tide_mm' in esds.columns:
         esds['daz_mm_notide'] = esds['daz_mm'] - esds['daz_tide_mm']
     return esds, framespd
 
 
+def get_grouped_detrended(df, col, xcol = None, by = 'frame'):
+    ''' Removes linear trend from df[col] within each group (by), all groups at once (through grouped sums).
+
+    Args:
+        df (pd.DataFrame):  e.g. esds, expected sorted by epochdate within the groups
+        col (str):          column to detrend
+        xcol (str or None): column with the independent variable (e.g. 'years_since_beginning'). If None, sample order is used (as in scipy.signal.detrend)
+        by (str or list):   column(s) to group by
+    Returns:
+        pd.Series: detrended values (NaN where col is NaN)
+    '''
+    y = df[col].astype(float)
+    valid = y.notna()
+    if xcol:
+        x = df[xcol].astype(float).where(valid)
+    else:
+        x = valid.astype(float).groupby([df[b] for b in np.atleast_1d(by)]).cumsum().where(valid)
+    tmp = pd.DataFrame({'x': x, 'y': y, 'xx': x*x, 'xy': x*y}, index=df.index)
+    grouped = tmp.groupby([df[b] for b in np.atleast_1d(by)])
+    n = grouped['y'].transform('count')
+    sx = grouped['x'].transform('sum')
+    sy = grouped['y'].transform('sum')
+    sxx = grouped['xx'].transform('sum')
+    sxy = grouped['xy'].transform('sum')
+    varx = sxx - sx*sx/n
+    slope = ((sxy - sx*sy/n)/varx).where(varx > 0, 0.0)
+    intercept = (sy - slope*sx)/n
+    return y - (slope*x + intercept)
+
+
+def df_quality_report(esds, framespd, col = 'daz_mm', countlimit = 25, minepochs = 10, subsetdate = dt.date(2016,3,1), mincount_subset = 20,
+                      jump_thres = 100, maxstd = 200, poddate = dt.date(2020,7,30)):
+    ''' Data quality report for all frames in one grouped pass (no per-frame loop).
+
+    Args:
+        esds, framespd (pd.DataFrame): as loaded by load_csvs (or after df_preprepare_esds)
+        col (str):              daz column [mm] to check. If not in esds, daz_total_wrt_orbits is converted using azimuth_resolution
+        countlimit (int):       minimal number of epochs (as in df_preprepare_esds)
+        minepochs (int):        minimal number of S1B epochs both before and after the POD change (as in get_s1b_offset)
+        subsetdate (dt.date):   data before this date are not used for velocity estimates (see df_calculate_slopes)
+        mincount_subset (int):  minimal number of epochs after subsetdate
+        jump_thres (float):     [mm] difference between consecutive epochs to be flagged as large jump
+        maxstd (float):         [mm] maximal std of the detrended data
+        poddate (dt.date):      date of the POD change
+    Returns:
+        pd.DataFrame: quality table per frame, with qc_ok (frame usable) and qc_s1ab_ok (enough data for the S1AB offset per POD) flags
+    '''
+    e = esds[['frame', 'epochdate']].copy()
+    if col in esds:
+        e['daz'] = esds[col]
+    else:
+        print('no '+col+' column, using daz_total_wrt_orbits with azimuth_resolution')
+        res = framespd.drop_duplicates('frame').set_index('frame')['azimuth_resolution']
+        e['daz'] = esds['daz_total_wrt_orbits']*esds['frame'].map(res)*1000
+    e['epochdate'] = pd.to_datetime(e['epochdate'])
+    if 'S1AorB' in esds:
+        e['isB'] = (esds['S1AorB'] == 'B').astype(int)
+    else:
+        e['isB'] = 0
+    e['ispre'] = (e['epochdate'] < pd.Timestamp(poddate)).astype(int)
+    e['isB_pre'] = e['isB']*e['ispre']
+    e['isB_post'] = e['isB']*(1 - e['ispre'])
+    e['insubset'] = (e['epochdate'] > pd.Timestamp(subsetdate)).astype(int)
+    e = e.sort_values(['frame', 'epochdate'])
+    gaps = e.groupby('frame')['epochdate'].diff().dt.days
+    e['gap'] = gaps
+    e['duplicate'] = (gaps == 0).astype(int)
+    e['jump'] = (e.groupby('frame')['daz'].diff().abs() > jump_thres).astype(int)
+    e['detrended2'] = get_grouped_detrended(e, 'daz')**2
+    qc = e.groupby('frame').agg(count=('epochdate', 'count'),
+                                first_epoch=('epochdate', 'min'),
+                                last_epoch=('epochdate', 'max'),
+                                max_gap_days=('gap', 'max'),
+                                median_gap_days=('gap', 'median'),
+                                duplicate_epochs=('duplicate', 'sum'),
+                                count_B=('isB', 'sum'),
+                                count_prepod=('ispre', 'sum'),
+                                count_B_prepod=('isB_pre', 'sum'),
+                                count_B_postpod=('isB_post', 'sum'),
+                                count_subset=('insubset', 'sum'),
+                                std_detrended_mm=('detrended2', 'mean'),
+                                large_jumps=('jump', 'sum'))
+    qc['std_detrended_mm'] = np.sqrt(qc['std_detrended_mm'])
+    qc['count_A'] = qc['count'] - qc['count_B']
+    qc['count_postpod'] = qc['count'] - qc['count_prepod']
+    qc['AB_balance'] = qc['count_B']/qc['count']
+    qc['in_framespd'] = qc.index.isin(framespd['frame'])
+    # flags
+    qc['qc_reason'] = ''
+    qc.loc[~qc['in_framespd'], 'qc_reason'] += 'no_frameta;'
+    qc.loc[qc['count'] < countlimit, 'qc_reason'] += 'few_epochs;'
+    qc.loc[qc['count_subset'] < mincount_subset, 'qc_reason'] += 'few_epochs_subset;'
+    qc.loc[~(qc['std_detrended_mm'] <= maxstd), 'qc_reason'] += 'noisy;'
+    qc['qc_ok'] = qc['qc_reason'] == ''
+    qc['qc_s1ab_ok'] = (qc['count_B_prepod'] >= minepochs) & (qc['count_B_postpod'] >= minepochs)
+    return qc.reset_index()
+
+
+def qc_select_frames(esds, framespd, qc):
+    ''' Keeps only frames flagged as qc_ok in the quality table from df_quality_report
+    '''
+    okframes = qc[qc['qc_ok']]['frame']
+    print('{0}/{1} frames passed the quality check'.format(len(okframes), len(qc)))
+    esds = esds[esds['frame'].isin(okframes)]
+    framespd = framespd[framespd['frame'].isin(okframes)]
+    return esds, framespd
+
+
 
 #######################################
 # step 4 - get plate motion model
@@ -406,7 +1028,9 @@ def df_compare_new_orbits(esds, col = 'daz_mm_notide_noiono_grad_OK'):
 
 
 
-def decompose_azrg2NEU(df):
+def decompose_azrg2NEU(df, weighted = False):
+    ''' weighted: solve the weighted least squares (by 1/std^2) rather than the plain one (std used only for the RMSE)
+    '''
     velrg = 'vel_rg'
     velaz = 'vel_az'
     stdrg = 'std_rg'
@@ -437,7 +1061,10 @@ def decompose_azrg2NEU(df):
     d = np.array(d)
     Q = np.zeros((len(d), len(d)))
     np.fill_diagonal(Q, Qt)
-    lstsq = np.linalg.lstsq(A, d, rcond=None)
+    if weighted:
+        lstsq = np.linalg.lstsq(np.sqrt(Q) @ A, np.sqrt(Q) @ d, rcond=None)
+    else:
+        lstsq = np.linalg.lstsq(A, d, rcond=None)
     # Qm will be variance for V,E and for V,N
     try:
         Qm = np.linalg.inv(A.transpose() @ Q @ A)
@@ -462,7 +1089,9 @@ def decompose_azrg2NEU(df):
                          })
 
 #function for decomposition (by LS inversion)
-def decompose_azi2NE(df, col = 'daz_mm_notide_noiono_grad', colstd = None):
+def decompose_azi2NE(df, col = 'daz_mm_notide_noiono_grad', colstd = None, weighted = False):
+    ''' weighted: solve the weighted least squares (by 1/RMSE^2) rather than the plain one (RMSE used only for the output RMSE)
+    '''
     velcol = 'slope_'+col+'_mmyear'
     if colstd:
         rmscol = colstd
@@ -488,7 +1117,10 @@ def decompose_azi2NE(df, col = 'daz_mm_notide_noiono_grad', colstd = None):
     d = np.array(d)
     Q = np.zeros((len(d),len(d)))
     np.fill_diagonal(Q,Qt)
-    lstsq = np.linalg.lstsq(A,d, rcond=None)
+    if weighted:
+        lstsq = np.linalg.lstsq(np.sqrt(Q) @ A, np.sqrt(Q) @ d, rcond=None)
+    else:
+        lstsq = np.linalg.lstsq(A,d, rcond=None)
     # Qm will be variance for V,E and for V,N
     try:
         Qm = np.linalg.inv(A.transpose() @ Q @ A)
@@ -652,10 +1284,73 @@ def get_std_diff(diff):
     return np.sqrt(suma/len(diff))
 
 
-def decompose_framespd(framespd, cell_size = 2.25, crs = "EPSG:4326"):
+def df_flag_inconsistent_frames(framespd, cols = ['daz_mm_notide_noiono_grad', 'daz_mm_notide_noiono', 'daz_mm_notide', 'daz_mm', 'vel_az'],
+                                k = 6, maxdist_km = 500, minneighbours = 2, thres = 3, pmmcol = 'slope_plates_vel_azi_itrf2014'):
+    '''
+    Flags frames whose velocity differs too much from their k nearest neighbouring frames of the same pass (A/D).
+    Neighbours are found through KD-tree on frame centres (unit sphere), the PMM prediction (pmmcol) is removed first.
+    Frame is flagged if |residual - median of neighbour residuals| > thres * robust std (1.4826*MAD) of these differences.
+
+    Args:
+        framespd (pd.DataFrame)
+        cols (list):        columns to check - velocities are in 'slope_'+col+'_mmyear' (or col itself, e.g. vel_az)
+        k (int):            number of nearest neighbours
+        maxdist_km (float): neighbours further than this are not used
+        minneighbours (int): frames with fewer neighbours are not flagged
+        thres (float):      threshold in multiples of the robust std
+        pmmcol (str):       column with plate motion model prediction (if not existing, velocities are compared directly)
+    Returns:
+        pd.DataFrame: framespd with new columns is_inconsistent_<col> and nbdiff_<col> (difference to neighbours median [mm/y])
+    '''
+    R = 6371.0
+    lon = np.radians(framespd['center_lon'].values.astype(float))
+    lat = np.radians(framespd['center_lat'].values.astype(float))
+    xyz = np.column_stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)])
+    maxchord = 2*np.sin(min(maxdist_km/R, np.pi)/2)
+    opass = framespd['frame'].str[3].values
+    # neighbour indices within the same pass (-1 for missing)
+    nbidx = np.full((len(framespd), k), -1)
+    for p in np.unique(opass):
+        inp = np.where(opass == p)[0]
+        if len(inp) < 2:
+            continue
+        tree = cKDTree(xyz[inp])
+        dist, idx = tree.query(xyz[inp], k = min(k+1, len(inp)), distance_upper_bound = maxchord)
+        idx = np.atleast_2d(idx)[:, 1:]  # first is the frame itself
+        valid = idx < len(inp)
+        nbidx[inp, :idx.shape[1]] = np.where(valid, inp[np.minimum(idx, len(inp)-1)], -1)
+    for col in cols:
+        velcol = 'slope_'+col+'_mmyear'
+        if not velcol in framespd:
+            velcol = col
+        if not velcol in framespd:
+            continue
+        vel = framespd[velcol].values.astype(float)
+        vel = np.where(vel == -999, np.nan, vel)
+        if pmmcol in framespd:
+            vel = vel - framespd[pmmcol].values.astype(float)
+        nbvel = np.where(nbidx >= 0, np.append(vel, np.nan)[nbidx], np.nan)
+        nbcount = np.isfinite(nbvel).sum(axis=1)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)  # all-NaN rows
+            nbdiff = vel - np.nanmedian(nbvel, axis=1)
+        nbdiff[nbcount < minneighbours] = np.nan
+        robstd = 1.4826*np.nanmedian(np.abs(nbdiff - np.nanmedian(nbdiff)))
+        framespd['nbdiff_'+col] = nbdiff
+        framespd['is_inconsistent_'+col] = np.abs(nbdiff) > thres*robstd
+        print('{0}: {1} frames flagged as inconsistent with neighbours'.format(col, framespd['is_inconsistent_'+col].sum()))
+    return framespd
+
+
+def decompose_framespd(framespd, cell_size = 2.25, crs = "EPSG:4326", inconsistent_factor = 0):
     '''
     cell_size = 2.25  # this is some ~230x230 km
+    inconsistent_factor: RMSE of frames flagged as inconsistent with neighbours (see df_flag_inconsistent_frames) is multiplied by this
+                         and the decomposition is then solved by weighted least squares (0 = no downweighting, plain least squares as before)
     '''
+    if inconsistent_factor:
+        if not [c for c in framespd.columns if c.startswith('is_inconsistent_')]:
+            framespd = df_flag_inconsistent_frames(framespd)
     framespd['opass'] = framespd['frame'].str[3]
     gdf = geopandas.GeoDataFrame(framespd,
                 geometry=geopandas.points_from_xy(framespd.center_lon, framespd.center_lat),
@@ -700,6 +1395,14 @@ def decompose_framespd(framespd, cell_size = 2.25, crs = "EPSG:4326"):
         if merged.loc[i].index_right not in gridagg.index:
             merged = merged.drop(i)
     
+    # downweight frames inconsistent with their neighbours (weighted least squares then)
+    weighted = bool(inconsistent_factor)
+    if inconsistent_factor:
+        for flagcol in [c for c in merged.columns if c.startswith('is_inconsistent_')]:
+            col = flagcol.replace('is_inconsistent_', '')
+            rmscol = 'std_az' if col == 'vel_az' else col+'_RMSE_mmy_full'
+            if rmscol in merged:
+                merged.loc[merged[flagcol].astype(bool), rmscol] *= inconsistent_factor
     gridgrouped = merged.groupby('index_right')
     # 2. now do the decomposition
     # old version:
@@ -708,7 +1411,7 @@ def decompose_framespd(framespd, cell_size = 2.25, crs = "EPSG:4326"):
         col = 'daz_mm_notide_noiono'
 
     if col in framespd:
-        decomposed = gridgrouped.apply(decompose_azi2NE, col)
+        decomposed = gridgrouped.apply(decompose_azi2NE, col, weighted = weighted)
         gridagg['VEL_N_noTI'] = decomposed['V_N'].values
         gridagg['VEL_E_noTI'] = decomposed['V_E'].values
         gridagg['RMSE_VEL_N_noTI'] = decomposed['RMSE_N'].values
@@ -716,7 +1419,7 @@ def decompose_framespd(framespd, cell_size = 2.25, crs = "EPSG:4326"):
 
     col = 'daz_mm_notide'
     if col+'_mmyear' in framespd:
-        decomposed = gridgrouped.apply(decompose_azi2NE, col)
+        decomposed = gridgrouped.apply(decompose_azi2NE, col, weighted = weighted)
         gridagg['VEL_N_noT'] = decomposed['V_N'].values
         gridagg['VEL_E_noT'] = decomposed['V_E'].values
         gridagg['RMSE_VEL_N_noT'] = decomposed['RMSE_N'].values
@@ -724,7 +1427,7 @@ def decompose_framespd(framespd, cell_size = 2.25, crs = "EPSG:4326"):
 
     col='daz_mm'
     if col + '_mmyear' in framespd:
-        decomposed = gridgrouped.apply(decompose_azi2NE, col)
+        decomposed = gridgrouped.apply(decompose_azi2NE, col, weighted = weighted)
         gridagg['VEL_N'] = decomposed['V_N'].values
         gridagg['VEL_E'] = decomposed['V_E'].values
         gridagg['RMSE_VEL_N'] = decomposed['RMSE_N'].values
@@ -734,7 +1437,7 @@ def decompose_framespd(framespd, cell_size = 2.25, crs = "EPSG:4326"):
     col = 'vel_az'
     colstd = 'std_az'
     if (col in framespd) and (colstd in framespd):
-        decomposed = gridgrouped.apply(decompose_azi2NE, col, colstd)
+        decomposed = gridgrouped.apply(decompose_azi2NE, col, colstd, weighted = weighted)
         gridagg['VEL_N_daz'] = decomposed['V_N'].values
         gridagg['VEL_E_daz'] = decomposed['V_E'].values
         gridagg['RMSE_VEL_N_daz'] = decomposed['RMSE_N'].values
@@ -743,7 +1446,7 @@ def decompose_framespd(framespd, cell_size = 2.25, crs = "EPSG:4326"):
         col2 = 'vel_rg'
         colstd2 = 'std_rg'
         if (col2 in framespd) and (colstd2 in framespd):
-            decomposed = gridgrouped.apply(decompose_azrg2NEU) #, col, colstd)
+            decomposed = gridgrouped.apply(decompose_azrg2NEU, weighted = weighted) #, col, colstd)
             gridagg['VEL_N_dazdrg'] = decomposed['V_N'].values
             gridagg['VEL_E_dazdrg'] = decomposed['V_E'].values
             gridagg['VEL_U_dazdrg'] = decomposed['V_U'].values
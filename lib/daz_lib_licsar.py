@@ -35,6 +35,7 @@ except:
 
 from daz_lib import *
 import datetime as dt # just in case..
+from functools import lru_cache
 
 def extract_all2txt(outfr = 'frames.txt', outdaz = 'esds.txt', inframelist = None, fix_epoch_time = False):
     """ Main function to extract all frame and daz data from the LiCSAR database.
@@ -115,7 +116,9 @@ def extract2txt_esds_frame(frame, fix_epoch_time = False, datemin=dt.date(2014,1
     the resultant txt file is a csv as:
     frame,esd_master,epoch,daz_total_wrt_orbits,daz_cc_wrt_orbits,orbits_precision,version
 
-    or with epochtime as well, if this was set by fix_epoch_time (takes long...)
+    or with epochtime as well, if this was set by fix_epoch_time (default: False, no epochtime). With fix_epoch_time = True, epochtime is
+    derived from the reference epoch acquisition time and the 6/12-day repeat (see add_epochtime). Use fix_epoch_time = 'bperps' for the
+    original (slow) estimate through fc.estimate_bperps
     '''
     a = get_daz_frame(frame, datemin=datemin, datemax=datemax)
     if 'epoch' in a:
@@ -127,12 +130,30 @@ def extract2txt_esds_frame(frame, fix_epoch_time = False, datemin=dt.date(2014,1
     a['frame'] = frame
     a=a.rename(columns={'cc_azi':'daz_cc_wrt_orbits'})
     cols = ['frame','esd_master','epoch','daz_total_wrt_orbits','daz_cc_wrt_orbits','orbits_precision','version']
-    if fix_epoch_time:
+    if fix_epoch_time == 'bperps':
         bperp, a['epochtime'] = fc.estimate_bperps(frame, list(a.epoch.values), return_epochsdt = True)
         cols = cols + ['epochtime']
+    elif fix_epoch_time:
+        a['epochdate'] = a['epoch']
+        a = add_epochtime(a, get_frame_master_time(frame))
+        cols = cols + ['epochtime']
     return a[cols]
 
 
+@lru_cache(maxsize=None)
+def get_frame_master_time(frame):
+    ''' Returns (cached) frame reference epoch and its centre_time from the frame metadata.txt, as framespd-like table'''
+    tr = int(frame[:3])
+    a = pd.DataFrame({'frame': [frame], 'master': [''], 'centre_time': ['0']})
+    try:
+        metafile = os.path.join(os.environ['LiCSAR_public'], str(tr), frame, 'metadata', 'metadata.txt')
+        a['master'] = grep1line('master=', metafile).split('=')[1]
+        a['centre_time'] = grep1line('center_time', metafile).split('=')[1]
+    except:
+        print('WARNING, could not get reference epoch time for frame '+frame)
+    return a
+
+
 def get_platemotion_en(df, collon = 'centroid_lon', collat = 'centroid_lat', outcolnm='eur', plate = 'Eurasia'):
     import licsbas_mintpy_PMM as pmm
     #
@@ -366,6 +387,45 @@ def get_param_gamma(param, parfile, floatt = True, pos = 0):
         a = float(a)
     return a
 
+def get_burst_interval(topsparfile, burst_interval = 2.758277):
+    ''' Gets the mean burst interval [s] (burst cycle time) of the swath from burst_asc_node_* times of the TOPS_par file.
+    Returns the nominal burst_interval if not available.'''
+    try:
+        nbursts = int(get_param_gamma('number_of_bursts', topsparfile))
+        ascnodes = [get_param_gamma('burst_asc_node_'+str(i+1)+':', topsparfile) for i in range(nbursts)]
+        if nbursts > 1:
+            burst_interval = float(np.mean(np.diff(ascnodes)))
+    except:
+        print('no burst timing in '+topsparfile+', using the nominal burst interval')
+    return burst_interval
+
+
+def get_burst_overlap_dts(topsparfile, center_time):
+    ''' Gets times [s] of the burst overlaps of the swath w.r.t. the given time (e.g. the swath centre time, in seconds of day).
+    The overlap time is the centre of the overlap of consecutive bursts, from burst_win_* (start, end time) of the TOPS_par file.
+
+    Returns:
+        list or None if not available
+    '''
+    params = {}
+    try:
+        with open(topsparfile) as f:
+            for line in f:
+                if ':' in line:
+                    key, val = line.split(':', 1)
+                    params[key.strip()] = val.split()
+        nbursts = int(params['number_of_bursts'][0])
+        wins = np.array([params['burst_win_'+str(i+1)][:2] for i in range(nbursts)], dtype=float)
+    except (OSError, KeyError, IndexError, ValueError):
+        print('no burst windows in '+topsparfile)
+        return None
+    if nbursts < 2:
+        return None
+    ovltimes = (wins[:-1, 1] + wins[1:, 0])/2
+    # (in case of crossing midnight)
+    return (np.mod(ovltimes - center_time + 43200, 86400) - 43200).tolist()
+
+
 # orig function - now in framecare
 def get_frame_master_s1ab(frame):
     tr = int(frame[:3])
@@ -424,14 +484,18 @@ def get_frameta(frame, perswath=False):
     a['ka'] = [ka]
     a['dfDC'] = [dfDC]
     if perswath:
-        parfiles = glob.glob(os.path.join(path_to_slcdir,primepoch)+'.IW?.slc.par')
+        parfiles = sorted(glob.glob(os.path.join(path_to_slcdir,primepoch)+'.IW?.slc.par'))  # IW1, IW2, IW3 (as nobovls)
         heading = []
         azimuth_resolution = []
         avg_incidence_angle = []
         centre_range_m = []
         centre_time = []
+        center_time_s = []
         lon = []
         lat = []
+        burst_interval = []
+        bovl_dt = []
+        nbovls = []
         for par in parfiles:
             heading.append(get_param_gamma('heading',par))
             azimuth_resolution.append(get_param_gamma('azimuth_pixel_spacing',par))
@@ -442,16 +506,28 @@ def get_frameta(frame, perswath=False):
             centre_range_m.append((nearrange+farrange)/2)
             cdate = grep1line('date', par).split()[4:]
             cdate = cdate[0]+':'+cdate[1]+':'+cdate[2]
-            centre_time.append(cdate)
+            centre_time.append(cdate)  # (this is the swath start time)
+            center_time_s.append(get_param_gamma('center_time', par))
             lon.append(get_param_gamma('center_longitude',par))
             lat.append(get_param_gamma('center_latitude',par))
+            burst_interval.append(get_burst_interval(par.replace('.slc.par', '.slc.TOPS_par')))
+            dts = get_burst_overlap_dts(par.replace('.slc.par', '.slc.TOPS_par'), get_param_gamma('center_time', par))
+            if dts is not None:
+                bovl_dt = bovl_dt + dts
+                nbovls.append(len(dts))
         a['swath_heading'] = [heading]
         a['swath_azimuth_resolution'] = [azimuth_resolution]
         a['swath_avg_incidence_angle'] = [avg_incidence_angle]
         a['swath_centre_range_m'] = [centre_range_m]
         a['swath_centre_time'] = [centre_time]
+        a['swath_center_time_s'] = [center_time_s]  # seconds of day
         a['swath_center_lon'] = [lon]
         a['swath_center_lat'] = [lat]
+        a['swath_burst_interval'] = [burst_interval]
+        if len(nbovls) == len(parfiles):
+            # burst overlap times w.r.t. the swath centre time, of all swaths (nbovls per swath)
+            a['swath_bovl_dt'] = [bovl_dt]
+            a['swath_nbovls'] = [nbovls]
     heading = float(grep1line('heading', metafile).split('=')[1])
     try:
         azimuth_resolution = float(grep1line('azimuth_resolution', metafile).split('=')[1])
@@ -155,15 +155,27 @@ def estimate_slope(epochsdt, mmvalues, rmsiter=5, target_rmse=30, printout = Tru
     return v,c,stderr
 
 
-def estimate_s1ab_allframes(esds, framespd, col = 'daz_mm_notide_noiono', rmsiter = 50):
+def estimate_s1ab_allframes(esds, framespd, col = 'daz_mm_notide_noiono', rmsiter = 50, qc = None):
+    '''
+    Estimates S1AB offset (together with velocity) per frame.
+    If qc (quality table from df_quality_report) is given, frames not flagged as qc_s1ab_ok are skipped (their outputs set to NaN, i.e. not corrected).
+    '''
     lenframes = len(framespd['frame'])
     framespd['S1AB_offset'] = 0.0
     framespd['slope_daz_rmseiter_mmyear']=0.0
     framespd['intercept_daz_rmseiter_mmyear'] = 0.0
     framespd['stderr_daz_rmseiter_mm'] = 0.0
+    s1abframes = framespd['frame']
+    if qc is not None:
+        s1abframes = qc[qc['qc_s1ab_ok']]['frame']
+        skipped = ~framespd['frame'].isin(s1abframes)
+        print('skipping {0} frames without enough S1B data for the S1AB offset'.format(skipped.sum()))
+        framespd.loc[skipped, ['S1AB_offset', 'slope_daz_rmseiter_mmyear', 'intercept_daz_rmseiter_mmyear', 'stderr_daz_rmseiter_mm']] = np.nan
     i = 0
     for frame in framespd['frame']:
         i=i+1
+        if not frame in s1abframes.values:
+            continue
         print('  Running for {0:6}/{1:6}th frame...'.format(i, lenframes), flush=True, end='\r')
         frameta = framespd[framespd['frame']==frame].copy()
         selected_frame_esds = esds[esds['frame'] == frame].copy()
@@ -175,27 +187,66 @@ def estimate_s1ab_allframes(esds, framespd, col = 'daz_mm_notide_noiono', rmsite
         framespd.update(frameta)
     return framespd
 
-def correct_s1ab(esds, framespd, cols = ['daz_mm', 'daz_mm_notide', 'daz_mm_notide_noiono'], stderr_thres = 100):
+def correct_s1ab(esds, framespd, cols = ['daz_mm', 'daz_mm_notide', 'daz_mm_notide_noiono'], stderr_thres = 100, auditcol = None):
     '''
     Will apply S1AB offset to given columns in esds pd, in case the stderr_daz_rmseiter_mm is lower than stderr_thres
+
+    The offsets are joined from framespd to the esds rows flagged as 'B' in one go (no per-frame loop).
+    If auditcol is given (e.g. 'S1AB_correction_mm'), the applied correction is stored to this column (0 where not applied).
     '''
     if 'S1AB_offset' not in framespd:
         print('ERROR, S1AB_offset not in framespd, cancelling')
         return esds, framespd
-    i=0
-    lenframes = len(framespd['frame'])
-    for frame in framespd['frame']:
-        i=i+1
-        print('  Running for {0:6}/{1:6}th frame...'.format(i, lenframes), flush=True, end='\r')
-        frameta = framespd[framespd['frame'] == frame].copy()
-        selected_frame_esds = esds[esds['frame'] == frame].copy()
-        selected_frame_esds = selected_frame_esds[selected_frame_esds['S1AorB']=='B']  #[framespd['stderr_daz_rmseiter_mm']>0]
-        s1aboff = float(frameta['S1AB_offset'].values[0])
-        if float(frameta['stderr_daz_rmseiter_mm'].values[0]) < stderr_thres:
-            selected_frame_esds[cols] = selected_frame_esds[cols] - s1aboff
-        esds.update(selected_frame_esds)
+    cols = [col for col in cols if col in esds]
+    fpd = framespd.drop_duplicates('frame').set_index('frame')
+    # NaN offsets or stderrs mean no correction (as before)
+    s1aboffs = fpd['S1AB_offset'].where(fpd['stderr_daz_rmseiter_mm'] < stderr_thres).fillna(0.0)
+    s1aboff = esds['frame'].map(s1aboffs).fillna(0.0)
+    s1aboff = s1aboff.where(esds['S1AorB'] == 'B', 0.0)
+    esds[cols] = esds[cols].sub(s1aboff, axis=0)
+    if auditcol:
+        esds[auditcol] = s1aboff
     return esds, framespd
 
+
+def df_remove_common_mode(esds, col = 'daz_mm_notide_noiono', minframes = 3, outcol = None, cmcol = None):
+    '''
+    Removes common-mode signal of frames along the same track (relative orbit + pass) acquired at the same date.
+    Frames of one track/date are acquired within seconds along the same orbit, so they share orbit-related errors.
+
+    Each frame is first detrended (linear in time), then median of the residuals across all frames of the same
+    (track, epochdate) is taken as the common mode - only if at least minframes frames contributed.
+    All tracks are processed at once (grouped operations, no per-frame loop).
+
+    Args:
+        esds (pd.DataFrame)
+        col (str):       column to filter
+        minframes (int): minimal number of frames per track and date to estimate the common mode (otherwise 0 is removed)
+        outcol (str):    output column, by default col+'_nocm'
+        cmcol (str):     if given, the removed common mode is stored to this column (e.g. 'daz_cm_mm')
+    Returns:
+        pd.DataFrame: esds with the new column
+    '''
+    if not outcol:
+        outcol = col + '_nocm'
+    if 'years_since_beginning' in esds:
+        xcol = 'years_since_beginning'
+    else:
+        xcol = 'tmp_years'
+        esds[xcol] = pd.to_datetime(esds['epochdate']).map(pd.Timestamp.toordinal)/365.25
+    track = esds['frame'].str[:4]
+    resid = get_grouped_detrended(esds, col, xcol = xcol)
+    grouped = resid.groupby([track, esds['epochdate']])
+    cm = grouped.transform('median').where(grouped.transform('count') >= minframes, 0.0).fillna(0.0)
+    esds[outcol] = esds[col] - cm
+    if cmcol:
+        esds[cmcol] = cm
+    if xcol == 'tmp_years':
+        esds = esds.drop(xcol, axis=1)
+    ntracks = (grouped.count() >= minframes).groupby(level=0).any().sum()
+    print('common mode removed from {0} for {1} tracks, stored as {2}'.format(col, ntracks, outcol))
+    return esds
+
 # reduced version, 2024
 def model_filter_v2(A, y, limrms=3, iters=2, target_rmse = 30, outsigmammy = True, full_stderr = False, weighted = False, printout = True):
     '''